@@ -1,10 +1,18 @@
 import os
 import re
+import time
+import weakref
+import threading
 from jose import jwt
 import requests
 import logging
-from flask import Flask, request, redirect, abort, render_template_string
+import json
+from flask import Flask, Response, request, redirect, abort, render_template_string, stream_with_context
 from kubernetes import client, config
+from jwks_cache import JWKSCache
+from token_cache import TokenCache
+from shell_informer import ShellInformer
+from warm_pool import WarmPool
 import sys
 
 logger = logging.getLogger()
@@ -30,23 +38,32 @@ NAMESPACE = "cloudshell"
 TTYD_IMAGE = "tsl0922/ttyd"
 TTYD_PORT = 7681
 
+# Readiness is served from a watch-fed cache; waiting clients long-poll or stream events
+STATUS_MAX_WAIT = float(os.environ.get("STATUS_MAX_WAIT", "25"))
+STATUS_STREAM_MAX_AGE = float(os.environ.get("STATUS_STREAM_MAX_AGE", "600"))
+STATUS_STREAM_KEEPALIVE = float(os.environ.get("STATUS_STREAM_KEEPALIVE", "15"))
+# API polling interval while the informer has not synced yet
+STATUS_POLL_INTERVAL = float(os.environ.get("STATUS_POLL_INTERVAL", "2"))
 
 
-def get_jwks():
-    try:
-        oidc_conf = requests.get(f"{OAUTH_ISSUER}/.well-known/openid-configuration", verify=True).json()
-        jwks_uri = oidc_conf["jwks_uri"]
-        return requests.get(jwks_uri, verify=True).json()
-    except Exception as e:
-        logging.error(f"Failed to fetch JWKS: {e}")
-        return {"keys": []}
+# Signing keys are indexed by kid and refreshed on TTL or unknown kid
+JWKS_CACHE_TTL = int(os.environ.get("JWKS_CACHE_TTL", "3600"))
+jwks_cache = JWKSCache(OAUTH_ISSUER, ttl=JWKS_CACHE_TTL)
 
-JWKS = get_jwks()
+# Claims of verified tokens are reused until exp; cleared when the signing keys rotate
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "1024"))
+TOKEN_CACHE_TTL = int(os.environ.get("TOKEN_CACHE_TTL", "300"))
+token_cache = TokenCache(max_size=TOKEN_CACHE_SIZE, max_ttl=TOKEN_CACHE_TTL, version_source=lambda: jwks_cache.version)
 
 def verify_id_token(token):
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
     try:
         unverified_header = jwt.get_unverified_header(token)
-        key = next(k for k in JWKS["keys"] if k["kid"] == unverified_header["kid"])
+        key = jwks_cache.get_key(unverified_header.get("kid"))
+        if key is None:
+            raise ValueError(f"No signing key for kid {unverified_header.get('kid')}")
         try:
             payload = jwt.decode(
                 token,
@@ -55,12 +72,15 @@ def verify_id_token(token):
                 audience=OAUTH_CLIENT_ID,
                 issuer=OAUTH_ISSUER,
             )
+            token_cache.put(token, payload)
             return payload
         except jwt.JWTError as e:
             if "at_hash" in str(e):
                 # Ignore at_hash error if you don't have access_token
                 payload = jwt.get_unverified_claims(token)
                 logging.warning("Ignoring at_hash error in id_token: using unverified claims.")
+                # at_hash is checked after the signature, so these claims are still signed
+                token_cache.put(token, payload)
                 return payload
             else:
                 raise
@@ -89,6 +109,41 @@ def get_service_name(username):
 def get_ingress_name(username):
     return f"ttyd-{username}"
 
+# One list-and-watch of pods and services for all users, started with the app
+shell_informer = ShellInformer(NAMESPACE, get_service_name)
+
+def query_shell_ready(username):
+    # Direct API query, only used until the informer has listed pods and services
+    v1 = client.CoreV1Api()
+    try:
+        v1.read_namespaced_service(get_service_name(username), NAMESPACE)
+        pods = v1.list_namespaced_pod(NAMESPACE, label_selector=f"user={username}")
+        return bool(pods.items) and all(pod.status.phase == "Running" for pod in pods.items)
+    except Exception:
+        return False
+
+def wait_shell_ready(username, wait):
+    """Readiness after waiting up to wait seconds for it; polls the API until the informer has synced"""
+    deadline = time.monotonic() + wait
+    while not shell_informer.synced:
+        ready = query_shell_ready(username)
+        remaining = deadline - time.monotonic()
+        if ready or remaining <= 0:
+            return ready
+        time.sleep(min(STATUS_POLL_INTERVAL, remaining))
+    return shell_informer.wait_ready(username, max(0.0, deadline - time.monotonic()))
+
+def authorize_status(username):
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        abort(401)
+    token = auth_header.split(" ", 1)[1]
+    userinfo = get_user_info_from_token(token)
+    if not userinfo:
+        abort(401)
+    if userinfo["username"] != username:
+        abort(403, "Forbidden")
+
 def ensure_serviceaccount(username):
     v1 = client.CoreV1Api()
     sa_name = f"user-{username}"
@@ -139,7 +194,172 @@ def ensure_rolebinding(username, groups):
         else:
             raise
 
+def render_kubeconfig(token):
+    return (
+        "apiVersion: v1\n"
+        "kind: Config\n"
+        "clusters:\n"
+        "- cluster:\n"
+        "    server: https://kubernetes.default.svc\n"
+        "    insecure-skip-tls-verify: true\n"
+        "  name: k8s\n"
+        "users:\n"
+        "- name: user\n"
+        "  user:\n"
+        f"    token: {token}\n"
+        "contexts:\n"
+        "- context:\n"
+        "    cluster: k8s\n"
+        "    user: user\n"
+        "  name: k8s\n"
+        "current-context: k8s\n"
+    )
+
+# Installs kubectl, helm and the docker client into the shared tools volume
+TOOLS_INSTALL_SCRIPT = (
+    "set -ex\n"
+    "apk update\n"
+    "apk add --no-cache curl bash docker-cli openssl file\n"
+    "# Install kubectl\n"
+    "KUBECTL_VERSION=$(curl -L -s https://dl.k8s.io/release/stable.txt)\n"
+    "curl -LO \"https://dl.k8s.io/release/${KUBECTL_VERSION}/bin/linux/amd64/kubectl\"\n"
+    "if ! file kubectl | grep -q 'ELF'; then\n"
+    "  echo \"kubectl download failed!\"\n"
+    "  exit 1\n"
+    "fi\n"
+    "install -m 755 kubectl /tools/kubectl\n"
+    "# Install helm\n"
+    "curl https://raw.githubusercontent.com/helm/helm/main/scripts/get-helm-3 | bash\n"
+    "mv /usr/local/bin/helm /tools/helm\n"
+    "# Copy docker client\n"
+    "cp /usr/bin/docker /tools/docker\n"
+)
+
+def build_ttyd_pod_manifest(metadata, token=None, is_admin=False):
+    """
+    ttyd pod with the tools volume; without a token the kubeconfig is written
+    when the pod is claimed from the warm pool, and such shells have no
+    KUBE_TOKEN in their env (env cannot be changed on a running pod)
+    """
+    script = TOOLS_INSTALL_SCRIPT
+    env = []
+    if token:
+        # The heredoc expands $KUBE_TOKEN into the kubeconfig
+        script += "# Write kubeconfig\ncat <<EOF > /tools/kubeconfig\n" + render_kubeconfig("$KUBE_TOKEN") + "EOF\n"
+        env = [{"name": "KUBE_TOKEN", "value": token}]
+    pod_manifest = {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": metadata,
+        "spec": {
+            # "serviceAccountName": sa_name,
+            "volumes": [
+                {"name": "tools", "emptyDir": {}}
+            ],
+            "initContainers": [
+                {
+                    "name": "install-tools",
+                    "image": "alpine:3.19",
+                    "env": env,
+                    "command": ["sh", "-c", script],
+                    "volumeMounts": [
+                        {"name": "tools", "mountPath": "/tools"}
+                    ]
+                }
+            ],
+            "containers": [
+                {
+                    "name": "ttyd",
+                    "image": TTYD_IMAGE,
+                    "imagePullPolicy": "IfNotPresent",
+                    "command": ["ttyd"],
+                    "args": ["-W", "bash"],
+                    "ports": [{"containerPort": TTYD_PORT}],
+                    "readinessProbe": {
+                        "tcpSocket": {"port": TTYD_PORT},
+                        "periodSeconds": 2
+                    },
+                    "env": [
+                        {
+                            "name": "PATH",
+                            "value": "/tools:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+                        },
+                        {
+                            "name": "KUBECONFIG",
+                            "value": "/tools/kubeconfig"
+                        }
+                    ] + env,
+                    "resources": {},
+                    "volumeMounts": [
+                        {"name": "tools", "mountPath": "/tools"}
+                    ]
+                }
+            ]
+        }
+    }
+
+    # If user is administrator, add privileged, hostPath mount, and hostPID
+    if is_admin:
+        pod_manifest["spec"]["hostPID"] = True
+        pod_manifest["spec"]["containers"][0]["securityContext"] = {"privileged": True}
+        pod_manifest["spec"]["volumes"].append({
+            "name": "host-root",
+            "hostPath": {"path": "/", "type": "Directory"}
+        })
+        pod_manifest["spec"]["containers"][0]["volumeMounts"].append({
+            "name": "host-root",
+            "mountPath": "/host",
+            "mountPropagation": "Bidirectional"
+        })
+        # Set ttyd to launch nsenter bash on the host by default
+        pod_manifest["spec"]["containers"][0]["args"] = [
+            "-W",
+            "nsenter",
+            "--mount=/host/proc/1/ns/mnt",
+            "--uts=/host/proc/1/ns/uts",
+            "--ipc=/host/proc/1/ns/ipc",
+            "--net=/host/proc/1/ns/net",
+            "--pid=/host/proc/1/ns/pid",
+            "--",
+            "bash"
+        ]
+        # Remove env for administrators
+        pod_manifest["spec"]["containers"][0].pop("env", None)
+    return pod_manifest
+
+# Unclaimed shells with the tools already installed; a claim relabels one to the user
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", "2"))
+WARM_POOL_REFILL_INTERVAL = float(os.environ.get("WARM_POOL_REFILL_INTERVAL", "30"))
+WARM_POOL_MAX_AGE = float(os.environ.get("WARM_POOL_MAX_AGE", "86400"))
+WARM_POOL_STARTUP_TIMEOUT = float(os.environ.get("WARM_POOL_STARTUP_TIMEOUT", "600"))
+# Claimed shells without requests through their ingress for this long are deleted (0 keeps them)
+WARM_POOL_IDLE_TIMEOUT = float(os.environ.get("WARM_POOL_IDLE_TIMEOUT", "28800"))
+warm_pool = WarmPool(
+    NAMESPACE,
+    WARM_POOL_SIZE,
+    lambda: build_ttyd_pod_manifest({"generateName": "ttyd-warm-"}),
+    refill_interval=WARM_POOL_REFILL_INTERVAL,
+    max_age=WARM_POOL_MAX_AGE,
+    startup_timeout=WARM_POOL_STARTUP_TIMEOUT,
+    idle_timeout=WARM_POOL_IDLE_TIMEOUT
+)
+
+# Serialises shell creation per user, so concurrent requests cannot claim two pods
+user_locks = weakref.WeakValueDictionary()
+user_locks_guard = threading.Lock()
+
+def get_user_lock(username):
+    with user_locks_guard:
+        lock = user_locks.get(username)
+        if lock is None:
+            lock = user_locks[username] = threading.Lock()
+        return lock
+
 def ensure_ttyd_pod(username, token):
+    with get_user_lock(username):
+        create_ttyd_pod(username, token)
+
+def create_ttyd_pod(username, token):
     v1 = client.CoreV1Api()
     pod_name = get_pod_name(username)
     sa_name = f"user-{username}"
@@ -153,135 +373,17 @@ def ensure_ttyd_pod(username, token):
         groups = payload.get("groups", [])
         is_admin = "administrators" in groups
 
-        pod_manifest = {
-            "apiVersion": "v1",
-            "kind": "Pod",
-            "metadata": {
-                "name": pod_name,
-                "labels": {"user": username}
-            },
-            "spec": {
-                # "serviceAccountName": sa_name,
-                "volumes": [
-                    {"name": "tools", "emptyDir": {}}
-                ],
-                "initContainers": [
-                    {
-                        "name": "install-tools",
-                        "image": "alpine:3.19",
-                        "env": [
-                            {
-                                "name": "KUBE_TOKEN",
-                                "value": token
-                            }
-                        ],
-                        "command": [
-                            "sh",
-                            "-c",
-                            (
-                                "set -ex\n"
-                                "apk update\n"
-                                "apk add --no-cache curl bash docker-cli openssl file\n"
-                                "# Install kubectl\n"
-                                "KUBECTL_VERSION=$(curl -L -s https://dl.k8s.io/release/stable.txt)\n"
-                                "curl -LO \"https://dl.k8s.io/release/${KUBECTL_VERSION}/bin/linux/amd64/kubectl\"\n"
-                                "if ! file kubectl | grep -q 'ELF'; then\n"
-                                "  echo \"kubectl download failed!\"\n"
-                                "  exit 1\n"
-                                "fi\n"
-                                "install -m 755 kubectl /tools/kubectl\n"
-                                "# Install helm\n"
-                                "curl https://raw.githubusercontent.com/helm/helm/main/scripts/get-helm-3 | bash\n"
-                                "mv /usr/local/bin/helm /tools/helm\n"
-                                "# Copy docker client\n"
-                                "cp /usr/bin/docker /tools/docker\n"
-                                "# Write kubeconfig\n"
-                                "cat <<EOF > /tools/kubeconfig\n"
-                                "apiVersion: v1\n"
-                                "kind: Config\n"
-                                "clusters:\n"
-                                "- cluster:\n"
-                                "    server: https://kubernetes.default.svc\n"
-                                "    insecure-skip-tls-verify: true\n"
-                                "  name: k8s\n"
-                                "users:\n"
-                                "- name: user\n"
-                                "  user:\n"
-                                "    token: $KUBE_TOKEN\n"
-                                "contexts:\n"
-                                "- context:\n"
-                                "    cluster: k8s\n"
-                                "    user: user\n"
-                                "  name: k8s\n"
-                                "current-context: k8s\n"
-                                "EOF\n"
-                            )
-                        ],
-                        "volumeMounts": [
-                            {"name": "tools", "mountPath": "/tools"}
-                        ]
-                    }
-                ],
-                "containers": [
-                    {
-                        "name": "ttyd",
-                        "image": TTYD_IMAGE,
-                        "imagePullPolicy": "IfNotPresent",
-                        "command": ["ttyd"],
-                        "args": ["-W", "bash"],
-                        "ports": [{"containerPort": TTYD_PORT}],
-                        "env": [
-                            {
-                                "name": "PATH",
-                                "value": "/tools:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
-                            },
-                            {
-                                "name": "KUBECONFIG",
-                                "value": "/tools/kubeconfig"
-                            },
-                            {
-                                "name": "KUBE_TOKEN",
-                                "value": token
-                            }
-                        ],
-                        "resources": {},
-                        "volumeMounts": [
-                            {"name": "tools", "mountPath": "/tools"}
-                        ]
-                    }
-                ]
-            }
-        }
-
-        # If user is administrator, add privileged, hostPath mount, and hostPID
-        if is_admin:
-            pod_manifest["spec"]["hostPID"] = True
-            pod_manifest["spec"]["containers"][0]["securityContext"] = {"privileged": True}
-            pod_manifest["spec"]["volumes"].append({
-                "name": "host-root",
-                "hostPath": {"path": "/", "type": "Directory"}
-            })
-            pod_manifest["spec"]["containers"][0]["volumeMounts"].append({
-                "name": "host-root",
-                "mountPath": "/host",
-                "mountPropagation": "Bidirectional"
-            })
-            # Set ttyd to launch nsenter bash on the host by default
-            pod_manifest["spec"]["containers"][0]["args"] = [
-                "-W",
-                "nsenter",
-                "--mount=/host/proc/1/ns/mnt",
-                "--uts=/host/proc/1/ns/uts",
-                "--ipc=/host/proc/1/ns/ipc",
-                "--net=/host/proc/1/ns/net",
-                "--pid=/host/proc/1/ns/pid",
-                "--",
-                "bash"
-            ]
-            # Remove env for administrators
-            pod_manifest["spec"]["containers"][0].pop("env", None)
-
+        # Administrator shells are privileged, so they are never taken from the pool
+        if not is_admin:
+            try:
+                if warm_pool.claim(username, render_kubeconfig(token)):
+                    return
+            except Exception as e:
+                logging.warning(f"Claiming a warm shell for {username} failed: {e}")
 
+        pod_manifest = build_ttyd_pod_manifest(
+            {"name": pod_name, "labels": {"user": username}}, token=token, is_admin=is_admin
+        )
         v1.create_namespaced_pod(namespace=NAMESPACE, body=pod_manifest)
 
 def ensure_ttyd_service(username):
@@ -387,28 +489,44 @@ def validate_user():
 
     if current_user != username:
         abort(403, "Forbidden: You cannot access another user's terminal.")
+    # nginx validates every request to the shell, terminal reconnects included
+    warm_pool.touch(username)
     return {"allowed": True}
 
 @app.route("/status/<username>")
 def status(username):
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return "Unauthorized", 401
-    token = auth_header.split(" ", 1)[1]
-    userinfo = get_user_info_from_token(token)
-    current_user = userinfo["username"]
-    if current_user != username:
-        abort(403, "Forbidden")
-    v1 = client.CoreV1Api()
-    service_name = get_service_name(username)
-    try:
-        svc = v1.read_namespaced_service(service_name, NAMESPACE)
-        pods = v1.list_namespaced_pod(NAMESPACE, label_selector=f"user={username}")
-        if pods.items and all(pod.status.phase == "Running" for pod in pods.items):
-            return {"ready": True}
-    except Exception:
-        pass
-    return {"ready": False}
+    """Shell readiness; with ?wait=<seconds> the request is held until ready or the wait expires"""
+    authorize_status(username)
+    wait = min(max(request.args.get("wait", 0, type=float), 0), STATUS_MAX_WAIT)
+    return {"ready": wait_shell_ready(username, wait)}
+
+@app.route("/events/<username>")
+def status_events(username):
+    """Server-sent events with the shell's readiness; the stream ends once it is ready"""
+    authorize_status(username)
+
+    def events():
+        deadline = time.monotonic() + STATUS_STREAM_MAX_AGE
+        ready = None
+        while time.monotonic() < deadline:
+            synced = shell_informer.synced
+            if synced:
+                current = shell_informer.wait_change(username, ready, STATUS_STREAM_KEEPALIVE)
+            else:
+                current = query_shell_ready(username)
+            if current != ready:
+                ready = current
+                yield f"data: {json.dumps({'ready': ready})}\n\n"
+                if ready:
+                    return
+            else:
+                # Keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+            if not synced:
+                time.sleep(STATUS_POLL_INTERVAL)
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/delete", methods=["GET", "POST"])
 def delete_user_resources():
@@ -439,12 +557,18 @@ def delete_user_resources():
     service_name = get_service_name(username)
     ingress_name = get_ingress_name(username)
 
-    # Delete Pod
+    # Delete Pod (shells claimed from the warm pool have a generated name)
     try:
-        v1.delete_namespaced_pod(pod_name, NAMESPACE)
+        pods = v1.list_namespaced_pod(NAMESPACE, label_selector=f"user={username}")
+        pod_names = {pod.metadata.name for pod in pods.items} | {pod_name}
+        for name in pod_names:
+            try:
+                v1.delete_namespaced_pod(name, NAMESPACE)
+            except client.exceptions.ApiException as e:
+                if e.status != 404:
+                    raise
     except client.exceptions.ApiException as e:
-        if e.status != 404:
-            return f"Error deleting pod: {e}", 500
+        return f"Error deleting pod: {e}", 500
 
     # Delete Service
     try:
@@ -481,6 +605,7 @@ def index():
     userid = userinfo["userid"]
     groups = userinfo.get("groups", [])
 
+    warm_pool.touch(username)
     # ensure_serviceaccount(username)
     # ensure_rolebinding(username, groups)
     ensure_ttyd_pod(username, token)
@@ -488,19 +613,24 @@ def index():
     ensure_ttyd_ingress(username)
 
     user_url = f"https://kube.gokcloud.com/cloudshell/user/{username}/"
-    # Serve progress page with JS polling
+    # Serve progress page with JS long-polling
     return render_template_string("""
     <!DOCTYPE html>
     <html>
     <head>
       <title>Starting your Cloud Shell...</title>
       <script>
+        // Long-poll: the server answers as soon as the shell is ready or after {{wait}}s
         async function poll() {
-          let resp = await fetch("/cloudshell/home/status/{{username}}", {headers: {"Authorization": document.cookie.split('; ').find(row => row.startsWith('Authorization='))?.split('=')[1] ? "Bearer " + document.cookie.split('; ').find(row => row.startsWith('Authorization='))?.split('=')[1] : ""}});
-          let data = await resp.json();
-          if (data.ready) {
-            window.location.href = "{{user_url}}";
-          } else {
+          try {
+            let resp = await fetch("/cloudshell/home/status/{{username}}?wait={{wait}}", {headers: {"Authorization": document.cookie.split('; ').find(row => row.startsWith('Authorization='))?.split('=')[1] ? "Bearer " + document.cookie.split('; ').find(row => row.startsWith('Authorization='))?.split('=')[1] : ""}});
+            let data = await resp.json();
+            if (data.ready) {
+              window.location.href = "{{user_url}}";
+              return;
+            }
+            poll();
+          } catch (e) {
             setTimeout(poll, 2000);
           }
         }
@@ -513,7 +643,9 @@ def index():
       <div id="spinner" style="font-size:48px;">⏳</div>
     </body>
     </html>
-    """, username=username, user_url=user_url)
+    """, username=username, user_url=user_url, wait=int(STATUS_MAX_WAIT))
 
 if __name__ == "__main__":
+    shell_informer.start()
+    warm_pool.start()
     app.run(host="0.0.0.0", port=8080)
\ No newline at end of file
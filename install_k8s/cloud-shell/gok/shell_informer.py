@@ -0,0 +1,154 @@
+"""
+Informer-style cache of cloud shell pods and services
+One list-and-watch per resource kind keeps the state of every ttyd pod and
+service in the cloudshell namespace in memory. Readiness checks read the
+cache and waiters are woken when it changes, so the API server sees the
+same two watches however many users wait for their shells
+"""
+
+import time
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+from kubernetes import client, watch
+
+logger = logging.getLogger(__name__)
+
+
+class ShellInformer:
+    """Watch-fed cache of pods (by user label) and services in one namespace"""
+
+    def __init__(self,
+                 namespace: str,
+                 service_name: Callable[[str], str],
+                 user_label: str = "user",
+                 watch_timeout: int = 300,
+                 retry_delay: float = 5):
+        """
+        Initialize the informer; call start() to begin watching
+
+        Args:
+            namespace: Namespace of the shells
+            service_name: Maps a username to the name of its ttyd service
+            user_label: Pod label holding the username
+            watch_timeout: Seconds after which the API server ends a watch (it is resumed)
+            retry_delay: Seconds to wait after a failed list or watch
+        """
+        self.namespace = namespace
+        self.service_name = service_name
+        self.user_label = user_label
+        self.watch_timeout = watch_timeout
+        self.retry_delay = retry_delay
+
+        self._changed = threading.Condition()
+        # pod name -> (username, phase); service names
+        self._pods: Dict[str, tuple] = {}
+        self._services = set()
+        self._synced = {"pods": threading.Event(), "services": threading.Event()}
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @property
+    def synced(self) -> bool:
+        return all(event.is_set() for event in self._synced.values())
+
+    def start(self):
+        """Start the watch threads; idempotent"""
+        with self._lock:
+            if self._threads:
+                return
+            v1 = client.CoreV1Api()
+            self._threads = [
+                threading.Thread(target=self._run, args=("pods", v1.list_namespaced_pod, self._apply_pod),
+                                 name="informer-pods", daemon=True),
+                threading.Thread(target=self._run, args=("services", v1.list_namespaced_service, self._apply_service),
+                                 name="informer-services", daemon=True),
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def wait_synced(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        return all(event.wait(max(0.0, deadline - time.monotonic())) for event in self._synced.values())
+
+    def is_ready(self, username: str) -> bool:
+        """Same rule as a direct query: the service exists and every pod of the user is Running"""
+        with self._changed:
+            return self._ready_locked(username)
+
+    def wait_ready(self, username: str, timeout: float) -> bool:
+        """Block until the user's shell is ready or the timeout expires; returns readiness"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._ready_locked(username), timeout)
+
+    def wait_change(self, username: str, last: Optional[bool], timeout: float) -> bool:
+        """Block until readiness differs from last (or the timeout expires); returns readiness"""
+        with self._changed:
+            self._changed.wait_for(lambda: self._ready_locked(username) != last, timeout)
+            return self._ready_locked(username)
+
+    def _ready_locked(self, username: str) -> bool:
+        if self.service_name(username) not in self._services:
+            return False
+        phases = [phase for user, phase in self._pods.values() if user == username]
+        return bool(phases) and all(phase == "Running" for phase in phases)
+
+    def _apply_pod(self, event_type: str, pod):
+        name = pod.metadata.name
+        if event_type == "DELETED":
+            self._pods.pop(name, None)
+        else:
+            user = (pod.metadata.labels or {}).get(self.user_label)
+            self._pods[name] = (user, pod.status.phase if pod.status else None)
+
+    def _apply_service(self, event_type: str, service):
+        name = service.metadata.name
+        if event_type == "DELETED":
+            self._services.discard(name)
+        else:
+            self._services.add(name)
+
+    def _replace(self, kind: str, items, apply):
+        with self._changed:
+            if kind == "pods":
+                self._pods.clear()
+            else:
+                self._services.clear()
+            for item in items:
+                apply("ADDED", item)
+            self._changed.notify_all()
+
+    def _run(self, kind: str, list_func, apply):
+        while True:
+            try:
+                listing = list_func(self.namespace)
+                self._replace(kind, listing.items, apply)
+                self._synced[kind].set()
+                resource_version = listing.metadata.resource_version
+                logger.info(f"Informer listed {len(listing.items)} {kind} in {self.namespace}")
+                while True:
+                    stream = watch.Watch().stream(
+                        list_func, self.namespace,
+                        resource_version=resource_version,
+                        timeout_seconds=self.watch_timeout
+                    )
+                    for event in stream:
+                        obj = event["object"]
+                        if event["type"] == "ERROR":
+                            raw = event.get("raw_object") or {}
+                            raise client.exceptions.ApiException(status=raw.get("code") or 500,
+                                                                 reason=raw.get("message"))
+                        resource_version = obj.metadata.resource_version
+                        with self._changed:
+                            apply(event["type"], obj)
+                            self._changed.notify_all()
+            except client.exceptions.ApiException as e:
+                if e.status == 410:
+                    # Our resourceVersion is too old; list again
+                    logger.info(f"Informer watch on {kind} expired, relisting")
+                    continue
+                logger.warning(f"Informer watch on {kind} failed: {e}")
+            except Exception as e:
+                logger.warning(f"Informer watch on {kind} failed: {e}")
+            time.sleep(self.retry_delay)
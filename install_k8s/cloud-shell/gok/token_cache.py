@@ -0,0 +1,109 @@
+"""
+Verified token cache for OIDC bearer tokens
+Keeps the claims of already verified tokens until they expire so repeated
+requests with the same token skip the RS256 signature check
+"""
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+
+class TokenCache:
+    """Bounded LRU of verified token claims with per-entry expiry"""
+
+    def __init__(self,
+                 max_size: int = 1024,
+                 max_ttl: float = 300,
+                 version_source: Callable[[], int] = None):
+        """
+        Initialize the token cache
+
+        Args:
+            max_size: Maximum number of cached tokens
+            max_ttl: Upper bound in seconds for how long claims are trusted,
+                even if the token's exp is later
+            version_source: Returns the current signing key set version; the
+                cache is cleared whenever it changes (key rotation)
+        """
+        self.max_size = max(1, max_size)
+        self.max_ttl = max_ttl
+        self.version_source = version_source
+
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = version_source() if version_source else None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def _check_version(self):
+        if self.version_source is None:
+            return
+        version = self.version_source()
+        if version != self._version:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+            self._version = version
+
+    def get(self, token: str) -> Optional[Dict]:
+        """Return cached claims for a token, or None if it has to be verified"""
+        if not token:
+            return None
+        key = self._digest(token)
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            claims, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return claims
+
+    def put(self, token: str, claims: Dict):
+        """Cache the claims of a token that passed verification"""
+        if not token or not claims:
+            return
+        now = time.time()
+        expires_at = now + self.max_ttl
+        exp = claims.get("exp")
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, exp)
+        if expires_at <= now:
+            return
+        key = self._digest(token)
+        with self._lock:
+            self._check_version()
+            self._entries[key] = (claims, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,241 @@
+"""
+Warm pool of pre-provisioned cloud shell pods
+A background loop keeps a number of ttyd pods whose tools are already
+installed running in the namespace. Claiming one writes the user's
+kubeconfig into it and then labels it with the user, which the user's
+service selects at once, so a shell is ready in well under a second
+instead of waiting for the tool install of a fresh pod. Claimed shells are deleted again once
+their user has not used them for the idle timeout
+"""
+
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+from kubernetes import client
+from kubernetes.stream import stream
+
+logger = logging.getLogger(__name__)
+
+CLAIMED_AT_ANNOTATION = "cloudshell/claimed-at"
+
+
+class WarmPool:
+    """Pre-started pods labelled pool=warm, handed to users on claim()"""
+
+    def __init__(self,
+                 namespace: str,
+                 size: int,
+                 pod_manifest: Callable[[], dict],
+                 user_label: str = "user",
+                 pool_label: str = "pool",
+                 container: str = "ttyd",
+                 kubeconfig_path: str = "/tools/kubeconfig",
+                 refill_interval: float = 30,
+                 max_age: float = 86400,
+                 startup_timeout: float = 600,
+                 idle_timeout: float = 28800,
+                 exec_timeout: float = 10):
+        """
+        Initialize the pool; call start() to begin filling it
+
+        Args:
+            namespace: Namespace of the shells
+            size: Number of unclaimed pods to keep; 0 disables the pool
+            pod_manifest: Returns the manifest of a new unclaimed pod (without pool label)
+            user_label: Pod label holding the username, selected by the user's service
+            pool_label: Pod label marking pool pods as warm or claimed
+            container: Container the kubeconfig is written into
+            kubeconfig_path: Path of the kubeconfig inside the container
+            refill_interval: Seconds between checks of the pool when nothing was claimed
+            max_age: Seconds after which an unclaimed pod is replaced (picks up new tool versions)
+            startup_timeout: Seconds after which an unclaimed pod that is not ready is replaced
+            idle_timeout: Seconds without touch() after which a claimed pod is deleted; 0 keeps them
+            exec_timeout: Seconds to wait for the kubeconfig to be written
+        """
+        self.namespace = namespace
+        self.size = max(0, size)
+        self.pod_manifest = pod_manifest
+        self.user_label = user_label
+        self.pool_label = pool_label
+        self.container = container
+        self.kubeconfig_path = kubeconfig_path
+        self.refill_interval = refill_interval
+        self.max_age = max_age
+        self.startup_timeout = startup_timeout
+        self.idle_timeout = idle_timeout
+        self.exec_timeout = exec_timeout
+
+        # username -> last request through the user's shell, seen by this process
+        self._last_active: Dict[str, datetime] = {}
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def start(self):
+        """Start the refill loop; idempotent, does nothing if the pool is disabled"""
+        with self._lock:
+            if self._thread is not None or not self.enabled:
+                return
+            self._thread = threading.Thread(target=self._run, name="warm-pool", daemon=True)
+        self._thread.start()
+
+    def touch(self, username: str):
+        """Record activity in the user's shell; keeps a claimed pod from being reaped"""
+        with self._lock:
+            self._last_active[username] = datetime.now(timezone.utc)
+
+    def claim(self, username: str, kubeconfig: str) -> Optional[str]:
+        """
+        Hand a ready pool pod to a user
+
+        Returns:
+            Name of the claimed pod, or None if no ready pod could be claimed
+        """
+        if not self.enabled:
+            return None
+        v1 = client.CoreV1Api()
+        pods = v1.list_namespaced_pod(self.namespace, label_selector=f"{self.pool_label}=warm")
+        # Oldest first, so pods are recycled before they reach max_age
+        candidates = sorted((pod for pod in pods.items if _is_ready(pod)),
+                            key=lambda pod: pod.metadata.creation_timestamp)
+        try:
+            return self._claim_first(v1, candidates, username, kubeconfig)
+        finally:
+            # Refill right away rather than at the next interval
+            self._wake.set()
+
+    def _claim_first(self, v1, candidates, username: str, kubeconfig: str) -> Optional[str]:
+        for pod in candidates:
+            name = pod.metadata.name
+            # Take the pod out of the pool first; resourceVersion makes the patch
+            # fail with 409 if another request claimed it first
+            body = {"metadata": {
+                "resourceVersion": pod.metadata.resource_version,
+                "labels": {self.pool_label: "claimed"},
+                "annotations": {CLAIMED_AT_ANNOTATION: datetime.now(timezone.utc).isoformat()}
+            }}
+            try:
+                v1.patch_namespaced_pod(name, self.namespace, body)
+            except client.exceptions.ApiException as e:
+                if e.status in (404, 409):
+                    continue
+                raise
+            try:
+                self._write_file(v1, name, kubeconfig)
+                # Only now the user's service selects the pod and it is reported ready
+                v1.patch_namespaced_pod(name, self.namespace, {"metadata": {"labels": {self.user_label: username}}})
+            except Exception as e:
+                logger.error(f"Handing pool pod {name} to {username} failed: {e}")
+                self._delete(v1, name)
+                continue
+            logger.info(f"Claimed pool pod {name} for {username}")
+            return name
+        return None
+
+    def reconcile(self):
+        """Reap idle claimed pods, replace failed, stuck and expired unclaimed pods and top the pool up to size"""
+        v1 = client.CoreV1Api()
+        self.reap_claimed(v1)
+        pods = v1.list_namespaced_pod(self.namespace, label_selector=f"{self.pool_label}=warm")
+        now = datetime.now(timezone.utc)
+        kept = []
+        for pod in pods.items:
+            if pod.metadata.deletion_timestamp is not None:
+                continue
+            age = (now - pod.metadata.creation_timestamp).total_seconds()
+            phase = pod.status.phase if pod.status else None
+            if phase in ("Failed", "Succeeded") or age > self.max_age or (
+                    not _is_ready(pod) and age > self.startup_timeout):
+                logger.info(f"Replacing pool pod {pod.metadata.name} (phase {phase}, age {int(age)}s)")
+                self._delete(v1, pod.metadata.name)
+            else:
+                kept.append(pod)
+        kept.sort(key=lambda pod: pod.metadata.creation_timestamp)
+        for pod in kept[self.size:]:
+            self._delete(v1, pod.metadata.name)
+        for _ in range(self.size - len(kept)):
+            manifest = self.pod_manifest()
+            manifest["metadata"].setdefault("labels", {})[self.pool_label] = "warm"
+            v1.create_namespaced_pod(namespace=self.namespace, body=manifest)
+
+    def reap_claimed(self, v1):
+        """Delete claimed pods that are idle, or whose handover to a user never completed"""
+        pods = v1.list_namespaced_pod(self.namespace, label_selector=f"{self.pool_label}=claimed")
+        now = datetime.now(timezone.utc)
+        for pod in pods.items:
+            if pod.metadata.deletion_timestamp is not None:
+                continue
+            claimed_at = _claimed_at(pod)
+            username = (pod.metadata.labels or {}).get(self.user_label)
+            if username is None:
+                # The claiming request died between its two patches
+                if (now - claimed_at).total_seconds() > self.startup_timeout:
+                    logger.info(f"Deleting pool pod {pod.metadata.name} claimed by nobody")
+                    self._delete(v1, pod.metadata.name)
+                continue
+            if not self.idle_timeout:
+                continue
+            with self._lock:
+                # After a restart activity counts from the claim
+                last_active = max(claimed_at, self._last_active.get(username, claimed_at))
+            if (now - last_active).total_seconds() > self.idle_timeout:
+                logger.info(f"Deleting idle shell {pod.metadata.name} of {username}")
+                self._delete(v1, pod.metadata.name)
+                with self._lock:
+                    self._last_active.pop(username, None)
+
+    def _write_file(self, v1, pod_name: str, content: str):
+        data = content.encode()
+        # head -c exits after exactly len(data) bytes, so stdin never has to be closed
+        resp = stream(
+            v1.connect_get_namespaced_pod_exec, pod_name, self.namespace,
+            container=self.container,
+            command=["sh", "-c", f"head -c {len(data)} > {self.kubeconfig_path}"],
+            stdin=True, stdout=True, stderr=True, tty=False,
+            _preload_content=False
+        )
+        try:
+            resp.write_stdin(content)
+            resp.run_forever(timeout=self.exec_timeout)
+            if resp.is_open():
+                raise TimeoutError(f"exec did not finish within {self.exec_timeout}s")
+            if resp.returncode != 0:
+                raise RuntimeError(f"exec exited with {resp.returncode}: {resp.read_stderr()}")
+        finally:
+            resp.close()
+
+    def _delete(self, v1, pod_name: str):
+        try:
+            v1.delete_namespaced_pod(pod_name, self.namespace)
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                logger.warning(f"Deleting pool pod {pod_name} failed: {e}")
+
+    def _run(self):
+        while True:
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.warning(f"Warm pool refill failed: {e}")
+            self._wake.wait(self.refill_interval)
+            self._wake.clear()
+
+
+def _claimed_at(pod) -> datetime:
+    value = (pod.metadata.annotations or {}).get(CLAIMED_AT_ANNOTATION)
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return pod.metadata.creation_timestamp
+
+
+def _is_ready(pod) -> bool:
+    if not pod.status or pod.status.phase != "Running" or pod.metadata.deletion_timestamp is not None:
+        return False
+    return any(c.type == "Ready" and c.status == "True" for c in pod.status.conditions or ())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the watch-fed cloud shell informer
+List calls and watch streams are replaced by scripted fakes
+"""
+
+import os
+import sys
+import queue
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+# Add the gok directory to Python path to import the cloud shell modules
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, 'gok'))
+
+import shell_informer
+from shell_informer import ShellInformer
+
+END = object()
+
+
+def make_pod(name, user, phase="Running", version="1"):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=name, labels={"user": user}, resource_version=version),
+        status=SimpleNamespace(phase=phase)
+    )
+
+
+def make_service(name, version="1"):
+    return SimpleNamespace(metadata=SimpleNamespace(name=name, labels={}, resource_version=version))
+
+
+class FakeResource:
+    """A list call returning the current items and a scripted queue of watch events"""
+
+    def __init__(self, items=()):
+        self.items = list(items)
+        self.events = queue.Queue()
+        self.lists = 0
+        self.listed = threading.Event()
+        self.allow_list = threading.Event()
+        self.allow_list.set()
+
+    def list(self, namespace):
+        self.allow_list.wait()
+        self.lists += 1
+        self.listed.set()
+        return SimpleNamespace(items=list(self.items), metadata=SimpleNamespace(resource_version=str(self.lists)))
+
+    def stream(self):
+        while True:
+            event = self.events.get()
+            if event is END:
+                return
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+
+class FakeWatch:
+    def stream(self, list_func, namespace, **kwargs):
+        return list_func.__self__.stream()
+
+
+class TestShellInformer(unittest.TestCase):
+    """Test cases for the informer's cache, waits and resyncs"""
+
+    def informer(self, pods=(), services=()):
+        self.pods = FakeResource(pods)
+        self.services = FakeResource(services)
+        api = SimpleNamespace(list_namespaced_pod=self.pods.list, list_namespaced_service=self.services.list)
+        for patcher in (patch.object(shell_informer.client, "CoreV1Api", return_value=api),
+                        patch.object(shell_informer.watch, "Watch", FakeWatch)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        informer = ShellInformer("cloudshell", lambda user: f"ttyd-{user}", retry_delay=0.01)
+        # Park the watch threads in their next list call when the test ends
+        self.addCleanup(self.park, self.pods, self.services)
+        return informer
+
+    @staticmethod
+    def park(*resources):
+        for resource in resources:
+            resource.allow_list.clear()
+            resource.events.put(RuntimeError("test over"))
+
+    def test_initial_list_fills_the_cache(self):
+        informer = self.informer([make_pod("p1", "bob"), make_pod("p2", "alice", "Pending")],
+                                 [make_service("ttyd-bob"), make_service("ttyd-alice")])
+        informer.start()
+        self.assertTrue(informer.wait_synced(5))
+        self.assertTrue(informer.is_ready("bob"))
+        self.assertFalse(informer.is_ready("alice"))
+        self.assertFalse(informer.is_ready("carol"))
+
+    def test_events_update_readiness_and_wake_waiters(self):
+        informer = self.informer([make_pod("p1", "bob", "Pending")], [make_service("ttyd-bob")])
+        informer.start()
+        self.assertTrue(informer.wait_synced(5))
+
+        def run_later():
+            time.sleep(0.1)
+            self.pods.events.put({"type": "MODIFIED", "object": make_pod("p1", "bob", "Running", "2")})
+
+        threading.Thread(target=run_later).start()
+        start = time.monotonic()
+        self.assertTrue(informer.wait_ready("bob", 5))
+        self.assertLess(time.monotonic() - start, 2)
+
+        self.pods.events.put({"type": "ADDED", "object": make_pod("p2", "bob", "Pending", "3")})
+        self.assertFalse(informer.wait_change("bob", True, 5))
+        self.pods.events.put({"type": "DELETED", "object": make_pod("p2", "bob", "Pending", "4")})
+        self.assertTrue(informer.wait_change("bob", False, 5))
+        self.services.events.put({"type": "DELETED", "object": make_service("ttyd-bob", "2")})
+        self.assertFalse(informer.wait_change("bob", True, 5))
+
+    def test_wait_times_out_before_sync(self):
+        informer = self.informer([make_pod("p1", "bob")], [make_service("ttyd-bob")])
+        self.pods.allow_list.clear()
+        informer.start()
+        self.assertFalse(informer.wait_synced(0.1))
+        self.assertFalse(informer.synced)
+        start = time.monotonic()
+        self.assertFalse(informer.wait_ready("bob", 0.2))
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.pods.allow_list.set()
+        self.assertTrue(informer.wait_ready("bob", 5))
+
+    def test_expired_watch_relists(self):
+        informer = self.informer([make_pod("p1", "bob")], [make_service("ttyd-bob")])
+        informer.start()
+        self.assertTrue(informer.wait_synced(5))
+        # Changes missed while the watch was gone show up in the new list
+        self.pods.items = [make_pod("p1", "bob", "Failed")]
+        self.pods.listed.clear()
+        self.pods.events.put({"type": "ERROR", "object": None, "raw_object": {"code": 410, "message": "Gone"}})
+        self.assertTrue(self.pods.listed.wait(5))
+        self.assertFalse(informer.wait_change("bob", True, 5))
+        self.assertEqual(self.pods.lists, 2)
+
+    def test_failed_watch_is_retried_with_a_new_list(self):
+        informer = self.informer([], [make_service("ttyd-bob")])
+        informer.start()
+        self.assertTrue(informer.wait_synced(5))
+        self.pods.items = [make_pod("p1", "bob")]
+        self.pods.listed.clear()
+        self.pods.events.put(ConnectionError("connection reset"))
+        self.assertTrue(self.pods.listed.wait(5))
+        self.assertTrue(informer.wait_ready("bob", 5))
+
+    def test_ended_watch_resumes_without_relisting(self):
+        informer = self.informer([], [make_service("ttyd-bob")])
+        informer.start()
+        self.assertTrue(informer.wait_synced(5))
+        self.pods.events.put(END)
+        self.pods.events.put({"type": "ADDED", "object": make_pod("p1", "bob", "Running", "5")})
+        self.assertTrue(informer.wait_ready("bob", 5))
+        self.assertEqual(self.pods.lists, 1)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
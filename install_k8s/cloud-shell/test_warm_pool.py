@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the cloud shell warm pool
+The Kubernetes API is replaced by an in-memory fake of the pod calls it uses
+"""
+
+import os
+import sys
+import copy
+import unittest
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest.mock import patch
+
+# Add the gok directory to Python path to import the cloud shell modules
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, 'gok'))
+
+from kubernetes import client
+
+from warm_pool import CLAIMED_AT_ANNOTATION, WarmPool
+
+
+def make_pod(name, age=60, ready=True, phase="Running", labels=None, annotations=None):
+    now = datetime.now(timezone.utc)
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            name=name,
+            labels=dict(labels if labels is not None else {"pool": "warm"}),
+            annotations=dict(annotations or {}),
+            resource_version="1",
+            creation_timestamp=now - timedelta(seconds=age),
+            deletion_timestamp=None
+        ),
+        status=SimpleNamespace(
+            phase=phase,
+            conditions=[SimpleNamespace(type="Ready", status="True" if ready else "False")]
+        )
+    )
+
+
+class FakeCoreV1Api:
+    """Pods of one namespace with label selection, optimistic patches and a patch log"""
+
+    def __init__(self, pods):
+        self.pods = {pod.metadata.name: pod for pod in pods}
+        self.patches = []
+        self.created = []
+
+    def list_namespaced_pod(self, namespace, label_selector=None):
+        key, value = label_selector.split("=")
+        # Copies, like objects decoded from an API response
+        return SimpleNamespace(items=[copy.deepcopy(p) for p in self.pods.values() if p.metadata.labels.get(key) == value])
+
+    def patch_namespaced_pod(self, name, namespace, body):
+        pod = self.pods.get(name)
+        if pod is None:
+            raise client.exceptions.ApiException(status=404)
+        metadata = body["metadata"]
+        if "resourceVersion" in metadata and metadata["resourceVersion"] != pod.metadata.resource_version:
+            raise client.exceptions.ApiException(status=409)
+        self.patches.append((name, dict(metadata.get("labels", {}))))
+        pod.metadata.labels.update(metadata.get("labels", {}))
+        pod.metadata.annotations.update(metadata.get("annotations", {}))
+        pod.metadata.resource_version += "1"
+
+    def create_namespaced_pod(self, namespace, body):
+        self.created.append(body)
+
+    def delete_namespaced_pod(self, name, namespace):
+        if self.pods.pop(name, None) is None:
+            raise client.exceptions.ApiException(status=404)
+
+
+class TestWarmPool(unittest.TestCase):
+    """Test cases for claiming and refilling the warm pool"""
+
+    def pool(self, api, **kwargs):
+        pool = WarmPool("cloudshell", 2, lambda: {"metadata": {"generateName": "ttyd-warm-"}}, **kwargs)
+        self.writes = []
+
+        def write_file(v1, name, content):
+            # The user must not be able to reach the pod before its kubeconfig exists
+            self.assertNotIn("user", api.pods[name].metadata.labels)
+            self.writes.append((name, content))
+
+        pool._write_file = write_file
+        patcher = patch.object(client, "CoreV1Api", return_value=api)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return pool
+
+    def test_claim_writes_kubeconfig_before_labelling_user(self):
+        api = FakeCoreV1Api([make_pod("new", age=10), make_pod("old", age=100), make_pod("starting", ready=False)])
+        pool = self.pool(api)
+        self.assertEqual(pool.claim("bob", "kubeconfig"), "old")
+        self.assertEqual(self.writes, [("old", "kubeconfig")])
+        self.assertEqual(api.patches, [("old", {"pool": "claimed"}), ("old", {"user": "bob"})])
+        self.assertEqual(api.pods["old"].metadata.labels, {"pool": "claimed", "user": "bob"})
+
+    def test_claim_skips_pod_taken_by_another_request(self):
+        api = FakeCoreV1Api([make_pod("a", age=100), make_pod("b", age=10)])
+        pool = self.pool(api)
+        original = api.list_namespaced_pod
+
+        def list_then_race(namespace, label_selector=None):
+            listing = original(namespace, label_selector)
+            api.pods["a"].metadata.resource_version = "2"
+            return listing
+
+        api.list_namespaced_pod = list_then_race
+        self.assertEqual(pool.claim("bob", "kubeconfig"), "b")
+
+    def test_failed_kubeconfig_write_deletes_pod_and_tries_next(self):
+        api = FakeCoreV1Api([make_pod("a", age=100), make_pod("b", age=10)])
+        pool = self.pool(api)
+
+        def write_file(v1, name, content):
+            if name == "a":
+                raise RuntimeError("exec failed")
+
+        pool._write_file = write_file
+        self.assertEqual(pool.claim("bob", "kubeconfig"), "b")
+        self.assertNotIn("a", api.pods)
+
+    def test_reconcile_replaces_broken_pods_and_refills(self):
+        api = FakeCoreV1Api([
+            make_pod("ok"),
+            make_pod("failed", phase="Failed"),
+            make_pod("stuck", age=700, ready=False),
+            make_pod("expired", age=90000)
+        ])
+        pool = self.pool(api, startup_timeout=600, max_age=86400)
+        pool.reconcile()
+        self.assertEqual(sorted(api.pods), ["ok"])
+        self.assertEqual(len(api.created), 1)
+        self.assertEqual(api.created[0]["metadata"]["labels"], {"pool": "warm"})
+
+    def test_claim_records_claim_time(self):
+        api = FakeCoreV1Api([make_pod("a")])
+        pool = self.pool(api)
+        pool.claim("bob", "kubeconfig")
+        self.assertIn(CLAIMED_AT_ANNOTATION, api.pods["a"].metadata.annotations)
+
+    def test_idle_claimed_pods_are_reaped(self):
+        long_ago = (datetime.now(timezone.utc) - timedelta(hours=10)).isoformat()
+        claimed = {CLAIMED_AT_ANNOTATION: long_ago}
+        api = FakeCoreV1Api([
+            make_pod("idle", labels={"pool": "claimed", "user": "bob"}, annotations=claimed),
+            make_pod("active", labels={"pool": "claimed", "user": "alice"}, annotations=claimed),
+            make_pod("fresh", labels={"pool": "claimed", "user": "carol"}),
+            make_pod("orphan", labels={"pool": "claimed"}, annotations=claimed),
+            make_pod("handover", labels={"pool": "claimed"})
+        ])
+        pool = self.pool(api, idle_timeout=3600, startup_timeout=600)
+        pool.touch("alice")
+        pool.reap_claimed(api)
+        self.assertEqual(sorted(api.pods), ["active", "fresh", "handover"])
+
+    def test_idle_timeout_zero_keeps_claimed_pods(self):
+        long_ago = (datetime.now(timezone.utc) - timedelta(days=3)).isoformat()
+        api = FakeCoreV1Api([make_pod("a", labels={"pool": "claimed", "user": "bob"},
+                                      annotations={CLAIMED_AT_ANNOTATION: long_ago})])
+        pool = self.pool(api, idle_timeout=0)
+        pool.reap_claimed(api)
+        self.assertEqual(sorted(api.pods), ["a"])
+
+    def test_disabled_pool_claims_nothing(self):
+        api = FakeCoreV1Api([make_pod("a")])
+        pool = self.pool(api)
+        pool.size = 0
+        self.assertIsNone(pool.claim("bob", "kubeconfig"))
+        self.assertEqual(api.patches, [])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
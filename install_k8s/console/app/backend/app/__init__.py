@@ -6,6 +6,8 @@ from flask_restx import Api
 import os
 from flask_socketio import SocketIO
 from app.socketio_handlers import register_socketio_handlers
+from app.socket_bridge import SocketBridge
+from app.http_client import ControllerClient
 
 def create_app():
     debug_mode = os.environ.get("FLASK_DEBUG", "0") == "1" or os.environ.get("FLASK_ENV") == "development"
@@ -25,6 +27,21 @@ def create_app():
 
     socketio = SocketIO(app, cors_allowed_origins="*")
     app.extensions["socketio"] = socketio
+    # One upstream connection to the controller for all batches of this process
+    app.extensions["socket_bridge"] = SocketBridge(
+        socketio,
+        app.config["TARGET_SOCKET_HOST"],
+        app.config["TARGET_SOCKET_PORT"],
+        idle_timeout=app.config["SOCKET_BRIDGE_IDLE_TIMEOUT"],
+        finished_linger=app.config["SOCKET_BRIDGE_FINISHED_LINGER"]
+    )
+    # Pooled keep-alive connections to the controller's HTTP API
+    app.extensions["controller_client"] = ControllerClient(
+        pool_size=app.config["CONTROLLER_HTTP_POOL_SIZE"],
+        connect_timeout=app.config["CONTROLLER_HTTP_CONNECT_TIMEOUT"],
+        read_timeout=app.config["CONTROLLER_HTTP_READ_TIMEOUT"],
+        retries=app.config["CONTROLLER_HTTP_RETRIES"]
+    )
 
     # Register Middleware
     app.before_request(auth_middleware)
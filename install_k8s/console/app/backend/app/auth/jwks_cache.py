@@ -0,0 +1,201 @@
+"""
+JWKS cache for OIDC token verification
+Indexes signing keys by kid, builds key objects once, refreshes them in the
+background and re-fetches on unknown kids so key rotation needs no restart
+"""
+
+import re
+import time
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import requests
+from jose import jwk
+
+logger = logging.getLogger(__name__)
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class JWKSCache:
+    """Thread-safe, self-refreshing cache of an issuer's JSON Web Key Set"""
+
+    def __init__(self,
+                 issuer: str,
+                 jwks_uri: str = None,
+                 ttl: float = 3600,
+                 min_ttl: float = 60,
+                 max_ttl: float = 86400,
+                 min_refresh_interval: float = 30,
+                 verify=True,
+                 timeout: float = 10,
+                 background: bool = True):
+        """
+        Initialize the JWKS cache and load the current keys
+
+        Args:
+            issuer: OIDC issuer URL, used to discover jwks_uri
+            jwks_uri: JWKS endpoint (discovered from the issuer if omitted)
+            ttl: Refresh interval when the response carries no cache headers
+            min_ttl: Lower bound for refresh intervals taken from cache headers
+            max_ttl: Upper bound for refresh intervals taken from cache headers
+            min_refresh_interval: Minimum seconds between fetches triggered by unknown kids
+            verify: TLS verification flag or CA bundle path passed to requests
+            timeout: HTTP timeout in seconds
+            background: Refresh keys in a daemon thread before they expire
+        """
+        self.issuer = issuer
+        self.jwks_uri = jwks_uri
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.verify = verify
+        self.timeout = timeout
+        self.background = background
+
+        self._session = requests.Session()
+        self._keys: Dict[str, object] = {}
+        self._jwks: Dict = {"keys": []}
+        self._etag = None
+        self._expires_at = 0.0
+        self._last_fetch = 0.0
+        self._version = 0
+
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+        self.refresh()
+
+    @property
+    def jwks(self) -> Dict:
+        """Raw JWKS document as last fetched"""
+        return self._jwks
+
+    @property
+    def version(self) -> int:
+        """Incremented whenever the key set changes"""
+        return self._version
+
+    def get_key(self, kid: Optional[str]):
+        """
+        Look up the verification key for a kid
+
+        Args:
+            kid: Key id from the token header
+
+        Returns:
+            jose Key object or None if the issuer does not know the kid
+        """
+        self._ensure_background()
+        if time.time() >= self._expires_at:
+            self.refresh()
+        key = self._keys.get(kid)
+        if key is None:
+            # Unknown kid usually means the issuer rotated its keys
+            self.refresh(force=True)
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Fetch the key set if it is due (single-flight across threads)
+
+        Args:
+            force: Fetch even before expiry; still rate limited by min_refresh_interval
+
+        Returns:
+            True if the key set is current after the call
+        """
+        started = time.time()
+        with self._refresh_lock:
+            # Another thread refreshed while we waited for the lock
+            if self._last_fetch >= started and self._keys:
+                return True
+            now = time.time()
+            if force:
+                if now - self._last_fetch < self.min_refresh_interval:
+                    return False
+            elif now < self._expires_at:
+                return True
+            return self._fetch()
+
+    def _fetch(self) -> bool:
+        self._last_fetch = time.time()
+        try:
+            if not self.jwks_uri:
+                oidc_conf = self._session.get(
+                    f"{self.issuer}/.well-known/openid-configuration",
+                    verify=self.verify, timeout=self.timeout
+                ).json()
+                self.jwks_uri = oidc_conf["jwks_uri"]
+
+            headers = {"If-None-Match": self._etag} if self._etag and self._keys else {}
+            response = self._session.get(self.jwks_uri, headers=headers, verify=self.verify, timeout=self.timeout)
+            if response.status_code == 304:
+                self._expires_at = time.time() + self._ttl_from_headers(response.headers)
+                return True
+            response.raise_for_status()
+
+            jwks = response.json()
+            keys = {}
+            for key_data in jwks.get("keys", []):
+                kid = key_data.get("kid")
+                if key_data.get("use", "sig") != "sig":
+                    continue
+                try:
+                    keys[kid] = jwk.construct(key_data, key_data.get("alg", "RS256"))
+                except Exception as e:
+                    logger.warning(f"Skipping unusable JWKS key {kid}: {e}")
+
+            changed = set(keys) != set(self._keys)
+            self._keys = keys
+            self._jwks = jwks
+            self._etag = response.headers.get("ETag")
+            self._expires_at = time.time() + self._ttl_from_headers(response.headers)
+            if changed:
+                self._version += 1
+                logger.info(f"Loaded {len(keys)} signing keys from {self.jwks_uri}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to fetch JWKS: {e}")
+            # Retry soon without hammering the issuer
+            self._expires_at = time.time() + self.min_refresh_interval
+            return False
+
+    def _ttl_from_headers(self, headers) -> float:
+        cache_control = headers.get("Cache-Control", "")
+        if "no-store" in cache_control or "no-cache" in cache_control:
+            return self.min_ttl
+        match = _MAX_AGE_RE.search(cache_control)
+        if match:
+            return min(max(float(match.group(1)), self.min_ttl), self.max_ttl)
+        expires = headers.get("Expires")
+        if expires:
+            try:
+                ttl = parsedate_to_datetime(expires).timestamp() - time.time()
+                return min(max(ttl, self.min_ttl), self.max_ttl)
+            except (TypeError, ValueError):
+                pass
+        return self.ttl
+
+    def _ensure_background(self):
+        # Started lazily so the thread survives forking servers
+        if not self.background or (self._thread and self._thread.is_alive()):
+            return
+        with self._thread_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._refresh_loop, name="jwks-refresh", daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            # Refresh a little before expiry so requests never wait on the fetch
+            delay = max(self._expires_at - time.time() - 5, 1)
+            time.sleep(delay)
+            with self._refresh_lock:
+                self._fetch()
@@ -2,7 +2,11 @@ from flask import request, jsonify, g, current_app, send_from_directory
 from functools import wraps
 from app.config import Config
 from app.schemas.user_schema import UserSchema
+from app.auth.jwks_cache import JWKSCache
+from app.auth.token_cache import TokenCache
+from app.auth.permissions import PermissionMatrix
 import os
+import copy
 import json
 from jose import jwt, exceptions as jose_exceptions
 import requests
@@ -14,31 +18,44 @@ PERMISSIONS = {
     'developers': ['GET']
 }
 
+permission_matrix = PermissionMatrix(PERMISSIONS)
 
-def get_jwks():
-    try:
-        # Disable SSL verification in debug mode
-        debug_mode = os.environ.get("FLASK_DEBUG", "0") == "1" or os.environ.get("FLASK_ENV") == "development"
-        verify_ssl = not debug_mode
+# Marshmallow schemas hold no per-dump state, so one instance serves every request
+user_schema = UserSchema()
 
-        oidc_conf = requests.get(f"{Config.OAUTH_ISSUER}/.well-known/openid-configuration", verify=verify_ssl).json()
-        jwks_uri = oidc_conf["jwks_uri"]
-        return requests.get(jwks_uri, verify=verify_ssl).json()
-    except Exception as e:
-        print(f"Error fetching JWKS: {e}")
-        traceback.print_exc()
-        return {"keys": []}
 
-JWKS = get_jwks()
+def create_jwks_cache():
+    # Disable SSL verification in debug mode
+    debug_mode = os.environ.get("FLASK_DEBUG", "0") == "1" or os.environ.get("FLASK_ENV") == "development"
+    verify_ssl = not debug_mode
+    return JWKSCache(Config.OAUTH_ISSUER, ttl=Config.JWKS_CACHE_TTL, verify=verify_ssl)
+
+jwks_cache = create_jwks_cache()
+
+# Claims of verified tokens are reused until exp; cleared when the signing keys rotate
+token_cache = TokenCache(
+    max_size=Config.TOKEN_CACHE_SIZE,
+    max_ttl=Config.TOKEN_CACHE_TTL,
+    version_source=lambda: jwks_cache.version
+)
+
+# Request context (serialized user, allowed methods) built once per verified token;
+# values are dicts carrying the token's exp so TokenCache bounds them the same way
+auth_context_cache = TokenCache(
+    max_size=Config.TOKEN_CACHE_SIZE,
+    max_ttl=Config.TOKEN_CACHE_TTL,
+    version_source=lambda: jwks_cache.version
+)
 
 def verify_id_token(token):
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
     try:
         unverified_header = jwt.get_unverified_header(token)
-        try:
-            key = next(k for k in JWKS["keys"] if k["kid"] == unverified_header.get("kid"))
-        except StopIteration:
+        key = jwks_cache.get_key(unverified_header.get("kid"))
+        if key is None:
             print("No matching 'kid' found in JWKS for token header.")
-            traceback.print_exc()
             return None
         try:
             payload = jwt.decode(
@@ -48,12 +65,15 @@ def verify_id_token(token):
                 audience=Config.OAUTH_CLIENT_ID,
                 issuer=Config.OAUTH_ISSUER,
             )
+            token_cache.put(token, payload)
             return payload
         except jwt.JWTError as e:
             print(f"JWT Error: {e}")
             if "at_hash" in str(e):
                 # Ignore at_hash error if you don't have access_token
                 payload = jwt.get_unverified_claims(token)
+                # at_hash is checked after the signature, so these claims are still signed
+                token_cache.put(token, payload)
                 return payload
             else:
                 raise
@@ -75,6 +95,47 @@ def verify_token(token):
         return None
 
 
+def build_auth_context(token, payload):
+    groups = payload.get("groups", [])
+    user_data = {
+        "sub": payload.get("sub"),
+        "username": payload.get("preferred_username"),
+        "email": payload.get("email"),
+        "name": payload.get("name"),
+        "groups": groups,
+        "roles": payload.get("roles", []),
+        "token": token,
+    }
+    return {
+        "exp": payload.get("exp"),
+        "user": payload,
+        "groups": groups,
+        "user_schema": user_schema.dump(user_data),
+        "methods": permission_matrix.mask_for(groups),
+    }
+
+def get_auth_context(token):
+    """Verified request context for a bearer token, or None if the token is invalid"""
+    context = auth_context_cache.get(token)
+    if context is not None:
+        return context
+    payload = verify_token(token)
+    if not payload:
+        return None
+    context = build_auth_context(token, payload)
+    auth_context_cache.put(token, context)
+    return context
+
+def apply_auth_context(context):
+    """Store the user in g; returns an error response if the method is not allowed"""
+    # The context is shared by every request with the same token; handlers get their own copies
+    g.user = copy.deepcopy(context["user"])
+    g.groups = list(context["groups"])
+    g.user_schema = copy.deepcopy(context["user_schema"])
+    if not PermissionMatrix.allows(context["methods"], request.method):
+        return jsonify({'message': 'Forbidden: insufficient permissions'}), 403
+    return None
+
 def get_dev_token():
     """Generate a dev token from demo_user.json if in debug mode and no token is provided."""
     demo_user_path = os.path.join(os.path.dirname(__file__), "../data/demo_user.json")
@@ -84,77 +145,41 @@ def get_dev_token():
         return jwt.encode(payload, "dev_secret", algorithm="HS256")
     return None
 
-def auth_middleware():
-    if request.path.startswith('/api/'):
-        auth_header = request.headers.get('Authorization', '')
-        token = None
-
-        if auth_header.startswith('Bearer '):
-            token = auth_header.split()[1]
+def bearer_token():
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        return auth_header.split()[1]
+    return None
 
-        if not token:
-            return jsonify({'message': 'Unauthorized'}), 401
+def auth_middleware():
+    # Static assets, the SPA and the API docs are served without authentication
+    if not request.path.startswith('/api/'):
+        return None
 
-        payload = verify_token(token)
+    token = bearer_token()
+    if not token:
+        return jsonify({'message': 'Unauthorized'}), 401
 
-        if not payload:
-            return jsonify({'message': 'Invalid or expired token'}), 401
+    context = get_auth_context(token)
+    if context is None:
+        return jsonify({'message': 'Invalid or expired token'}), 401
 
-        # Save user info in Flask global context
-        g.user = payload
-        g.groups = payload.get('groups', [])
-
-        # Serialize user info for this request
-        user_data = {
-            "sub": payload.get("sub"),
-            "username": payload.get("preferred_username"),
-            "email": payload.get("email"),
-            "name": payload.get("name"),
-            "groups": payload.get("groups", []),
-            "roles": payload.get("roles", []),
-            "token": token,
-        }
-        g.user_schema = UserSchema().dump(user_data)
-
-        # Check authorization
-        method = request.method
-        if not any(method in PERMISSIONS.get(group, []) for group in g.groups):
-            return jsonify({'message': 'Forbidden: insufficient permissions'}), 403
+    return apply_auth_context(context)
 
 def keycloak_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth_header = request.headers.get('Authorization', '')
-        print(f"Keycloak Auth header: {auth_header}")
-        token = None
-
-        if auth_header.startswith('Bearer '):
-            token = auth_header.split()[1]
-
+        token = bearer_token()
         if not token:
             return jsonify({'message': 'Unauthorized'}), 401
 
-        payload = verify_token(token)
-
-        if not payload:
+        context = get_auth_context(token)
+        if context is None:
             return jsonify({'message': 'Invalid or expired token'}), 401
 
-        g.user = payload
-        g.groups = payload.get('groups', [])
-
-        user_data = {
-            "sub": payload.get("sub"),
-            "username": payload.get("preferred_username"),
-            "email": payload.get("email"),
-            "name": payload.get("name"),
-            "groups": payload.get("groups", []),
-            "roles": payload.get("roles", []),
-        }
-        g.user_schema = UserSchema().dump(user_data)
-
-        method = request.method
-        if not any(method in PERMISSIONS.get(group, []) for group in g.groups):
-            return jsonify({'message': 'Forbidden: insufficient permissions'}), 403
+        error = apply_auth_context(context)
+        if error:
+            return error
 
         return f(*args, **kwargs)
     return decorated
@@ -0,0 +1,47 @@
+"""
+Compiled group permissions for the console API
+The group -> allowed HTTP methods map is turned into one bitmask per group
+at startup, and the combined mask of every distinct set of groups is
+memoized, so an authorization check is a dict lookup and a bitwise and
+"""
+
+from functools import lru_cache
+from typing import Dict, Iterable
+
+METHOD_BITS = {
+    method: 1 << bit
+    for bit, method in enumerate(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+}
+
+
+def compile_permissions(permissions: Dict[str, Iterable[str]]) -> Dict[str, int]:
+    """Bitmask of allowed methods per group; unknown method names are ignored"""
+    compiled = {}
+    for group, methods in permissions.items():
+        mask = 0
+        for method in methods:
+            mask |= METHOD_BITS.get(method.upper(), 0)
+        compiled[group] = mask
+    return compiled
+
+
+class PermissionMatrix:
+    """Allowed methods for any combination of groups"""
+
+    def __init__(self, permissions: Dict[str, Iterable[str]], cache_size: int = 1024):
+        self._groups = compile_permissions(permissions)
+        self._mask_for_set = lru_cache(maxsize=cache_size)(self._combine)
+
+    def _combine(self, groups: frozenset) -> int:
+        mask = 0
+        for group in groups:
+            mask |= self._groups.get(group, 0)
+        return mask
+
+    def mask_for(self, groups: Iterable[str]) -> int:
+        """Methods allowed to a user in all of the given groups, as a bitmask"""
+        return self._mask_for_set(frozenset(groups or ()))
+
+    @staticmethod
+    def allows(mask: int, method: str) -> bool:
+        return bool(mask & METHOD_BITS.get(method, 0))
@@ -7,4 +7,17 @@ class Config:
     KEYCLOAK_CLIENT_ID = os.environ.get('KEYCLOAK_CLIENT_ID')
     KEYCLOAK_PUBLIC_KEY = os.environ.get('KEYCLOAK_PUBLIC_KEY')  # PEM or base64 format
     OAUTH_ISSUER = os.environ.get('OAUTH_ISSUER', 'https://keycloak.gokcloud.com/realms/GokDevelopers')
-    OAUTH_CLIENT_ID = os.environ.get('OAUTH_CLIENT_ID', 'gok-developers-client')
\ No newline at end of file
+    OAUTH_CLIENT_ID = os.environ.get('OAUTH_CLIENT_ID', 'gok-developers-client')
+    JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', '3600'))
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '1024'))
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', '300'))
+    # Controller Socket.IO endpoint relayed to console clients by the shared SocketBridge
+    TARGET_SOCKET_HOST = os.environ.get('TARGET_SOCKET_HOST', 'web-controller.gok-controller.svc')
+    TARGET_SOCKET_PORT = int(os.environ.get('TARGET_SOCKET_PORT', '8080'))
+    SOCKET_BRIDGE_IDLE_TIMEOUT = float(os.environ.get('SOCKET_BRIDGE_IDLE_TIMEOUT', '300'))
+    SOCKET_BRIDGE_FINISHED_LINGER = float(os.environ.get('SOCKET_BRIDGE_FINISHED_LINGER', '30'))
+    # Keep-alive HTTP client used to submit batches to the controller
+    CONTROLLER_HTTP_POOL_SIZE = int(os.environ.get('CONTROLLER_HTTP_POOL_SIZE', '20'))
+    CONTROLLER_HTTP_CONNECT_TIMEOUT = float(os.environ.get('CONTROLLER_HTTP_CONNECT_TIMEOUT', '3'))
+    CONTROLLER_HTTP_READ_TIMEOUT = float(os.environ.get('CONTROLLER_HTTP_READ_TIMEOUT', '30'))
+    CONTROLLER_HTTP_RETRIES = int(os.environ.get('CONTROLLER_HTTP_RETRIES', '2'))
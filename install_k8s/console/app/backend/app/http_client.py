@@ -0,0 +1,71 @@
+"""
+Pooled HTTP client for calls from the console to the controller
+One keep-alive session per console process reuses TCP and TLS connections
+across command submissions, every request has connect and read timeouts so
+a slow controller cannot pin a worker, and failures that happen before the
+controller accepted a batch are retried
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError
+from urllib3.util.retry import Retry
+
+
+class ControllerClient:
+    """Thread-safe keep-alive session with timeouts and safe retries"""
+
+    def __init__(self,
+                 pool_size: int = 20,
+                 connect_timeout: float = 3,
+                 read_timeout: float = 30,
+                 retries: int = 2,
+                 backoff_factor: float = 0.2):
+        """
+        Initialize the client
+
+        Args:
+            pool_size: Keep-alive connections kept per host
+            connect_timeout: Seconds to establish a connection (TLS handshake included)
+            read_timeout: Seconds to wait for the controller's response
+            retries: Retries of connection failures and 503 responses
+            backoff_factor: Base of the exponential backoff between retries in seconds
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        # POSTs are retried only when the controller cannot have accepted the
+        # batch: the connection failed, or it answered 503 (broker unavailable,
+        # nothing published). Read timeouts are not retried to avoid duplicate batches.
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=(503,),
+            allowed_methods=None,
+            backoff_factor=backoff_factor,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """POST with the default timeouts; raises requests.RequestException on failure"""
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            return self.session.post(url, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            # With read retries disabled urllib3 reports a read timeout as exhausted retries
+            reason = e.args[0] if e.args else None
+            if isinstance(reason, MaxRetryError) and isinstance(reason.reason, ReadTimeoutError):
+                raise requests.exceptions.ReadTimeout(e, request=e.request, response=e.response)
+            raise
+
+    def close(self):
+        self.session.close()
+
+
+def get_controller_client(app) -> ControllerClient:
+    """The console process's controller client, stored on the Flask app"""
+    return app.extensions["controller_client"]
@@ -1,28 +1,38 @@
 import requests
 from flask import current_app, request, jsonify
-from app.socket_bridge import SocketBridge
+from app.http_client import get_controller_client
+from app.socket_bridge import get_socket_bridge
 
-def send_command_and_start_bridge(commands, bridges, socketio, target_api, target_host, target_port):
+def send_command_and_start_bridge(commands, target_api, priority=None):
     # Skip SSL verification in debug mode
     verify_ssl = not current_app.debug
 
-    resp = requests.post(
-        target_api,
-        json={"commands": commands},
-        headers={"Authorization": request.headers.get("Authorization")},
-        verify=verify_ssl
-    )
+    payload = {"commands": commands}
+    if priority is not None:
+        payload["priority"] = priority
+
+    try:
+        resp = get_controller_client(current_app).post(
+            target_api,
+            json=payload,
+            headers={"Authorization": request.headers.get("Authorization")},
+            verify=verify_ssl
+        )
+    except requests.exceptions.Timeout as e:
+        return None, jsonify({"error": "Target server timed out", "details": str(e)}), 504
+    except requests.exceptions.RequestException as e:
+        return None, jsonify({"error": "Target server unreachable", "details": str(e)}), 502
 
     if resp.status_code != 200:
-        return None, jsonify({"error": "Failed to send to target server", "details": resp.text}), 502
+        # Pass rejections of the request itself (auth, validation) through to the client
+        status = resp.status_code if 400 <= resp.status_code < 500 else 502
+        return None, jsonify({"error": "Failed to send to target server", "details": resp.text}), status
 
     batch_id = resp.json().get("batch_id")
     if not batch_id:
         return None, jsonify({"error": "No batch_id from target server"}), 502
 
-    # Start socket bridge for this batch_id
-    if batch_id not in bridges:
-        bridges[batch_id] = SocketBridge(socketio, target_host, target_port)
-        bridges[batch_id].start(batch_id)
+    # Relay this batch's events through the shared socket bridge
+    get_socket_bridge(current_app).watch(batch_id)
 
     return batch_id, None, None
\ No newline at end of file
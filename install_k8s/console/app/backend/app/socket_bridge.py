@@ -1,37 +1,201 @@
+"""
+Relay of controller Socket.IO events to console clients
+One upstream socketio.Client per console process joins the controller room
+of every batch that is being watched and forwards its events to the console
+room of the same name. Rooms are reference counted by the console clients
+that joined them and left upstream once nobody watches them any more, so
+sockets and threads stay flat however many batches are run
+"""
+
+import time
+import logging
 import threading
+from typing import Dict, List, Optional, Set
+
 import socketio  # pip install "python-socketio[client]"
 
+logger = logging.getLogger(__name__)
+
+# Controller events relayed to the console room of their batch_id
+RELAYED_EVENTS = ("result", "command_status", "batch_status")
+
+
+class _Room:
+    __slots__ = ("clients", "last_activity", "finished")
+
+    def __init__(self):
+        self.clients: Set[str] = set()
+        self.last_activity = time.monotonic()
+        self.finished = False
+
+
 class SocketBridge:
-    def __init__(self, socketio_ws, target_host, target_port):
-        self.socketio_ws = socketio_ws  # Flask-SocketIO instance
+    """Shared, auto-reconnecting upstream client multiplexing many batch rooms"""
+
+    def __init__(self,
+                 socketio_ws,
+                 target_host: str,
+                 target_port: int,
+                 idle_timeout: float = 300,
+                 finished_linger: float = 30,
+                 sweep_interval: float = 10,
+                 reconnect_delay_max: float = 30):
+        """
+        Initialize the bridge; nothing connects until the first room is watched
+
+        Args:
+            socketio_ws: Flask-SocketIO instance of the console
+            target_host: Controller host
+            target_port: Controller port
+            idle_timeout: Seconds a room without clients or events is kept
+            finished_linger: Seconds a finished batch's room without clients is kept
+            sweep_interval: Seconds between idle room checks
+            reconnect_delay_max: Upper bound of the reconnect backoff in seconds
+        """
+        self.socketio_ws = socketio_ws
         self.target_host = target_host
         self.target_port = target_port
-        self.sio = socketio.Client()
-        self.thread = None
+        self.idle_timeout = idle_timeout
+        self.finished_linger = finished_linger
+        self.sweep_interval = sweep_interval
+        self.reconnect_delay_max = reconnect_delay_max
 
-    def start(self, batch_id):
-        if self.thread and self.thread.is_alive():
-            return
-        self.thread = threading.Thread(target=self._run, args=(batch_id,), daemon=True)
-        self.thread.start()
+        self.sio = socketio.Client(reconnection=True, reconnection_delay_max=reconnect_delay_max)
+        self.sio.on("connect", self._on_connect)
+        self.sio.on("disconnect", self._on_disconnect)
+        for event in RELAYED_EVENTS:
+            self.sio.on(event, self._relay(event))
 
-    def _run(self, batch_id):
-        @self.sio.event
-        def connect():
-            print(f"Connected to target socket server at {self.target_host}:{self.target_port}")
-            self.sio.emit("join", {"batch_id": batch_id})
+        self._lock = threading.Lock()
+        self._rooms: Dict[str, _Room] = {}
+        self._thread = None
+        self._stopping = threading.Event()
 
-        @self.sio.on("result")
-        def on_results(data):
-            # Forward as "result" to match React client expectation
-            self.socketio_ws.emit("result", data, room=batch_id)
+    @property
+    def url(self) -> str:
+        return f"http://{self.target_host}:{self.target_port}"
 
-        try:
-            self.sio.connect(f"http://{self.target_host}:{self.target_port}")
-            self.sio.wait()
-        except Exception as e:
-            self.socketio_ws.emit("result", {"error": str(e)}, room=batch_id)
+    @property
+    def rooms(self) -> int:
+        with self._lock:
+            return len(self._rooms)
+
+    def start(self):
+        """Connect in the background; idempotent"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="socket-bridge", daemon=True)
+        self._thread.start()
 
     def stop(self):
+        self._stopping.set()
         if self.sio.connected:
-            self.sio.disconnect()
\ No newline at end of file
+            self.sio.disconnect()
+
+    def watch(self, batch_id: str):
+        """Relay a batch that was just submitted, before any console client joined it"""
+        self._join(batch_id)
+
+    def acquire(self, batch_id: str, client: str):
+        """A console client joined the room of a batch"""
+        self._join(batch_id, client)
+
+    def release(self, batch_id: str, client: str):
+        """A console client left the room of a batch"""
+        with self._lock:
+            room = self._rooms.get(batch_id)
+            if room is not None:
+                room.clients.discard(client)
+                room.last_activity = time.monotonic()
+
+    def release_client(self, client: str):
+        """A console client disconnected; drop it from every room"""
+        now = time.monotonic()
+        with self._lock:
+            for room in self._rooms.values():
+                if client in room.clients:
+                    room.clients.discard(client)
+                    room.last_activity = now
+
+    def sweep(self, now: Optional[float] = None) -> List[str]:
+        """Leave the upstream rooms nobody watches any more; returns their batch ids"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            idle = [
+                batch_id for batch_id, room in self._rooms.items()
+                if not room.clients and now - room.last_activity >= (
+                    self.finished_linger if room.finished else self.idle_timeout
+                )
+            ]
+            for batch_id in idle:
+                del self._rooms[batch_id]
+        for batch_id in idle:
+            self._emit_upstream("leave", batch_id)
+        return idle
+
+    def _join(self, batch_id: str, client: Optional[str] = None):
+        with self._lock:
+            room = self._rooms.get(batch_id)
+            new = room is None
+            if new:
+                room = self._rooms[batch_id] = _Room()
+            if client is not None:
+                room.clients.add(client)
+            room.last_activity = time.monotonic()
+        self.start()
+        if new:
+            self._emit_upstream("join", batch_id)
+
+    def _emit_upstream(self, event: str, batch_id: str):
+        if not self.sio.connected:
+            # Rooms are (re)joined on connect
+            return
+        try:
+            self.sio.emit(event, {"batch_id": batch_id})
+        except Exception as e:
+            logger.warning(f"Upstream {event} for batch {batch_id} failed: {e}")
+
+    def _relay(self, event: str):
+        def handler(data):
+            batch_id = data.get("batch_id") if isinstance(data, dict) else None
+            if not batch_id:
+                return
+            with self._lock:
+                room = self._rooms.get(batch_id)
+                if room is not None:
+                    room.last_activity = time.monotonic()
+                    if event == "batch_status":
+                        room.finished = True
+            self.socketio_ws.emit(event, data, room=batch_id)
+        return handler
+
+    def _on_connect(self):
+        logger.info(f"Connected to target socket server at {self.target_host}:{self.target_port}")
+        with self._lock:
+            batch_ids = list(self._rooms)
+        for batch_id in batch_ids:
+            self._emit_upstream("join", batch_id)
+
+    def _on_disconnect(self, *args):
+        logger.warning(f"Disconnected from target socket server at {self.target_host}:{self.target_port}")
+
+    def _run(self):
+        delay = 1
+        while not self._stopping.is_set():
+            try:
+                # Later drops are handled by the client's own reconnection
+                self.sio.connect(self.url)
+                break
+            except Exception as e:
+                logger.warning(f"Connecting to {self.url} failed: {e}. Retrying in {delay}s")
+                self.sweep()
+                self._stopping.wait(delay)
+                delay = min(delay * 2, self.reconnect_delay_max)
+        while not self._stopping.wait(self.sweep_interval):
+            self.sweep()
+
+
+def get_socket_bridge(app) -> SocketBridge:
+    """The console process's bridge, stored on the Flask app"""
+    return app.extensions["socket_bridge"]
@@ -1,14 +1,28 @@
-from flask_socketio import join_room
+from flask import request
+from flask_socketio import join_room, leave_room
 
 def register_socketio_handlers(app):
     socketio = app.extensions["socketio"]
+    bridge = app.extensions["socket_bridge"]
 
     @socketio.on("join")
     def handle_join(data):
         batch_id = data.get("batch_id")
         if batch_id:
             join_room(batch_id)
+            bridge.acquire(batch_id, request.sid)
+
+    @socketio.on("leave")
+    def handle_leave(data):
+        batch_id = data.get("batch_id")
+        if batch_id:
+            leave_room(batch_id)
+            bridge.release(batch_id, request.sid)
 
     @socketio.on("connect")
     def handle_connect():
-        print("A client connected.")
\ No newline at end of file
+        print("A client connected.")
+
+    @socketio.on("disconnect")
+    def handle_disconnect(*args):
+        bridge.release_client(request.sid)
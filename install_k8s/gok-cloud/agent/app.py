@@ -8,10 +8,26 @@ from jose import jwt
 import requests
 import sys
 import time
+import shlex
+import threading
 from functools import wraps
 # Import our Vault credential managers
-from vault_credentials import get_rabbitmq_credentials, VaultCredentialManager
+from vault_credentials import get_rabbitmq_credentials, VaultCredentialManager, RabbitMQCredentials, CredentialProvider
 from vault import get_vault_secrets_from_files, get_config_secrets, get_rabbitmq_secrets_from_files
+from batch_executor import BatchExecutor, ThreadSafeChannel, parse_group_limits
+from shell_sessions import ShellSessionPool
+from result_coalescer import ResultCoalescer
+from batch_message import CONTENT_TYPE_JSON, CommandStatus, ResultMessage, decode_batch, encode
+from command_control import (CommandRegistry, STATUS_DENIED, STATUS_ERROR, STATUS_UNAUTHORIZED, batch_record,
+                             control_routing_key, kill_process_group, parse_control_message)
+from dedupe_index import DedupeIndex
+from jwks_cache import JWKSCache
+from metrics import (COMMANDS, COMMANDS_IN_FLIGHT, CREDENTIAL_RESOLVE_SECONDS, DUPLICATE_COMMANDS,
+                     JWT_VERIFY_SECONDS, MESSAGES_ACKED,
+                     MESSAGES_CONSUMED, MESSAGES_PUBLISHED, PUBLISH_SECONDS, RECONNECTS, STREAM_LINE_SECONDS,
+                     message_kind, start_metrics_server)
+from token_cache import TokenCache
+from async_agent import AsyncAgent, aio_pika
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -92,16 +108,57 @@ OAUTH_CLIENT_ID = os.environ.get("OAUTH_CLIENT_ID", "your-client-id")
 REQUIRED_GROUP = os.environ.get("REQUIRED_GROUP", "administrators")
 RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "rabbitmq.rabbitmq")
 RESULTS_QUEUE = 'results'
+# Result routing: "queue" publishes everything to RESULTS_QUEUE, "topic" publishes to
+# RESULTS_EXCHANGE with routing key results.<user>.<batch_id> so consumers bind per batch
+RESULT_ROUTING = os.environ.get("RESULT_ROUTING", "queue")  # Options: "queue", "topic"
+RESULTS_EXCHANGE = os.environ.get("RESULTS_EXCHANGE", "gok.results")
+
+# Execution mode configuration
+AGENT_EXECUTION_MODE = os.environ.get("AGENT_EXECUTION_MODE", "pool")  # Options: "pool", "serial", "async"
+AGENT_MAX_CONCURRENT_BATCHES = int(os.environ.get("AGENT_MAX_CONCURRENT_BATCHES", os.cpu_count() or 1))
+AGENT_MAX_CONCURRENT_COMMANDS = int(os.environ.get("AGENT_MAX_CONCURRENT_COMMANDS", AGENT_MAX_CONCURRENT_BATCHES))
+AGENT_GROUP_CONCURRENCY = parse_group_limits(os.environ.get("AGENT_GROUP_CONCURRENCY", ""))
+# Batches prefetched beyond the running ones in pool mode; they start by priority and fair share per user
+AGENT_QUEUED_BATCHES = int(os.environ.get("AGENT_QUEUED_BATCHES", AGENT_MAX_CONCURRENT_BATCHES))
+# x-max-priority of the commands queue; must match the controller's COMMANDS_QUEUE_MAX_PRIORITY (0 disables)
+COMMANDS_QUEUE_MAX_PRIORITY = int(os.environ.get("COMMANDS_QUEUE_MAX_PRIORITY", "10"))
+
+# Shell mode configuration
+AGENT_SHELL_MODE = os.environ.get("AGENT_SHELL_MODE", "session")  # Options: "session", "spawn"
+AGENT_SHELL_POOL_SIZE = int(os.environ.get("AGENT_SHELL_POOL_SIZE", AGENT_MAX_CONCURRENT_COMMANDS))
+AGENT_SHELL_MAX_COMMANDS = int(os.environ.get("AGENT_SHELL_MAX_COMMANDS", "500"))
+AGENT_SHELL_MAX_AGE = float(os.environ.get("AGENT_SHELL_MAX_AGE", "3600"))
+
+# Result publishing configuration
+AGENT_RESULT_COALESCE = os.environ.get("AGENT_RESULT_COALESCE", "true").lower() == "true"
+AGENT_RESULT_MAX_LINES = int(os.environ.get("AGENT_RESULT_MAX_LINES", "200"))
+AGENT_RESULT_MAX_BYTES = int(os.environ.get("AGENT_RESULT_MAX_BYTES", "65536"))
+AGENT_RESULT_MAX_DELAY_MS = int(os.environ.get("AGENT_RESULT_MAX_DELAY_MS", "200"))
+
+# Command limits; cancel requests arrive on CONTROL_EXCHANGE with routing key control.<batch_id>
+AGENT_COMMAND_TIMEOUT = float(os.environ.get("AGENT_COMMAND_TIMEOUT", "3600"))  # Seconds, 0 disables
+AGENT_COMMAND_MAX_OUTPUT_BYTES = int(os.environ.get("AGENT_COMMAND_MAX_OUTPUT_BYTES", "67108864"))  # 0 disables
+AGENT_CANCEL_TTL = float(os.environ.get("AGENT_CANCEL_TTL", "3600"))
+CONTROL_EXCHANGE = os.environ.get("CONTROL_EXCHANGE", "gok.control")
+
+# Completed (batch_id, command_id) pairs remembered so redelivered batches do not run commands twice
+AGENT_DEDUPE_MAX_ENTRIES = int(os.environ.get("AGENT_DEDUPE_MAX_ENTRIES", "10000"))
+AGENT_DEDUPE_TTL = float(os.environ.get("AGENT_DEDUPE_TTL", "3600"))
+
+# Prometheus /metrics on a side HTTP server; 0 disables it
+AGENT_METRICS_PORT = int(os.environ.get("AGENT_METRICS_PORT", "9100"))
 
 # Vault integration mode configuration
 VAULT_INTEGRATION_MODE = os.environ.get("VAULT_INTEGRATION_MODE", "hybrid")  # Options: "agent", "api", "hybrid"
+CREDENTIAL_CACHE_TTL = int(os.environ.get("CREDENTIAL_CACHE_TTL", "300"))
+CREDENTIAL_FALLBACK_TTL = int(os.environ.get("CREDENTIAL_FALLBACK_TTL", "30"))
 
-# Get RabbitMQ credentials using hybrid Vault approach
-def get_rabbitmq_connection_params():
+# Resolve RabbitMQ credentials using hybrid Vault approach
+def resolve_rabbitmq_credentials():
     """
-    Get RabbitMQ connection parameters with hybrid Vault integration
+    Resolve RabbitMQ credentials with hybrid Vault integration
     Supports both Agent Injector (static) and Direct API (dynamic) approaches
-    Returns connection parameters for pika
+    Returns RabbitMQCredentials; called by the credential provider only when needed
     """
     try:
         logger.info(f"Using Vault integration mode: {VAULT_INTEGRATION_MODE}")
@@ -115,15 +172,14 @@ def get_rabbitmq_connection_params():
             agent_secrets = get_rabbitmq_secrets_from_files()
             if agent_secrets and agent_secrets.get('username') and agent_secrets.get('password'):
                 logger.info("Successfully retrieved RabbitMQ credentials from Vault Agent Injector")
-                return {
-                    'host': agent_secrets.get('host', RABBITMQ_HOST),
-                    'port': int(agent_secrets.get('port', 5672)),
-                    'virtual_host': agent_secrets.get('virtual_host', '/'),
-                    'credentials': pika.PlainCredentials(
-                        agent_secrets.get('username'),
-                        agent_secrets.get('password')
-                    )
-                }
+                return RabbitMQCredentials(
+                    username=agent_secrets.get('username'),
+                    password=agent_secrets.get('password'),
+                    host=agent_secrets.get('host', RABBITMQ_HOST),
+                    port=int(agent_secrets.get('port', 5672)),
+                    virtual_host=agent_secrets.get('virtual_host', '/'),
+                    source="agent-injector"
+                )
             else:
                 logger.warning("Agent Injector credentials not available or incomplete")
         
@@ -134,57 +190,84 @@ def get_rabbitmq_connection_params():
             
             if credentials_obj:
                 logger.info(f"Successfully retrieved RabbitMQ credentials from Vault API for user: {credentials_obj.username}")
-                return {
-                    'host': credentials_obj.host,
-                    'port': credentials_obj.port,
-                    'virtual_host': credentials_obj.virtual_host,
-                    'credentials': pika.PlainCredentials(
-                        credentials_obj.username, 
-                        credentials_obj.password
-                    )
-                }
+                return credentials_obj
             else:
                 logger.warning("Direct API credentials not available")
         
-        # Final fallback to environment variables
+        # Final fallback to environment variables, re-checked soon in case Vault comes back
         logger.warning("Could not retrieve credentials from any Vault method, using environment variables")
-        return {
-            'host': RABBITMQ_HOST,
-            'port': 5672,
-            'virtual_host': '/',
-            'credentials': pika.PlainCredentials(
-                os.environ.get("RABBITMQ_USER", "guest"),
-                os.environ.get("RABBITMQ_PASSWORD", "guest")
-            )
-        }
+        return RabbitMQCredentials(
+            username=os.environ.get("RABBITMQ_USER", "guest"),
+            password=os.environ.get("RABBITMQ_PASSWORD", "guest"),
+            host=RABBITMQ_HOST,
+            source="environment",
+            expires_at=time.time() + CREDENTIAL_FALLBACK_TTL
+        )
         
     except Exception as e:
         logger.error(f"Error getting RabbitMQ credentials: {e}")
         # Ultimate fallback
-        return {
-            'host': RABBITMQ_HOST,
-            'port': 5672,
-            'virtual_host': '/',
-            'credentials': pika.PlainCredentials("guest", "guest")
-        }
+        return RabbitMQCredentials(
+            username="guest",
+            password="guest",
+            host=RABBITMQ_HOST,
+            source="default",
+            expires_at=time.time() + CREDENTIAL_FALLBACK_TTL
+        )
+
+# Files written by the CSI driver, Agent Injector and secret volumes; a change triggers re-resolution
+CREDENTIAL_WATCH_PATHS = [
+    "/mnt/secrets-store",
+    os.path.join(os.environ.get("VAULT_SECRETS_PATH", "/vault/secrets/"), "rabbitmq"),
+    "/var/run/secrets/kubernetes.io/secret/rabbitmq",
+]
+
+def timed_resolve_rabbitmq_credentials():
+    with CREDENTIAL_RESOLVE_SECONDS.time():
+        return resolve_rabbitmq_credentials()
+
+credential_provider = CredentialProvider(
+    timed_resolve_rabbitmq_credentials,
+    ttl=CREDENTIAL_CACHE_TTL,
+    watch_paths=CREDENTIAL_WATCH_PATHS
+)
+
+def get_rabbitmq_connection_params(force_refresh=False):
+    """
+    Get RabbitMQ connection parameters from the process-wide credential cache
+    Returns connection parameters for pika
+    """
+    credentials_obj = credential_provider.get(force=force_refresh)
+    return {
+        'host': credentials_obj.host,
+        'port': credentials_obj.port,
+        'virtual_host': credentials_obj.virtual_host,
+        'credentials': pika.PlainCredentials(
+            credentials_obj.username,
+            credentials_obj.password
+        )
+    }
 
 session_shells = {}
 
-def get_jwks():
-    try:
-        oidc_conf = requests.get(f"{OAUTH_ISSUER}/.well-known/openid-configuration", verify=True).json()
-        jwks_uri = oidc_conf["jwks_uri"]
-        return requests.get(jwks_uri, verify=True).json()
-    except Exception as e:
-        logging.error(f"Failed to fetch JWKS: {e}")
-        return {"keys": []}
+# Signing keys are indexed by kid and refreshed on TTL or unknown kid
+JWKS_CACHE_TTL = int(os.environ.get("JWKS_CACHE_TTL", "3600"))
+jwks_cache = JWKSCache(OAUTH_ISSUER, ttl=JWKS_CACHE_TTL)
 
-JWKS = get_jwks()
+# Claims of verified tokens are reused until exp; cleared when the signing keys rotate
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "1024"))
+TOKEN_CACHE_TTL = int(os.environ.get("TOKEN_CACHE_TTL", "300"))
+token_cache = TokenCache(max_size=TOKEN_CACHE_SIZE, max_ttl=TOKEN_CACHE_TTL, version_source=lambda: jwks_cache.version)
 
 def verify_id_token(token):
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
     try:
         unverified_header = jwt.get_unverified_header(token)
-        key = next(k for k in JWKS["keys"] if k["kid"] == unverified_header["kid"])
+        key = jwks_cache.get_key(unverified_header.get("kid"))
+        if key is None:
+            raise ValueError(f"No signing key for kid {unverified_header.get('kid')}")
         try:
             payload = jwt.decode(
                 token,
@@ -193,12 +276,15 @@ def verify_id_token(token):
                 audience=OAUTH_CLIENT_ID,
                 issuer=OAUTH_ISSUER,
             )
+            token_cache.put(token, payload)
             return payload
         except jwt.JWTError as e:
             if "at_hash" in str(e):
                 # Ignore at_hash error if you don't have access_token
                 payload = jwt.get_unverified_claims(token)
                 logging.warning("Ignoring at_hash error in id_token: using unverified claims.")
+                # at_hash is checked after the signature, so these claims are still signed
+                token_cache.put(token, payload)
                 return payload
             else:
                 raise
@@ -211,7 +297,8 @@ def get_group_from_token(token):
     if token in TOKEN_GROUP_MAP:
         return TOKEN_GROUP_MAP[token]
     # Try JWT validation
-    payload = verify_id_token(token)
+    with JWT_VERIFY_SECONDS.time():
+        payload = verify_id_token(token)
     if payload:
         groups = payload.get("groups", [])
         if isinstance(groups, str):
@@ -230,72 +317,355 @@ def is_command_allowed(group, command):
     return group in GROUP_COMMANDS and cmd in GROUP_COMMANDS[group]
 
 
+def result_routing_key(user, batch_id):
+    """Topic routing key for a batch's results; dots would split values into extra words"""
+    return "results.{}.{}".format(str(user or "unknown").replace(".", "_"), str(batch_id).replace(".", "_"))
+
+# (routing key, content type) of the batches currently running
+result_routes = {}
+result_routes_lock = threading.Lock()
+
+def register_result_route(batch_id, user_info, content_type=CONTENT_TYPE_JSON):
+    routing_key = result_routing_key(user_info.get("sub"), batch_id) if RESULT_ROUTING == "topic" else RESULTS_QUEUE
+    with result_routes_lock:
+        result_routes[batch_id] = (routing_key, content_type)
+
+def release_result_route(batch_id):
+    with result_routes_lock:
+        result_routes.pop(batch_id, None)
+
+def publish_result(channel, result_msg):
+    publish_message(channel, ResultMessage.from_dict(result_msg))
+
+def publish_message(channel, message):
+    batch_id = message.batch_id
+    route = result_routes.get(batch_id)
+    if route is None:
+        route = (result_routing_key(None, batch_id) if RESULT_ROUTING == "topic" else RESULTS_QUEUE, CONTENT_TYPE_JSON)
+    routing_key, content_type = route
+    # Results go out in the format the batch's producer asked for
+    body, content_type, content_encoding = encode(message, content_type)
+    properties = pika.BasicProperties(content_type=content_type, content_encoding=content_encoding)
+    exchange = RESULTS_EXCHANGE if RESULT_ROUTING == "topic" else ''
+    kind = message_kind(message)
+
+    def publish(ch):
+        # Timed where the publish really happens (the connection thread in pool mode)
+        with PUBLISH_SECONDS.labels(kind).time():
+            ch.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+        MESSAGES_PUBLISHED.labels(kind).inc()
+
+    ThreadSafeChannel.run(channel, "basic_publish", publish)
+
+result_coalescer = None
+
+def get_result_coalescer():
+    """Create the output coalescer on first use when result coalescing is enabled"""
+    global result_coalescer
+    # max_delay needs the idle-stream flusher, which needs a thread-safe channel. Serial
+    # mode runs commands on the connection thread, so nothing could publish a quiet
+    # command's buffered line until the command ends; its lines are published unbuffered.
+    if not AGENT_RESULT_COALESCE or AGENT_EXECUTION_MODE != "pool":
+        return None
+    if result_coalescer is None:
+        result_coalescer = ResultCoalescer(
+            publish=publish_result,
+            max_lines=AGENT_RESULT_MAX_LINES,
+            max_bytes=AGENT_RESULT_MAX_BYTES,
+            max_delay=AGENT_RESULT_MAX_DELAY_MS / 1000.0,
+            background=True
+        )
+    return result_coalescer
+
 def stream_result(channel, batch_id, command_id, output):
-    result_msg = {
-        'batch_id': batch_id,
-        'command_id': command_id,
-        'output': output
-    }
-    channel.basic_publish(exchange='', routing_key=RESULTS_QUEUE, body=json.dumps(result_msg))
+    with STREAM_LINE_SECONDS.time():
+        coalescer = get_result_coalescer()
+        if coalescer is not None:
+            coalescer.add(channel, batch_id, command_id, output)
+            return
+        result_msg = {
+            'batch_id': batch_id,
+            'command_id': command_id,
+            'output': output
+        }
+        publish_result(channel, result_msg)
 
-def process_command(channel, batch_id, command, command_id, group):
-    if not is_command_allowed(group, command):
-        out = f"Group '{group}' not allowed to run '{command}'"
-        logging.warning(f"{out} (batch_id={batch_id}, command_id={command_id})")
-        stream_result(channel, batch_id, command_id, out)
-        return
+def finish_stream(batch_id, command_id):
+    """Publish any output still buffered for a finished command"""
+    coalescer = get_result_coalescer()
+    if coalescer is not None:
+        coalescer.flush(batch_id, command_id, final=True)
+
+# Environment prepared before every command, either per spawn or once per session
+SHELL_SETUP = [
+    "export MOUNT_PATH=/root",
+    "source /root/kubernetes/install_k8s/gok",
+    "source /root/kubernetes/install_k8s/util",
+]
+# Use nsenter to run commands in the host's namespaces
+NSENTER_PREFIX = "nsenter --mount=/host/proc/1/ns/mnt --uts=/host/proc/1/ns/uts --ipc=/host/proc/1/ns/ipc --net=/host/proc/1/ns/net --pid=/host/proc/1/ns/pid --"
+
+# Running commands, their limits and pending cancels
+command_registry = CommandRegistry(
+    timeout=AGENT_COMMAND_TIMEOUT,
+    max_output=AGENT_COMMAND_MAX_OUTPUT_BYTES,
+    cancel_ttl=AGENT_CANCEL_TTL
+)
+COMMANDS_IN_FLIGHT.set_function(lambda: command_registry.running)
+
+# Claimed and recently completed commands, so redeliveries replay records instead of running again
+dedupe_index = DedupeIndex(max_entries=AGENT_DEDUPE_MAX_ENTRIES, ttl=AGENT_DEDUPE_TTL)
+
+def on_control(ch, method, properties, body):
     try:
-        # Prepare environment setup before the actual command
-        setup = (
-            "export MOUNT_PATH=/root && "
-            "source /root/kubernetes/install_k8s/gok && "
-            "source /root/kubernetes/install_k8s/util && "
+        msg = parse_control_message(body)
+    except ValueError as e:
+        logging.warning(f"Ignoring control message: {e}")
+        return
+    stopped = command_registry.cancel(msg["batch_id"], msg.get("command_id"), msg.get("sub"), bool(msg.get("admin")))
+    logging.info(f"Cancel for batch {msg['batch_id']} (command_id={msg.get('command_id')}) stopped {stopped} running command(s)")
+
+shell_pool = None
+
+def get_shell_pool():
+    """Create the pre-sourced shell session pool on first use when running in session mode"""
+    global shell_pool
+    if AGENT_SHELL_MODE != "session":
+        return None
+    if shell_pool is None:
+        shell_pool = ShellSessionPool(
+            argv=shlex.split(NSENTER_PREFIX) + ["bash", "--noprofile", "--norc"],
+            setup=SHELL_SETUP,
+            size=AGENT_SHELL_POOL_SIZE,
+            max_commands=AGENT_SHELL_MAX_COMMANDS,
+            max_age=AGENT_SHELL_MAX_AGE
         )
-        # Use nsenter to run the command in the host's namespaces
-        nsenter_prefix = "nsenter --mount=/host/proc/1/ns/mnt --uts=/host/proc/1/ns/uts --ipc=/host/proc/1/ns/ipc --net=/host/proc/1/ns/net --pid=/host/proc/1/ns/pid --"
-        command_to_run = f"{nsenter_prefix} bash -c \"{setup}{command}\""
-        proc = subprocess.Popen(command_to_run, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        while True:
-            line = proc.stdout.readline()
-            if not line and proc.poll() is not None:
-                break
-            if line:
-                stream_result(channel, batch_id, command_id, line)
-        proc.wait()
-        if proc.returncode == 0:
-            logging.info(f"Command '{command_to_run}' succeeded (batch_id={batch_id}, command_id={command_id})")
+    return shell_pool
+
+def spawn_command(command, on_line, handle=None):
+    """Run a command in a fresh nsenter shell that sources the environment first"""
+    setup = "".join(f"{line} && " for line in SHELL_SETUP)
+    command_to_run = f"{NSENTER_PREFIX} bash -c \"{setup}{command}\""
+    # Own process group, so a cancel or timeout takes down everything the command started
+    proc = subprocess.Popen(command_to_run, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                            start_new_session=True)
+    if handle is not None:
+        handle.attach(lambda: kill_process_group(proc.pid))
+    for line in iter(proc.stdout.readline, ''):
+        on_line(line)
+    proc.stdout.close()
+    # Reap with wait4 to get the command's own peak RSS
+    _, wait_status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(wait_status)
+    if handle is not None:
+        handle.max_rss_kb = usage.ru_maxrss
+    return proc.returncode
+
+def spawn_argv(command):
+    """argv running a command in a fresh nsenter shell, for callers that exec without a shell"""
+    setup = "".join(f"{line} && " for line in SHELL_SETUP)
+    return shlex.split(NSENTER_PREFIX) + ["bash", "-c", f"{setup}{command}"]
+
+def session_command(pool, command, on_line, handle=None):
+    """Run a command in a pooled pre-sourced shell; a crashed session is replaced on the next checkout"""
+    with pool.session() as shell:
+        if handle is not None:
+            # Stopping a command kills its whole session, which is then discarded
+            handle.attach(shell.kill)
+        return shell.run(command, on_line)
+
+def process_command(channel, batch_id, command, command_id, group, owner=None, published_at=None):
+    """Run one command and publish its output and completion record; returns the record"""
+    status, returncode, handle = STATUS_ERROR, None, None
+    try:
+        if not is_command_allowed(group, command):
+            out = f"Group '{group}' not allowed to run '{command}'"
+            logging.warning(f"{out} (batch_id={batch_id}, command_id={command_id})")
+            stream_result(channel, batch_id, command_id, out)
+            status = STATUS_DENIED
+            return
+        handle = command_registry.start(batch_id, command_id, owner)
+        if handle.stop_reason is not None:
+            status = handle.stop_reason
+            logging.info(f"Skipping cancelled command '{command}' (batch_id={batch_id}, command_id={command_id})")
+            return
+        try:
+            def on_line(line):
+                if handle.count_output(len(line)):
+                    stream_result(channel, batch_id, command_id, line)
+            pool = get_shell_pool()
+            if pool is not None:
+                returncode = session_command(pool, command, on_line, handle)
+            else:
+                returncode = spawn_command(command, on_line, handle)
+            status = handle.status(returncode)
+            if returncode == 0:
+                logging.info(f"Command '{command}' succeeded (batch_id={batch_id}, command_id={command_id})")
+            else:
+                logging.error(f"Command '{command}' {status} with exit code {returncode} (batch_id={batch_id}, command_id={command_id})")
+        except Exception as e:
+            if handle.stop_reason is not None:
+                # The session was killed on purpose
+                status = handle.stop_reason
+                logging.warning(f"Command '{command}' stopped: {status} (batch_id={batch_id}, command_id={command_id})")
+            else:
+                out = str(e)
+                logging.error(f"Exception running '{command}' (batch_id={batch_id}, command_id={command_id}): {out}")
+                stream_result(channel, batch_id, command_id, out)
+    finally:
+        if handle is not None:
+            command_registry.finish(handle)
+        finish_stream(batch_id, command_id)
+        COMMANDS.labels(status).inc()
+        if handle is not None:
+            record = handle.record(status, returncode, published_at)
         else:
-            logging.error(f"Command '{command_to_run}' failed (batch_id={batch_id}, command_id={command_id})")
+            record = CommandStatus(batch_id, command_id, status)
+        try:
+            publish_message(channel, record)
+        except Exception as e:
+            logging.error(f"Failed to publish status (batch_id={batch_id}, command_id={command_id}): {e}")
+    return record
+
+def parse_batch_message(body, properties=None):
+    """Decode a commands queue message (JSON or compact, per content_type) into a BatchMessage"""
+    batch = decode_batch(
+        body,
+        getattr(properties, 'content_type', None),
+        getattr(properties, 'content_encoding', None)
+    )
+    # Publish time travels in a header so it works with both wire formats
+    headers = getattr(properties, 'headers', None) or {}
+    if isinstance(headers.get('published_at'), (int, float)):
+        batch.published_at = float(headers['published_at'])
+    if isinstance(getattr(properties, 'priority', None), int):
+        batch.priority = properties.priority
+    return batch
+
+def run_command(channel, batch_id, cmd, group, owner=None, published_at=None):
+    """Run a command of a batch once; a redelivered command republishes the record of its first run"""
+    try:
+        record, duplicate = dedupe_index.run_once(
+            batch_id, cmd.command_id,
+            lambda: process_command(channel, batch_id, cmd.command, cmd.command_id, group, owner, published_at),
+            timeout=0
+        )
+    except TimeoutError as e:
+        # Deliveries of a running batch are parked in on_message, so this only happens on a race
+        logging.error(f"Duplicate delivery of a running command: {e}")
+        return CommandStatus(batch_id, cmd.command_id, STATUS_ERROR)
+    if duplicate:
+        DUPLICATE_COMMANDS.inc()
+        logging.info(f"Skipping redelivered command '{cmd.command}' (batch_id={batch_id}, command_id={cmd.command_id}, status={record.status})")
+        try:
+            publish_message(channel, record)
+        except Exception as e:
+            logging.error(f"Failed to publish status (batch_id={batch_id}, command_id={cmd.command_id}): {e}")
+    return record
+
+def publish_batch_status(channel, batch, records, received_at, status=None):
+    """Publish the completion record of a batch after the records of its commands"""
+    try:
+        publish_message(channel, batch_record(batch.batch_id, records, received_at, batch.published_at, status))
+    except Exception as e:
+        logging.error(f"Failed to publish batch status (batch_id={batch.batch_id}): {e}")
+
+batch_executor = None
+
+def get_batch_executor():
+    """Create the shared worker pool on first use when running in pool mode"""
+    global batch_executor
+    if AGENT_EXECUTION_MODE != "pool":
+        return None
+    if batch_executor is None:
+        batch_executor = BatchExecutor(
+            max_batches=AGENT_MAX_CONCURRENT_BATCHES,
+            max_commands=AGENT_MAX_CONCURRENT_COMMANDS,
+            group_limits=AGENT_GROUP_CONCURRENCY
+        )
+    return batch_executor
+
+def ack_batch(channel, delivery_tag):
+    def ack(ch):
+        ch.basic_ack(delivery_tag=delivery_tag)
+        MESSAGES_ACKED.inc()
+
+    ThreadSafeChannel.run(channel, "basic_ack", ack)
+
+def redeliver_parked(ch, method, properties, body):
+    """Process a parked delivery again on its connection thread; its commands now replay their records"""
+    try:
+        ch.connection.add_callback_threadsafe(lambda: on_message(ch, method, properties, body))
     except Exception as e:
-        out = str(e)
-        logging.error(f"Exception running '{command}' (batch_id={batch_id}, command_id={command_id}): {out}")
-        stream_result(channel, batch_id, command_id, out)
+        # The connection is gone; the broker redelivers the batch after reconnecting
+        logging.warning(f"Could not resume parked delivery: {e}")
 
 def on_message(ch, method, properties, body):
+    MESSAGES_CONSUMED.inc()
+    claimed = None
     try:
-        msg = json.loads(body)
-        token = msg.get('token') or msg.get('user_info', {}).get('id_token')
-        batch_id = msg.get('batch_id', 'single')
-        commands = msg.get('commands', [])
-        # Support single command as well
-        if not commands and 'command' in msg:
-            commands = [{'command': msg['command'], 'command_id': msg.get('command_id', 'single')}]
-        group = get_group_from_token(token)
+        received_at = time.time()
+        batch = parse_batch_message(body, properties)
+        batch_id, commands = batch.batch_id, batch.commands
+        register_result_route(batch_id, batch.user_info, batch.result_format)
+        group = get_group_from_token(batch.token)
         if not group:
             logging.warning(f"Unauthorized or unknown token/group (batch_id={batch_id})")
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            publish_batch_status(ch, batch, [], received_at, STATUS_UNAUTHORIZED)
+            release_result_route(batch_id)
+            ack_batch(ch, method.delivery_tag)
+            return
+        if not dedupe_index.claim_batch(batch_id, lambda: redeliver_parked(ch, method, properties, body)):
+            # A redelivery while the first delivery still runs: leave it un-acked until that run is done
+            logging.info(f"Batch {batch_id} is still running, parking its redelivery")
+            return
+        claimed = batch_id
+        owner = batch.user_info.get("sub")
+        records = []
+        executor = get_batch_executor()
+        if executor is None:
+            try:
+                for cmd in commands:
+                    records.append(run_command(ch, batch_id, cmd, group, owner, batch.published_at))
+                publish_batch_status(ch, batch, records, received_at)
+            finally:
+                release_result_route(batch_id)
+                claimed = None
+                dedupe_index.release_batch(batch_id)
+            ack_batch(ch, method.delivery_tag)
             return
-        for cmd in commands:
-            command = cmd['command']
-            command_id = cmd.get('command_id', 'single')
-            process_command(ch, batch_id, command, command_id, group)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        # Workers publish and ack through the connection thread
+        safe_channel = ThreadSafeChannel(ch.connection, ch)
+
+        def batch_done():
+            try:
+                publish_batch_status(safe_channel, batch, records, received_at)
+                release_result_route(batch_id)
+                ack_batch(safe_channel, method.delivery_tag)
+            finally:
+                dedupe_index.release_batch(batch_id)
+
+        executor.submit(
+            batch_id,
+            group,
+            commands,
+            run_command=lambda cmd: records.append(
+                run_command(safe_channel, batch_id, cmd, group, owner, batch.published_at)
+            ),
+            on_done=batch_done,
+            owner=owner,
+            priority=batch.priority
+        )
+        # Released by batch_done from here on
+        claimed = None
     except Exception as e:
         logging.error(f"Malformed message or processing error: {str(e)}")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        if claimed is not None:
+            dedupe_index.release_batch(claimed)
+        ack_batch(ch, method.delivery_tag)
 
 def ensure_results_queue():
-    """Ensure the 'results' queue exists in RabbitMQ, create if not present."""
+    """Ensure the 'results' queue (or the results exchange in topic mode) exists in RabbitMQ."""
     def _ensure_queue():
         conn_params = get_rabbitmq_connection_params()
         connection = pika.BlockingConnection(
@@ -303,6 +673,10 @@ def ensure_results_queue():
         )
         channel = connection.channel()
         try:
+            if RESULT_ROUTING == "topic":
+                channel.exchange_declare(exchange=RESULTS_EXCHANGE, exchange_type='topic', durable=True)
+                logging.info(f"Exchange '{RESULTS_EXCHANGE}' ready for per-batch result routing.")
+                return True
             channel.queue_declare(queue=RESULTS_QUEUE, passive=True)
             logging.info(f"Queue '{RESULTS_QUEUE}' already exists.")
             return True
@@ -316,6 +690,28 @@ def ensure_results_queue():
     
     return safe_rabbitmq_operation("ensure_results_queue", _ensure_queue)
 
+def commands_queue_arguments():
+    return {"x-max-priority": COMMANDS_QUEUE_MAX_PRIORITY} if COMMANDS_QUEUE_MAX_PRIORITY > 0 else None
+
+def declare_commands_queue(connection, channel):
+    """
+    Declare the commands queue as a priority queue and return the channel to use
+
+    A queue created before priorities were enabled cannot be redeclared with
+    x-max-priority (PRECONDITION_FAILED closes the channel); it is then used
+    as it is, in FIFO order, until it is deleted and recreated
+    """
+    try:
+        channel.queue_declare(queue='commands', durable=True, arguments=commands_queue_arguments())
+        return channel
+    except pika.exceptions.ChannelClosedByBroker as e:
+        if e.reply_code != 406:
+            raise
+        logging.warning(f"Queue 'commands' exists with other arguments, consuming it without priorities: {e}")
+        channel = connection.channel()
+        channel.queue_declare(queue='commands', passive=True)
+        return channel
+
 def ensure_commands_queue():
     """Ensure the 'commands' queue exists in RabbitMQ, create if not present."""
     def _ensure_queue():
@@ -330,7 +726,7 @@ def ensure_commands_queue():
             return True
         except pika.exceptions.ChannelClosedByBroker:
             channel = connection.channel()  # Reopen channel after exception
-            channel.queue_declare(queue='commands', durable=True)
+            channel.queue_declare(queue='commands', durable=True, arguments=commands_queue_arguments())
             logging.info("Queue 'commands' created.")
             return True
         finally:
@@ -342,36 +738,70 @@ def ensure_commands_queue():
 def establish_rabbitmq_connection():
     """Establish RabbitMQ connection with retry logic"""
     conn_params = get_rabbitmq_connection_params()
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(**conn_params)
-    )
+    try:
+        connection = pika.BlockingConnection(
+            pika.ConnectionParameters(**conn_params)
+        )
+    except pika.exceptions.ProbableAuthenticationError:
+        # Cached credentials may have been rotated; re-resolve before the next attempt
+        get_rabbitmq_connection_params(force_refresh=True)
+        raise
     return connection
 
 def main():
     """Main application loop with robust error handling"""
+    connected_before = False
     while True:
         try:
             logger.info("Attempting to establish RabbitMQ connection...")
             connection = establish_rabbitmq_connection()
+            if connected_before:
+                RECONNECTS.inc()
+            connected_before = True
             channel = connection.channel()
             
             # Ensure queues exist
-            channel.queue_declare(queue='commands', durable=True)
-            channel.queue_declare(queue=RESULTS_QUEUE, durable=True)
-            channel.basic_qos(prefetch_count=1)
+            channel = declare_commands_queue(connection, channel)
+            if RESULT_ROUTING == "topic":
+                channel.exchange_declare(exchange=RESULTS_EXCHANGE, exchange_type='topic', durable=True)
+            else:
+                channel.queue_declare(queue=RESULTS_QUEUE, durable=True)
+            # Let the broker hand out as many batches as the worker pool can run
+            prefetch_count = AGENT_MAX_CONCURRENT_BATCHES + AGENT_QUEUED_BATCHES if AGENT_EXECUTION_MODE == "pool" else 1
+            channel.basic_qos(prefetch_count=prefetch_count)
             channel.basic_consume(queue='commands', on_message_callback=on_message)
+            # Every agent hears every cancel; a private queue per connection, gone when it closes
+            channel.exchange_declare(exchange=CONTROL_EXCHANGE, exchange_type='topic', durable=True)
+            control_queue = channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+            channel.queue_bind(queue=control_queue, exchange=CONTROL_EXCHANGE, routing_key=control_routing_key('*'))
+            channel.basic_consume(queue=control_queue, on_message_callback=on_control, auto_ack=True)
             
             logger.info("✅ RabbitMQ connection established successfully!")
-            logger.info("Unified agent started, waiting for commands/batches...")
+            logger.info(f"Unified agent started in {AGENT_EXECUTION_MODE} mode (prefetch={prefetch_count}), waiting for commands/batches...")
             
             # Log initial health status
             check_rabbitmq_health()
             
+            # Reconnect with the new credentials when they rotate
+            unsubscribe = credential_provider.subscribe(
+                lambda old, new: connection.add_callback_threadsafe(channel.stop_consuming)
+            )
             try:
                 channel.start_consuming()
+                logger.info("Consumer stopped after credential rotation, reconnecting...")
+                if connection and not connection.is_closed:
+                    connection.close()
+                continue
             except KeyboardInterrupt:
                 logger.info("Received keyboard interrupt, stopping gracefully...")
                 channel.stop_consuming()
+                if batch_executor:
+                    batch_executor.shutdown(wait=False)
+                if shell_pool:
+                    shell_pool.close()
+                if result_coalescer:
+                    result_coalescer.close()
+                command_registry.close()
                 connection.close()
                 break
             except pika.exceptions.ConnectionClosedByBroker:
@@ -384,6 +814,8 @@ def main():
                 if connection and not connection.is_closed:
                     connection.close()
                 continue
+            finally:
+                unsubscribe()
                 
         except pika.exceptions.ProbableAuthenticationError as e:
             logger.error(f"❌ Authentication failed: {e}")
@@ -403,6 +835,62 @@ def main():
             time.sleep(10)
             continue
 
+def run_async_agent():
+    """Run the asyncio consumer, restarting it with fresh credentials when they rotate"""
+    import asyncio
+
+    agent = AsyncAgent(
+        credentials_factory=credential_provider.get,
+        parse_batch=parse_batch_message,
+        authorize=get_group_from_token,
+        command_allowed=is_command_allowed,
+        argv_for=spawn_argv,
+        result_route=lambda batch: result_routing_key(batch.user_info.get("sub"), batch.batch_id)
+            if RESULT_ROUTING == "topic" else RESULTS_QUEUE,
+        results_queue=RESULTS_QUEUE,
+        results_exchange=RESULTS_EXCHANGE if RESULT_ROUTING == "topic" else None,
+        control_exchange=CONTROL_EXCHANGE,
+        registry=command_registry,
+        dedupe=dedupe_index,
+        commands_queue_arguments=commands_queue_arguments(),
+        max_batches=AGENT_MAX_CONCURRENT_BATCHES,
+        max_commands=AGENT_MAX_CONCURRENT_COMMANDS,
+        max_lines=AGENT_RESULT_MAX_LINES,
+        max_bytes=AGENT_RESULT_MAX_BYTES,
+        max_delay=AGENT_RESULT_MAX_DELAY_MS / 1000.0
+    )
+
+    async def supervise():
+        loop = asyncio.get_running_loop()
+        while True:
+            task = asyncio.create_task(agent.run())
+            rotated = threading.Event()
+
+            def on_rotate(old, new):
+                # Unacked batches of the old connection are redelivered to the new one
+                rotated.set()
+                loop.call_soon_threadsafe(task.cancel)
+
+            unsubscribe = credential_provider.subscribe(on_rotate)
+            try:
+                await task
+            except asyncio.CancelledError:
+                if not rotated.is_set():
+                    raise
+                RECONNECTS.inc()
+                logger.info("Async consumer stopped after credential rotation, reconnecting...")
+                continue
+            except Exception as e:
+                logger.error(f"❌ Async consumer failed: {e}")
+                logger.info("Retrying in 10 seconds...")
+                await asyncio.sleep(10)
+                RECONNECTS.inc()
+            finally:
+                unsubscribe()
+
+    logger.info(f"Unified agent started in async mode (prefetch={agent.max_batches}), waiting for commands/batches...")
+    asyncio.run(supervise())
+
 if __name__ == '__main__':
     logger.info("🚀 Starting GOK Agent...")
     
@@ -416,9 +904,27 @@ if __name__ == '__main__':
     else:
         logger.warning("⚠️ Queue setup failed, but application will continue and retry...")
     
+    try:
+        start_metrics_server(AGENT_METRICS_PORT)
+    except OSError as e:
+        logger.warning(f"⚠️ Could not start metrics server on port {AGENT_METRICS_PORT}: {e}")
+    
+    if AGENT_EXECUTION_MODE == "async" and aio_pika is None:
+        logger.warning("⚠️ aio-pika is not installed, falling back to pool mode")
+        AGENT_EXECUTION_MODE = "pool"
+    
+    # Source gok/util once up front so the first command does not pay for it
+    pool = get_shell_pool() if AGENT_EXECUTION_MODE != "async" else None
+    if pool:
+        logger.info("Pre-starting shell session...")
+        pool.warm_up(1)
+    
     # Start main loop (will retry connections automatically)
     try:
-        main()
+        if AGENT_EXECUTION_MODE == "async":
+            run_async_agent()
+        else:
+            main()
     except KeyboardInterrupt:
         logger.info("👋 Application stopped by user")
     except Exception as e:
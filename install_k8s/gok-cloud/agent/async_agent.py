@@ -0,0 +1,341 @@
+"""
+Asyncio execution mode for the GOK agent
+One event loop consumes batches with aio-pika and runs commands with
+asyncio.create_subprocess_exec, so thousands of output streams share one
+process without a thread each and AMQP heartbeats are never starved by a
+long-running command
+"""
+
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Set
+
+from batch_message import BatchMessage, CommandStatus, ResultMessage, encode
+from dedupe_index import DedupeIndex
+from fair_scheduler import AsyncFairSlots
+from metrics import COMMANDS, DUPLICATE_COMMANDS, MESSAGES_ACKED, MESSAGES_CONSUMED, MESSAGES_PUBLISHED, PUBLISH_SECONDS, message_kind
+from command_control import (CommandRegistry, STATUS_DENIED, STATUS_ERROR, STATUS_UNAUTHORIZED, batch_record,
+                             control_routing_key, kill_process_group, parse_control_message)
+
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAgent:
+    """Event-loop based consumer with the same RBAC, ordering and ack semantics as on_message"""
+
+    def __init__(self,
+                 credentials_factory: Callable,
+                 parse_batch: Callable,
+                 authorize: Callable[[str], Optional[str]],
+                 command_allowed: Callable[[str, str], bool],
+                 argv_for: Callable[[str], List[str]],
+                 result_route: Callable[[BatchMessage], str],
+                 commands_queue: str = "commands",
+                 commands_queue_arguments: Optional[Dict] = None,
+                 results_queue: str = "results",
+                 results_exchange: str = None,
+                 control_exchange: str = None,
+                 registry: CommandRegistry = None,
+                 dedupe: DedupeIndex = None,
+                 max_batches: int = 256,
+                 max_commands: int = 1024,
+                 max_lines: int = 200,
+                 max_bytes: int = 65536,
+                 max_delay: float = 0.2,
+                 heartbeat: int = 60):
+        """
+        Initialize the async agent (call run() inside an event loop)
+
+        Args:
+            credentials_factory: Returns RabbitMQCredentials; called off-loop on every connect
+            parse_batch: Decodes (body, properties) into a BatchMessage
+            authorize: Maps an id token to a group, or None if unauthorized; called off-loop
+            command_allowed: RBAC check for (group, command)
+            argv_for: Builds the argv that runs a command
+            result_route: Routing key for a batch's results
+            commands_queue: Queue to consume batches from
+            commands_queue_arguments: Arguments the commands queue is declared with (e.g. x-max-priority)
+            results_queue: Results queue declared when no exchange is used
+            results_exchange: Topic exchange for results (None publishes to the default exchange)
+            control_exchange: Topic exchange carrying cancel requests (None disables cancellation)
+            registry: Tracks running commands and enforces their limits (none by default)
+            dedupe: Claims commands so redelivered batches replay records instead of running again
+            max_batches: Batches the broker may hand out at once (prefetch)
+            max_commands: Commands running at once across all batches; waiting commands
+                start by batch priority and fair share per user
+            max_lines: Output lines coalesced into one result message
+            max_bytes: Output bytes coalesced into one result message
+            max_delay: Seconds a line may wait before its message is published
+            heartbeat: AMQP heartbeat interval in seconds
+        """
+        self.credentials_factory = credentials_factory
+        self.parse_batch = parse_batch
+        self.authorize = authorize
+        self.command_allowed = command_allowed
+        self.argv_for = argv_for
+        self.result_route = result_route
+        self.commands_queue = commands_queue
+        self.commands_queue_arguments = commands_queue_arguments
+        self.results_queue = results_queue
+        self.results_exchange = results_exchange
+        self.control_exchange = control_exchange
+        self.registry = registry or CommandRegistry()
+        self.dedupe = dedupe or DedupeIndex()
+        self.max_batches = max(1, max_batches)
+        self.max_commands = max(1, max_commands)
+        self.max_lines = max(1, max_lines)
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.heartbeat = heartbeat
+
+        self._exchange = None
+        self._command_slots = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def in_flight(self) -> int:
+        """Batches currently being executed"""
+        return len(self._tasks)
+
+    async def run(self):
+        """Consume batches until cancelled"""
+        if aio_pika is None:
+            raise RuntimeError("aio-pika is required for the async agent mode")
+        loop = asyncio.get_running_loop()
+        self._command_slots = AsyncFairSlots(self.max_commands)
+
+        credentials = await loop.run_in_executor(None, self.credentials_factory)
+        connection = await aio_pika.connect_robust(
+            host=credentials.host,
+            port=credentials.port,
+            login=credentials.username,
+            password=credentials.password,
+            virtualhost=credentials.virtual_host,
+            heartbeat=self.heartbeat
+        )
+        try:
+            channel = await connection.channel()
+            try:
+                queue = await channel.declare_queue(
+                    self.commands_queue, durable=True, arguments=self.commands_queue_arguments
+                )
+            except aio_pika.exceptions.ChannelPreconditionFailed as e:
+                # Created before priorities were enabled; use it as it is
+                logger.warning(f"Queue '{self.commands_queue}' exists with other arguments, "
+                               f"consuming it without priorities: {e}")
+                channel = await connection.channel()
+                queue = await channel.declare_queue(self.commands_queue, passive=True)
+            await channel.set_qos(prefetch_count=self.max_batches)
+            if self.results_exchange:
+                self._exchange = await channel.declare_exchange(
+                    self.results_exchange, aio_pika.ExchangeType.TOPIC, durable=True
+                )
+            else:
+                await channel.declare_queue(self.results_queue, durable=True)
+                self._exchange = channel.default_exchange
+            await queue.consume(self._on_message)
+            if self.control_exchange:
+                control = await channel.declare_exchange(
+                    self.control_exchange, aio_pika.ExchangeType.TOPIC, durable=True
+                )
+                control_queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+                await control_queue.bind(control, routing_key=control_routing_key("*"))
+                await control_queue.consume(self._on_control, no_ack=True)
+            logger.info(f"Async agent consuming '{self.commands_queue}' (prefetch={self.max_batches}, "
+                        f"max concurrent commands={self.max_commands})")
+            await asyncio.Future()
+        finally:
+            await self.shutdown()
+            await connection.close()
+
+    async def shutdown(self):
+        """Cancel running batches; their messages stay unacked and are redelivered"""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _on_message(self, message):
+        MESSAGES_CONSUMED.inc()
+        try:
+            batch = self.parse_batch(message.body, message)
+        except Exception as e:
+            logger.error(f"Malformed message or processing error: {e}")
+            await message.ack()
+            MESSAGES_ACKED.inc()
+            return
+        task = asyncio.create_task(self.run_batch(message, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _on_control(self, message):
+        try:
+            msg = parse_control_message(message.body)
+        except ValueError as e:
+            logger.warning(f"Ignoring control message: {e}")
+            return
+        self.registry.cancel(msg["batch_id"], msg.get("command_id"), msg.get("sub"), bool(msg.get("admin")))
+
+    async def run_batch(self, message, batch: BatchMessage):
+        """Run a batch's commands in order and ack the message once all of them finished"""
+        if self._command_slots is None:
+            self._command_slots = AsyncFairSlots(self.max_commands)
+        received_at = time.time()
+        try:
+            loop = asyncio.get_running_loop()
+            group = await loop.run_in_executor(None, self.authorize, batch.token)
+            if not group:
+                logger.warning(f"Unauthorized or unknown token/group (batch_id={batch.batch_id})")
+                await self._publish(batch, batch_record(batch.batch_id, [], received_at, batch.published_at,
+                                                        STATUS_UNAUTHORIZED))
+            else:
+                records = []
+                for cmd in batch.commands:
+                    records.append(await self.run_command_once(batch, cmd.command, cmd.command_id, group))
+                await self._publish(batch, batch_record(batch.batch_id, records, received_at, batch.published_at))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error processing batch {batch.batch_id}: {e}")
+        await message.ack()
+        MESSAGES_ACKED.inc()
+
+    async def run_command_once(self, batch: BatchMessage, command: str, command_id, group: str) -> CommandStatus:
+        """Run a command unless an earlier delivery of its batch already did; then republish that record"""
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = self.dedupe.claim(batch.batch_id, command_id)
+            if entry is None:
+                record = None
+                owner = batch.user_info.get("sub")
+                try:
+                    await self._command_slots.acquire(owner, batch.priority)
+                    try:
+                        record = await self.run_command(batch, command, command_id, group)
+                    finally:
+                        self._command_slots.release(owner)
+                finally:
+                    self.dedupe.complete(batch.batch_id, command_id, record)
+                COMMANDS.labels(record.status).inc()
+                return record
+            # The first run may still be going on another task; wait off-loop for its record
+            record = await loop.run_in_executor(None, entry.wait, self.registry.timeout or None)
+            if record is not None:
+                DUPLICATE_COMMANDS.inc()
+                logger.info(f"Skipping redelivered command '{command}' (batch_id={batch.batch_id}, "
+                            f"command_id={command_id}, status={record.status})")
+                await self._publish(batch, record)
+                return record
+            if not entry.done.is_set():
+                record = CommandStatus(batch.batch_id, command_id, STATUS_ERROR)
+                await self._publish(batch, record)
+                return record
+
+    async def run_command(self, batch: BatchMessage, command: str, command_id, group: str) -> CommandStatus:
+        """Run one command, streaming coalesced output; publishes and returns its completion record"""
+        if not self.command_allowed(group, command):
+            out = f"Group '{group}' not allowed to run '{command}'"
+            logger.warning(f"{out} (batch_id={batch.batch_id}, command_id={command_id})")
+            await self._publish(batch, ResultMessage(batch.batch_id, command_id, out))
+            record = CommandStatus(batch.batch_id, command_id, STATUS_DENIED)
+            await self._publish(batch, record)
+            return record
+
+        handle = self.registry.start(batch.batch_id, command_id, batch.user_info.get("sub"))
+        if handle.stop_reason is not None:
+            record = handle.record(handle.stop_reason, published_at=batch.published_at)
+            await self._publish(batch, record)
+            return record
+
+        proc = None
+        status, returncode = STATUS_ERROR, None
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *self.argv_for(command),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                start_new_session=True
+            )
+            # Cancels and the timeout watchdog kill the process group, which ends the pump
+            handle.attach(lambda: kill_process_group(proc.pid))
+            await self._pump(batch, command_id, proc.stdout, handle)
+            returncode = await proc.wait()
+            status = handle.status(returncode)
+            if returncode == 0:
+                logger.info(f"Command '{command}' succeeded (batch_id={batch.batch_id}, command_id={command_id})")
+            else:
+                logger.error(f"Command '{command}' {status} with exit code {returncode} (batch_id={batch.batch_id}, command_id={command_id})")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Exception running '{command}' (batch_id={batch.batch_id}, command_id={command_id}): {e}")
+            await self._publish(batch, ResultMessage(batch.batch_id, command_id, str(e)))
+        finally:
+            self.registry.finish(handle)
+            if proc is not None and proc.returncode is None:
+                # Cancelled mid-stream: take the whole process group down with it
+                kill_process_group(proc.pid)
+        record = handle.record(status, returncode, batch.published_at)
+        await self._publish(batch, record)
+        return record
+
+    async def _pump(self, batch: BatchMessage, command_id, reader: asyncio.StreamReader, handle=None):
+        lines, size, seq = [], 0, 0
+        while True:
+            try:
+                if lines:
+                    # Publish what we have if the command goes quiet
+                    line = await asyncio.wait_for(self._read_line(reader), self.max_delay)
+                else:
+                    line = await self._read_line(reader)
+            except asyncio.TimeoutError:
+                seq = await self._flush(batch, command_id, lines, seq)
+                lines, size = [], 0
+                continue
+            if not line:
+                break
+            if handle is not None and not handle.count_output(len(line)):
+                # Over the output limit; keep draining until the kill closes the pipe
+                continue
+            text = line.decode(errors="replace")
+            lines.append(text)
+            size += len(text)
+            if len(lines) >= self.max_lines or size >= self.max_bytes:
+                seq = await self._flush(batch, command_id, lines, seq)
+                lines, size = [], 0
+        await self._flush(batch, command_id, lines, seq)
+
+    @staticmethod
+    async def _read_line(reader: asyncio.StreamReader) -> bytes:
+        """Next line, or the buffered piece of a line longer than the stream limit; b"" at EOF"""
+        try:
+            return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            # EOF: the last line had no trailing newline
+            return e.partial
+        except asyncio.LimitOverrunError as e:
+            # The data stays buffered on overrun (readline() would discard it); the rest follows as further pieces
+            return await reader.readexactly(e.consumed)
+
+    async def _flush(self, batch: BatchMessage, command_id, lines: List[str], seq: int) -> int:
+        if not lines:
+            return seq
+        await self._publish(batch, ResultMessage(batch.batch_id, command_id, "".join(lines), seq, len(lines)))
+        return seq + 1
+
+    async def _publish(self, batch: BatchMessage, result):
+        body, content_type, content_encoding = encode(result, batch.result_format)
+        kind = message_kind(result)
+        with PUBLISH_SECONDS.labels(kind).time():
+            await self._exchange.publish(
+                aio_pika.Message(body, content_type=content_type, content_encoding=content_encoding),
+                routing_key=self.result_route(batch)
+            )
+        MESSAGES_PUBLISHED.labels(kind).inc()
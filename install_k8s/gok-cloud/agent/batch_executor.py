@@ -0,0 +1,227 @@
+"""
+Concurrent batch execution for the GOK agent
+Runs command batches on a worker pool while keeping per-batch ordering,
+global and per-group concurrency limits, and thread-safe RabbitMQ acks.
+Batches waiting for a worker are started by priority and fair share per user
+"""
+
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Dict, List, Optional
+
+from fair_scheduler import FairScheduler
+
+logger = logging.getLogger(__name__)
+
+
+def parse_group_limits(spec: Optional[str]) -> Dict[str, int]:
+    """
+    Parse a per-group concurrency spec such as "developers=2,administrators=8"
+
+    Args:
+        spec: Comma separated list of group=limit pairs
+
+    Returns:
+        Dictionary mapping group name to its maximum concurrent commands
+    """
+    limits = {}
+    if not spec:
+        return limits
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' not in item:
+            logger.warning(f"Ignoring malformed group limit entry: {item}")
+            continue
+        group, value = item.split('=', 1)
+        try:
+            limit = int(value)
+        except ValueError:
+            logger.warning(f"Ignoring non-numeric group limit for {group.strip()}: {value}")
+            continue
+        if limit > 0:
+            limits[group.strip()] = limit
+    return limits
+
+
+class ThreadSafeChannel:
+    """
+    Proxy for a pika BlockingChannel that can be used from worker threads
+
+    pika channels are not thread-safe, so every publish and ack is scheduled
+    onto the connection's I/O thread with add_callback_threadsafe.
+    """
+
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+
+    def _schedule(self, operation_name: str, callback: Callable) -> bool:
+        try:
+            self.connection.add_callback_threadsafe(callback)
+            return True
+        except Exception as e:
+            # Connection went away; the broker will redeliver unacked messages
+            logger.error(f"{operation_name} - Could not schedule on connection thread: {e}")
+            return False
+
+    def basic_publish(self, *args, **kwargs) -> bool:
+        return self._schedule("basic_publish", partial(self.channel.basic_publish, *args, **kwargs))
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False) -> bool:
+        return self._schedule("basic_ack", partial(self.channel.basic_ack, delivery_tag=delivery_tag, multiple=multiple))
+
+    def call(self, operation_name: str, operation: Callable) -> bool:
+        """Schedule operation(channel) on the connection thread, e.g. a publish with its bookkeeping"""
+        return self._schedule(operation_name, partial(operation, self.channel))
+
+    @staticmethod
+    def run(channel, operation_name: str, operation: Callable) -> bool:
+        """Run operation(channel) now, or on the connection thread if channel is a ThreadSafeChannel"""
+        if isinstance(channel, ThreadSafeChannel):
+            return channel.call(operation_name, operation)
+        operation(channel)
+        return True
+
+
+class BatchExecutor:
+    """Worker pool that executes command batches concurrently"""
+
+    def __init__(self,
+                 max_batches: int = None,
+                 max_commands: int = None,
+                 group_limits: Dict[str, int] = None):
+        """
+        Initialize the batch executor
+
+        Args:
+            max_batches: Number of batches that may run at the same time
+            max_commands: Number of commands that may run at the same time across all batches
+            group_limits: Optional per-group cap on concurrent commands
+        """
+        self.max_batches = max(1, max_batches or os.cpu_count() or 1)
+        self.max_commands = max(1, max_commands or self.max_batches)
+        self.group_limits = dict(group_limits or {})
+
+        self._pool = ThreadPoolExecutor(max_workers=self.max_batches, thread_name_prefix="gok-batch")
+        self._command_slots = threading.BoundedSemaphore(self.max_commands)
+        self._group_slots = {
+            group: threading.BoundedSemaphore(limit) for group, limit in self.group_limits.items()
+        }
+
+        # Batches sharing a batch_id (e.g. redeliveries) run one after another
+        self._lock = threading.Lock()
+        self._batch_locks: Dict[str, List] = {}
+        self._in_flight = 0
+        # Every submit queues one batch and one pool task; a task runs whichever batch is due
+        self._scheduler = FairScheduler()
+
+        logger.info(f"Batch executor started (batches={self.max_batches}, commands={self.max_commands}, "
+                    f"group_limits={self.group_limits or 'none'})")
+
+    @property
+    def in_flight(self) -> int:
+        """Number of batches submitted but not yet finished"""
+        with self._lock:
+            return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        """Number of batches submitted but not yet started"""
+        with self._lock:
+            return len(self._scheduler)
+
+    @contextmanager
+    def command_slot(self, group: str):
+        """Hold one global command slot and, if configured, one slot of the group"""
+        group_slot = self._group_slots.get(group)
+        if group_slot:
+            group_slot.acquire()
+        try:
+            with self._command_slots:
+                yield
+        finally:
+            if group_slot:
+                group_slot.release()
+
+    def _acquire_batch_lock(self, batch_id: str) -> threading.Lock:
+        with self._lock:
+            entry = self._batch_locks.get(batch_id)
+            if entry is None:
+                entry = [threading.Lock(), 0]
+                self._batch_locks[batch_id] = entry
+            entry[1] += 1
+        entry[0].acquire()
+        return entry[0]
+
+    def _release_batch_lock(self, batch_id: str):
+        with self._lock:
+            entry = self._batch_locks[batch_id]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._batch_locks[batch_id]
+
+    def submit(self,
+               batch_id: str,
+               group: str,
+               commands: List[Dict],
+               run_command: Callable[[Dict], None],
+               on_done: Callable[[], None],
+               owner: Optional[str] = None,
+               priority: int = 0):
+        """
+        Schedule a batch for execution
+
+        Args:
+            batch_id: Batch identifier, used for ordering
+            group: RBAC group the batch runs as, used for per-group limits
+            commands: Commands of the batch, executed in order
+            run_command: Called once per command from a worker thread
+            on_done: Called once after the whole batch finished (used to ack)
+            owner: User the batch runs for; waiting batches are shared fairly between users
+            priority: Waiting batches with a higher priority start first
+        """
+        with self._lock:
+            self._in_flight += 1
+            self._scheduler.push(owner, priority, (batch_id, group, commands, run_command, on_done))
+        return self._pool.submit(self._run_next)
+
+    def _run_next(self):
+        with self._lock:
+            owner, batch = self._scheduler.pop()
+        try:
+            self._run_batch(*batch)
+        finally:
+            with self._lock:
+                self._scheduler.finished(owner)
+
+    def _run_batch(self, batch_id, group, commands, run_command, on_done):
+        try:
+            self._acquire_batch_lock(batch_id)
+            try:
+                for cmd in commands:
+                    with self.command_slot(group):
+                        try:
+                            run_command(cmd)
+                        except Exception as e:
+                            command_id = cmd.get('command_id') if isinstance(cmd, dict) else getattr(cmd, 'command_id', None)
+                            logger.error(f"Unhandled error in command {command_id} (batch_id={batch_id}): {e}")
+            finally:
+                self._release_batch_lock(batch_id)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            try:
+                on_done()
+            except Exception as e:
+                logger.error(f"Batch completion callback failed (batch_id={batch_id}): {e}")
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting batches and optionally wait for running ones"""
+        self._pool.shutdown(wait=wait)
@@ -1,13 +1,220 @@
-from dataclasses import dataclass, field
-from typing import List, Optional
+"""
+Command and result messages exchanged over RabbitMQ
+JSON is the default wire format and stays readable for old consumers. The
+compact format packs the same dataclasses positionally with msgpack, so keys
+are not repeated on every output line, and deflates large outputs. The
+format of each message is carried in the AMQP content_type/content_encoding
+"""
 
-@dataclass
+import json
+import zlib
+from dataclasses import astuple, dataclass, field, fields
+from typing import Dict, List, Optional, Tuple, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_COMPACT = "application/x-gok-msgpack"
+CONTENT_ENCODING_DEFLATE = "deflate"
+
+WIRE_VERSION = 1
+COMPRESS_MIN_BYTES = 4096
+
+_KIND_BATCH = 1
+_KIND_RESULT = 2
+_KIND_STATUS = 3
+_KIND_BATCH_STATUS = 4
+
+WIRE_FORMATS = {"json": CONTENT_TYPE_JSON, "msgpack": CONTENT_TYPE_COMPACT}
+
+
+@dataclass(slots=True)
 class Command:
     command: str
-    command_id: int
+    command_id: Union[int, str]
 
-@dataclass
+
+@dataclass(slots=True)
 class BatchMessage:
     commands: List[Command]
     token: str
-    batch_id: str
\ No newline at end of file
+    batch_id: str
+    user_info: Dict = field(default_factory=dict)
+    # Content type the producer wants results in; agents that do not know it reply in JSON
+    result_format: str = CONTENT_TYPE_JSON
+    # Epoch seconds the producer published the batch; carried in a message header, not the body
+    published_at: Optional[float] = None
+    # AMQP message priority the batch was published with; also a message property
+    priority: int = 0
+
+    def to_dict(self) -> Dict:
+        msg = {
+            "commands": [{"command": c.command, "command_id": c.command_id} for c in self.commands],
+            "user_info": dict(self.user_info, id_token=self.token),
+            "batch_id": self.batch_id,
+        }
+        if self.result_format != CONTENT_TYPE_JSON:
+            msg["result_format"] = self.result_format
+        return msg
+
+    @classmethod
+    def from_dict(cls, msg: Dict) -> "BatchMessage":
+        user_info = dict(msg.get("user_info") or {})
+        token = msg.get("token") or user_info.get("id_token")
+        user_info.pop("id_token", None)
+        commands = [Command(c["command"], c.get("command_id", "single")) for c in msg.get("commands", [])]
+        # Support single command as well
+        if not commands and "command" in msg:
+            commands = [Command(msg["command"], msg.get("command_id", "single"))]
+        return cls(commands, token, msg.get("batch_id", "single"), user_info,
+                   msg.get("result_format", CONTENT_TYPE_JSON))
+
+
+@dataclass(slots=True)
+class ResultMessage:
+    batch_id: str
+    command_id: Union[int, str]
+    output: str
+    seq: Optional[int] = None
+    lines: Optional[int] = None
+
+    def to_dict(self) -> Dict:
+        msg = {"batch_id": self.batch_id, "command_id": self.command_id, "output": self.output}
+        if self.seq is not None:
+            msg["seq"] = self.seq
+        if self.lines is not None:
+            msg["lines"] = self.lines
+        return msg
+
+    @classmethod
+    def from_dict(cls, msg: Dict) -> "ResultMessage":
+        return cls(msg.get("batch_id"), msg.get("command_id"), msg.get("output", ""),
+                   msg.get("seq"), msg.get("lines"))
+
+
+@dataclass(slots=True)
+class CommandStatus:
+    """Final message of a command, sent after its last output; times are epoch seconds"""
+    batch_id: str
+    command_id: Union[int, str]
+    status: str
+    exit_code: Optional[int] = None
+    duration: Optional[float] = None
+    started_at: Optional[float] = None
+    ended_at: Optional[float] = None
+    # Seconds from publish to start, and from start until the process was running
+    queue_wait: Optional[float] = None
+    spawn_latency: Optional[float] = None
+    output_bytes: Optional[int] = None
+    output_lines: Optional[int] = None
+    max_rss_kb: Optional[int] = None
+
+    def to_dict(self) -> Dict:
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    @classmethod
+    def from_dict(cls, msg: Dict) -> "CommandStatus":
+        return cls(**{f.name: msg.get(f.name) for f in fields(cls)})
+
+
+@dataclass(slots=True)
+class BatchStatus:
+    """Final message of a batch, sent after the status of its last command"""
+    batch_id: str
+    status: str
+    commands: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    started_at: Optional[float] = None
+    ended_at: Optional[float] = None
+    queue_wait: Optional[float] = None
+
+    def to_dict(self) -> Dict:
+        return dict({f.name: getattr(self, f.name) for f in fields(self)}, type="batch_status")
+
+    @classmethod
+    def from_dict(cls, msg: Dict) -> "BatchStatus":
+        return cls(**{f.name: msg.get(f.name) for f in fields(cls)})
+
+
+def content_type_for(wire_format: str) -> str:
+    """Map a configured wire format name ("json" or "msgpack") to its content type"""
+    content_type = WIRE_FORMATS.get(wire_format, CONTENT_TYPE_JSON)
+    if content_type == CONTENT_TYPE_COMPACT and msgpack is None:
+        return CONTENT_TYPE_JSON
+    return content_type
+
+
+def _pack(message) -> list:
+    if isinstance(message, BatchMessage):
+        return [WIRE_VERSION, _KIND_BATCH, message.batch_id, message.token,
+                [[c.command, c.command_id] for c in message.commands],
+                message.user_info, message.result_format]
+    if isinstance(message, CommandStatus):
+        return [WIRE_VERSION, _KIND_STATUS, *astuple(message)]
+    if isinstance(message, BatchStatus):
+        return [WIRE_VERSION, _KIND_BATCH_STATUS, *astuple(message)]
+    return [WIRE_VERSION, _KIND_RESULT, message.batch_id, message.command_id,
+            message.output, message.seq, message.lines]
+
+
+def encode(message: Union[BatchMessage, ResultMessage, CommandStatus, BatchStatus],
+           content_type: str = CONTENT_TYPE_JSON) -> Tuple[bytes, str, Optional[str]]:
+    """
+    Serialize a message
+
+    Args:
+        message: BatchMessage, ResultMessage, CommandStatus or BatchStatus
+        content_type: Requested format; falls back to JSON if msgpack is not installed
+
+    Returns:
+        Tuple of (body, content_type, content_encoding)
+    """
+    if content_type != CONTENT_TYPE_COMPACT or msgpack is None:
+        return json.dumps(message.to_dict()).encode(), CONTENT_TYPE_JSON, None
+    body = msgpack.packb(_pack(message), use_bin_type=True)
+    if len(body) >= COMPRESS_MIN_BYTES:
+        return zlib.compress(body, 1), CONTENT_TYPE_COMPACT, CONTENT_ENCODING_DEFLATE
+    return body, CONTENT_TYPE_COMPACT, None
+
+
+def _unpack(body: bytes, content_type: Optional[str], content_encoding: Optional[str], kinds: Tuple[int, ...]):
+    if content_encoding == CONTENT_ENCODING_DEFLATE:
+        body = zlib.decompress(body)
+    if content_type != CONTENT_TYPE_COMPACT:
+        # Old producers send JSON without a content type
+        return json.loads(body)
+    if msgpack is None:
+        raise ValueError(f"Cannot decode {CONTENT_TYPE_COMPACT} without msgpack installed")
+    values = msgpack.unpackb(body, raw=False)
+    if values[0] > WIRE_VERSION or values[1] not in kinds:
+        raise ValueError(f"Unsupported message version {values[0]} or kind {values[1]}")
+    return values[1:]
+
+
+def decode_batch(body: bytes, content_type: str = None, content_encoding: str = None) -> BatchMessage:
+    values = _unpack(body, content_type, content_encoding, (_KIND_BATCH,))
+    if isinstance(values, dict):
+        return BatchMessage.from_dict(values)
+    _, batch_id, token, commands, user_info, result_format = values
+    return BatchMessage([Command(c, i) for c, i in commands], token, batch_id, user_info, result_format)
+
+
+def decode_result(body: bytes, content_type: str = None,
+                  content_encoding: str = None) -> Union[ResultMessage, CommandStatus, BatchStatus]:
+    """Decode a results queue message: command output, or the final status of a command or batch"""
+    values = _unpack(body, content_type, content_encoding, (_KIND_RESULT, _KIND_STATUS, _KIND_BATCH_STATUS))
+    if isinstance(values, dict):
+        if values.get("type") == "batch_status":
+            return BatchStatus.from_dict(values)
+        if "status" in values:
+            return CommandStatus.from_dict(values)
+        return ResultMessage.from_dict(values)
+    if values[0] == _KIND_STATUS:
+        return CommandStatus(*values[1:])
+    if values[0] == _KIND_BATCH_STATUS:
+        return BatchStatus(*values[1:])
+    return ResultMessage(*values[1:])
@@ -0,0 +1,298 @@
+"""
+Cancellation and limits for running agent commands
+Every command is registered while it runs, together with a kill callback
+that takes down its process group. A watchdog thread enforces the
+wall-clock limit, output is counted against a byte limit, and cancel
+requests from the control exchange stop matching commands. Cancels that
+arrive before a batch is picked up are remembered for a while, so queued
+batches are skipped instead of started. A finished handle becomes the
+command's completion record (timings, exit code, output size)
+"""
+
+import os
+import json
+import time
+import signal
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from batch_message import BatchStatus, CommandStatus
+from metrics import COMMAND_SPAWN_SECONDS
+
+logger = logging.getLogger(__name__)
+
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+STATUS_TIMEOUT = "timeout"
+STATUS_OUTPUT_LIMIT = "output_limit"
+STATUS_DENIED = "denied"
+STATUS_ERROR = "error"
+STATUS_UNAUTHORIZED = "unauthorized"
+
+CONTROL_ROUTING_PREFIX = "control"
+
+
+def control_routing_key(batch_id: str) -> str:
+    """Topic routing key for control messages of a batch; dots would split it into extra words"""
+    return f"{CONTROL_ROUTING_PREFIX}.{str(batch_id).replace('.', '_')}"
+
+
+def parse_control_message(body: bytes) -> Dict:
+    """
+    Decode a control message
+
+    Control messages are small JSON objects:
+    {"action": "cancel", "batch_id": ..., "command_id": ... (optional),
+     "sub": requesting user, "admin": true if the requester may cancel any batch}
+
+    Raises:
+        ValueError for malformed messages or unknown actions
+    """
+    msg = json.loads(body)
+    if not isinstance(msg, dict) or msg.get("action") != "cancel" or not msg.get("batch_id"):
+        raise ValueError(f"Unsupported control message: {msg!r}")
+    return msg
+
+
+def kill_process_group(pid: int):
+    """SIGKILL a process group started with start_new_session=True"""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class RunningCommand:
+    """A registered command; stop() records why it ended early and kills it"""
+
+    def __init__(self, batch_id: str, command_id, owner: Optional[str], timeout: float, max_output: int):
+        self.batch_id = batch_id
+        self.command_id = command_id
+        self.owner = owner
+        self.max_output = max_output
+        self.started_at = time.monotonic()
+        self.started_wall = time.time()
+        self.deadline = self.started_at + timeout if timeout else None
+        self.output_bytes = 0
+        self.output_lines = 0
+        self.spawn_latency = None
+        self.max_rss_kb = None
+        self.stop_reason = None
+        self._kill = None
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def attach(self, kill: Callable[[], None]):
+        """Set the kill callback once the process exists; kills at once if already stopped"""
+        self.spawn_latency = time.monotonic() - self.started_at
+        COMMAND_SPAWN_SECONDS.observe(self.spawn_latency)
+        with self._lock:
+            self._kill = kill
+            stopped = self.stop_reason is not None
+        if stopped:
+            kill()
+
+    def stop(self, reason: str) -> bool:
+        """Stop the command; only the first reason is kept. Returns True if this call stopped it"""
+        with self._lock:
+            if self.stop_reason is not None:
+                return False
+            self.stop_reason = reason
+            kill = self._kill
+        logger.warning(f"Stopping command (batch_id={self.batch_id}, command_id={self.command_id}): {reason}")
+        if kill is not None:
+            kill()
+        return True
+
+    def count_output(self, size: int) -> bool:
+        """Account for output; returns False once the command is stopped and output should be dropped"""
+        if self.stop_reason is not None:
+            return False
+        self.output_bytes += size
+        if self.max_output and self.output_bytes > self.max_output:
+            self.stop(STATUS_OUTPUT_LIMIT)
+            return False
+        self.output_lines += 1
+        return True
+
+    def status(self, returncode: Optional[int]) -> str:
+        if self.stop_reason is not None:
+            return self.stop_reason
+        return STATUS_SUCCEEDED if returncode == 0 else STATUS_FAILED
+
+    def record(self, status: str, exit_code: Optional[int] = None,
+               published_at: Optional[float] = None) -> CommandStatus:
+        """Completion record of the command, taken when it has finished"""
+        return CommandStatus(
+            self.batch_id, self.command_id, status, exit_code,
+            duration=round(self.duration, 3),
+            started_at=round(self.started_wall, 3),
+            ended_at=round(time.time(), 3),
+            queue_wait=round(max(0.0, self.started_wall - published_at), 3) if published_at else None,
+            spawn_latency=round(self.spawn_latency, 4) if self.spawn_latency is not None else None,
+            output_bytes=self.output_bytes,
+            output_lines=self.output_lines,
+            max_rss_kb=self.max_rss_kb
+        )
+
+
+def batch_record(batch_id: str, records: List[CommandStatus], started_at: float,
+                 published_at: Optional[float] = None, status: Optional[str] = None) -> BatchStatus:
+    """
+    Completion record of a batch from the records of its commands
+
+    Args:
+        batch_id: Batch the records belong to
+        records: CommandStatus of every command that was processed
+        started_at: Epoch seconds the agent received the batch
+        published_at: Epoch seconds the producer published the batch
+        status: Overrides the derived status (e.g. unauthorized)
+    """
+    succeeded = sum(1 for r in records if r.status == STATUS_SUCCEEDED)
+    if status is None:
+        if any(r.status == STATUS_CANCELLED for r in records):
+            status = STATUS_CANCELLED
+        else:
+            status = STATUS_SUCCEEDED if succeeded == len(records) else STATUS_FAILED
+    return BatchStatus(
+        batch_id, status,
+        commands=len(records),
+        succeeded=succeeded,
+        failed=len(records) - succeeded,
+        started_at=round(started_at, 3),
+        ended_at=round(time.time(), 3),
+        queue_wait=round(max(0.0, started_at - published_at), 3) if published_at else None
+    )
+
+
+class CommandRegistry:
+    """Thread-safe registry of running commands with a deadline watchdog"""
+
+    def __init__(self,
+                 timeout: float = 0,
+                 max_output: int = 0,
+                 cancel_ttl: float = 3600,
+                 max_cancels: int = 10000,
+                 interval: float = 1.0):
+        """
+        Initialize the registry
+
+        Args:
+            timeout: Wall-clock limit per command in seconds (0 disables)
+            max_output: Output limit per command in bytes (0 disables)
+            cancel_ttl: Seconds a cancel for a batch that is not running is remembered
+            max_cancels: Remembered cancels kept at most
+            interval: Watchdog check interval in seconds
+        """
+        self.timeout = timeout
+        self.max_output = max_output
+        self.cancel_ttl = cancel_ttl
+        self.max_cancels = max_cancels
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._running: Dict[int, RunningCommand] = {}
+        # (batch_id, command_id or None) -> (expiry, sub, admin)
+        self._cancels: "OrderedDict[Tuple, Tuple[float, Optional[str], bool]]" = OrderedDict()
+        self._watchdog = None
+        self._stopping = threading.Event()
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    def start(self, batch_id: str, command_id, owner: Optional[str] = None) -> RunningCommand:
+        """
+        Register a command about to run
+
+        The returned handle is already stopped (stop_reason set) if the batch
+        or command was cancelled before it started
+        """
+        handle = RunningCommand(batch_id, command_id, owner, self.timeout, self.max_output)
+        with self._lock:
+            cancelled = self._cancelled_locked(batch_id, command_id, owner)
+            if not cancelled:
+                self._running[id(handle)] = handle
+        if cancelled:
+            handle.stop(STATUS_CANCELLED)
+        elif handle.deadline is not None:
+            self._ensure_watchdog()
+        return handle
+
+    def finish(self, handle: RunningCommand):
+        with self._lock:
+            self._running.pop(id(handle), None)
+
+    def cancel(self, batch_id: str, command_id=None, sub: Optional[str] = None, admin: bool = False) -> int:
+        """
+        Cancel a batch (command_id None) or a single command
+
+        Args:
+            batch_id: Batch to cancel
+            command_id: Command within the batch, or None for the whole batch
+            sub: Requesting user; only commands owned by this user are stopped
+            admin: Requester may cancel commands of any user
+
+        Returns:
+            Number of running commands that were stopped
+        """
+        now = time.monotonic()
+        key = (batch_id, command_id)
+        with self._lock:
+            self._cancels[key] = (now + self.cancel_ttl, sub, admin)
+            self._cancels.move_to_end(key)
+            self._expire_cancels_locked(now)
+            matches = [
+                h for h in self._running.values()
+                if h.batch_id == batch_id and (command_id is None or h.command_id == command_id)
+                and (admin or h.owner == sub)
+            ]
+        return sum(1 for h in matches if h.stop(STATUS_CANCELLED))
+
+    def is_cancelled(self, batch_id: str, command_id=None, owner: Optional[str] = None) -> bool:
+        with self._lock:
+            return self._cancelled_locked(batch_id, command_id, owner)
+
+    def close(self):
+        self._stopping.set()
+
+    def _cancelled_locked(self, batch_id: str, command_id, owner: Optional[str]) -> bool:
+        now = time.monotonic()
+        for key in ((batch_id, None), (batch_id, command_id)):
+            entry = self._cancels.get(key)
+            if entry is None:
+                continue
+            expiry, sub, admin = entry
+            if expiry > now and (admin or sub == owner):
+                return True
+        return False
+
+    def _expire_cancels_locked(self, now: float):
+        while self._cancels:
+            key, (expiry, _, _) = next(iter(self._cancels.items()))
+            if expiry > now and len(self._cancels) <= self.max_cancels:
+                break
+            self._cancels.popitem(last=False)
+
+    def _ensure_watchdog(self):
+        with self._lock:
+            if self._watchdog is not None:
+                return
+            self._watchdog = threading.Thread(target=self._watch, name="command-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def _watch(self):
+        while not self._stopping.wait(self.interval):
+            now = time.monotonic()
+            with self._lock:
+                expired: List[RunningCommand] = [
+                    h for h in self._running.values() if h.deadline is not None and h.deadline <= now
+                ]
+            for handle in expired:
+                handle.stop(STATUS_TIMEOUT)
@@ -0,0 +1,157 @@
+"""
+Duplicate suppression for redelivered command batches
+A batch that was running when the broker connection dropped is redelivered
+to the agent after it reconnects. Every (batch_id, command_id) is claimed
+before it runs and keeps its completion record for a while afterwards, so
+a redelivered command replays its record instead of running again. A
+redelivered batch whose first delivery is still running is parked until
+that run releases the batch, so no worker blocks waiting on it
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from batch_message import CommandStatus
+
+
+class _Entry:
+    __slots__ = ("done", "record", "completed_at")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.record: Optional[CommandStatus] = None
+        self.completed_at: Optional[float] = None
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[CommandStatus]:
+        """Completion record of the first run, or None if it failed or did not finish in time"""
+        self.done.wait(timeout)
+        return self.record
+
+
+class DedupeIndex:
+    """Bounded LRU of claimed and completed commands with a TTL after completion"""
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 3600):
+        """
+        Initialize the index
+
+        Args:
+            max_entries: Completed commands remembered at most; the oldest are dropped first
+            ttl: Seconds a completed command is remembered
+        """
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, _Entry]" = OrderedDict()
+
+        # batch_id -> callbacks of deliveries parked until the running delivery releases it
+        self._batches: Dict[str, List[Callable[[], None]]] = {}
+
+        self.duplicates = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def claim(self, batch_id: str, command_id) -> Optional[_Entry]:
+        """
+        Claim a command before running it
+
+        Returns:
+            None if the caller owns the command and has to run it, otherwise
+            the entry of the earlier run (wait() on it for the record)
+        """
+        key = (batch_id, command_id)
+        with self._lock:
+            self._expire_locked(time.monotonic())
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.duplicates += 1
+                return entry
+            self._entries[key] = _Entry()
+            return None
+
+    def complete(self, batch_id: str, command_id, record: Optional[CommandStatus]):
+        """
+        Store the record of a claimed command; a None record releases the
+        claim so a later delivery runs the command again
+        """
+        key = (batch_id, command_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if record is None:
+                del self._entries[key]
+            else:
+                entry.record = record
+                entry.completed_at = time.monotonic()
+                self._entries.move_to_end(key)
+        entry.done.set()
+
+    def claim_batch(self, batch_id: str, on_released: Callable[[], None]) -> bool:
+        """
+        Claim a batch before processing a delivery of it
+
+        Returns:
+            True if the caller owns the batch and has to call release_batch()
+            when done; False if another delivery is processing it, in which
+            case on_released is called once that delivery released it
+        """
+        with self._lock:
+            parked = self._batches.get(batch_id)
+            if parked is None:
+                self._batches[batch_id] = []
+                return True
+            parked.append(on_released)
+            return False
+
+    def release_batch(self, batch_id: str):
+        """Release a claimed batch and call the callbacks of the deliveries parked on it"""
+        with self._lock:
+            parked = self._batches.pop(batch_id, None) or []
+        for on_released in parked:
+            on_released()
+
+    def run_once(self, batch_id: str, command_id, run: Callable[[], CommandStatus],
+                 timeout: Optional[float] = None) -> Tuple[CommandStatus, bool]:
+        """
+        Run a command unless it already ran
+
+        Args:
+            batch_id: Batch of the command
+            command_id: Command within the batch
+            run: Runs the command and returns its completion record
+            timeout: Seconds to wait for a duplicate that is still running (None waits forever)
+
+        Returns:
+            (record, duplicate) where duplicate is True if run was not called
+        """
+        while True:
+            entry = self.claim(batch_id, command_id)
+            if entry is None:
+                record = None
+                try:
+                    record = run()
+                finally:
+                    self.complete(batch_id, command_id, record)
+                return record, False
+            record = entry.wait(timeout)
+            if record is not None:
+                return record, True
+            if not entry.done.is_set():
+                raise TimeoutError(f"Command {command_id} of batch {batch_id} is still running")
+            # The first run failed without a record and released its claim
+
+    def _expire_locked(self, now: float):
+        # Entries still running are never dropped; they are moved behind the completed ones
+        for _ in range(len(self._entries)):
+            key, entry = next(iter(self._entries.items()))
+            if entry.completed_at is None:
+                self._entries.move_to_end(key)
+                continue
+            if len(self._entries) <= self.max_entries and now - entry.completed_at < self.ttl:
+                break
+            self._entries.popitem(last=False)
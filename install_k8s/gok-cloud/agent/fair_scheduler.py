@@ -0,0 +1,109 @@
+"""
+Fair-share scheduling for the GOK agent
+Work waiting for a local slot is handed out by priority first, then to the
+user with the fewest running items, then to the user served longest ago.
+A user who submits many long batches thereby only holds their share of
+slots, and short interactive batches of other users skip ahead of them
+"""
+
+import asyncio
+import heapq
+import itertools
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class FairScheduler:
+    """Waiting items per owner and the running count of every owner (not thread-safe)"""
+
+    def __init__(self):
+        self._waiting: Dict[Optional[str], List[Tuple[int, int, Any]]] = {}
+        self._running: Dict[Optional[str], int] = {}
+        self._last_served: Dict[Optional[str], int] = {}
+        self._seq = itertools.count()
+        self._served = itertools.count()
+
+    def __len__(self) -> int:
+        return sum(len(items) for items in self._waiting.values())
+
+    def running(self, owner: Optional[str]) -> int:
+        return self._running.get(owner, 0)
+
+    def push(self, owner: Optional[str], priority: int, item: Any):
+        """Queue an item; within an owner higher priorities go first, then arrival order"""
+        heapq.heappush(self._waiting.setdefault(owner, []), (-priority, next(self._seq), item))
+
+    def pop(self) -> Optional[Tuple[Optional[str], Any]]:
+        """
+        Take the next item and count it as running for its owner
+
+        Returns:
+            (owner, item), or None if nothing is waiting
+        """
+        if not self._waiting:
+            return None
+        owner = min(self._waiting, key=lambda o: (
+            self._waiting[o][0][0], self._running.get(o, 0), self._last_served.get(o, -1)
+        ))
+        items = self._waiting[owner]
+        _, _, item = heapq.heappop(items)
+        if not items:
+            del self._waiting[owner]
+        self.started(owner)
+        return owner, item
+
+    def started(self, owner: Optional[str]):
+        """Count one item of the owner as running (pop() does this for queued items)"""
+        self._running[owner] = self._running.get(owner, 0) + 1
+        self._last_served[owner] = next(self._served)
+
+    def finished(self, owner: Optional[str]):
+        """Count one item of the owner as done"""
+        count = self._running.get(owner, 0) - 1
+        if count > 0:
+            self._running[owner] = count
+        else:
+            self._running.pop(owner, None)
+            if owner not in self._waiting:
+                self._last_served.pop(owner, None)
+
+
+class AsyncFairSlots:
+    """asyncio counterpart of a semaphore that grants free slots through a FairScheduler"""
+
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        self._free = self.slots
+        self._scheduler = FairScheduler()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._scheduler)
+
+    async def acquire(self, owner: Optional[str], priority: int = 0):
+        if self._free > 0 and not self.waiting:
+            self._free -= 1
+            self._scheduler.started(owner)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._scheduler.push(owner, priority, waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we were cancelled; pass it on
+                self.release(owner)
+            raise
+
+    def release(self, owner: Optional[str]):
+        self._scheduler.finished(owner)
+        while True:
+            entry = self._scheduler.pop()
+            if entry is None:
+                self._free += 1
+                return
+            next_owner, waiter = entry
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+            # Cancelled while waiting
+            self._scheduler.finished(next_owner)
@@ -0,0 +1,220 @@
+"""
+In-process Kubernetes secret reader
+Reads secrets straight from the API server with the pod's service account
+token, so credential fallbacks need no kubectl or base64 subprocesses
+"""
+
+import os
+import json
+import base64
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+SERVICE_ACCOUNT_DIR = "/var/run/secrets/kubernetes.io/serviceaccount"
+
+
+class KubernetesSecretError(Exception):
+    """Raised when a secret cannot be read from the API server"""
+
+
+def decode_secret(secret: Dict) -> Dict[str, str]:
+    """Decode the base64 data of a Secret object into plain strings"""
+    return {
+        key: base64.b64decode(value).decode()
+        for key, value in (secret.get("data") or {}).items()
+    }
+
+
+class KubernetesSecretReader:
+    """Thread-safe secret reader sharing one keep-alive session to the API server"""
+
+    def __init__(self,
+                 api_server: str = None,
+                 token_path: str = f"{SERVICE_ACCOUNT_DIR}/token",
+                 ca_path: str = f"{SERVICE_ACCOUNT_DIR}/ca.crt",
+                 timeout: float = 10,
+                 watch: bool = False,
+                 watch_timeout: int = 300):
+        """
+        Initialize the secret reader
+
+        Args:
+            api_server: API server URL (defaults to the in-cluster service address)
+            token_path: Service account token file, re-read when it is rotated
+            ca_path: CA bundle for the API server certificate
+            timeout: HTTP timeout in seconds
+            watch: Keep read secrets in memory, updated by a watch on each secret
+            watch_timeout: Server-side timeout of a single watch request in seconds
+        """
+        if api_server is None:
+            host = os.getenv("KUBERNETES_SERVICE_HOST")
+            port = os.getenv("KUBERNETES_SERVICE_PORT", "443")
+            if host:
+                if ":" in host:
+                    host = f"[{host}]"
+                api_server = f"https://{host}:{port}"
+        self.api_server = api_server.rstrip("/") if api_server else None
+        self.token_path = token_path
+        self.ca_path = ca_path
+        self.timeout = timeout
+        self.watch = watch
+        self.watch_timeout = watch_timeout
+
+        self._session = requests.Session()
+        self._token = None
+        self._token_mtime = None
+        self._lock = threading.Lock()
+        self._cache: Dict[Tuple[str, str], Dict[str, str]] = {}
+        self._watches: Dict[Tuple[str, str], threading.Thread] = {}
+
+    @property
+    def available(self) -> bool:
+        """True if an API server and service account token are configured"""
+        return bool(self.api_server) and os.path.exists(self.token_path)
+
+    @property
+    def verify(self):
+        return self.ca_path if os.path.exists(self.ca_path) else True
+
+    def _headers(self) -> Dict[str, str]:
+        # Bound service account tokens are rotated by the kubelet
+        mtime = os.stat(self.token_path).st_mtime
+        with self._lock:
+            if self._token is None or mtime != self._token_mtime:
+                with open(self.token_path) as f:
+                    self._token = f.read().strip()
+                self._token_mtime = mtime
+            return {"Authorization": f"Bearer {self._token}", "Accept": "application/json"}
+
+    def get_secret(self, namespace: str, name: str) -> Dict[str, str]:
+        """
+        Read a secret and return its decoded data
+
+        Args:
+            namespace: Secret namespace
+            name: Secret name
+
+        Returns:
+            Mapping of data keys to decoded string values
+
+        Raises:
+            KubernetesSecretError if the secret cannot be read
+        """
+        key = (namespace, name)
+        if self.watch:
+            with self._lock:
+                cached = self._cache.get(key)
+            if cached is not None:
+                return dict(cached)
+
+        if not self.available:
+            raise KubernetesSecretError("Not running in a cluster with a service account token")
+
+        url = f"{self.api_server}/api/v1/namespaces/{namespace}/secrets/{name}"
+        try:
+            response = self._session.get(url, headers=self._headers(), verify=self.verify, timeout=self.timeout)
+        except (requests.RequestException, OSError) as e:
+            raise KubernetesSecretError(f"Kubernetes API request failed: {e}")
+        if response.status_code != 200:
+            raise KubernetesSecretError(
+                f"Failed to read secret {namespace}/{name}: HTTP {response.status_code}"
+            )
+
+        secret = response.json()
+        data = decode_secret(secret)
+        if self.watch:
+            with self._lock:
+                self._cache[key] = data
+            self._start_watch(key, secret.get("metadata", {}).get("resourceVersion"))
+        return dict(data)
+
+    def invalidate(self, namespace: str = None, name: str = None):
+        """Drop cached secrets so the next read goes to the API server"""
+        with self._lock:
+            if namespace is None:
+                self._cache.clear()
+            else:
+                self._cache.pop((namespace, name), None)
+
+    def _start_watch(self, key: Tuple[str, str], resource_version: Optional[str]):
+        with self._lock:
+            thread = self._watches.get(key)
+            if thread and thread.is_alive():
+                return
+            thread = threading.Thread(
+                target=self._watch_loop, args=(key, resource_version),
+                name=f"secret-watch-{key[1]}", daemon=True
+            )
+            self._watches[key] = thread
+        thread.start()
+
+    def _watch_loop(self, key: Tuple[str, str], resource_version: Optional[str]):
+        try:
+            while resource_version:
+                resource_version = self._watch_once(key, resource_version)
+        except Exception as e:
+            logger.warning(f"Watch on secret {key[0]}/{key[1]} stopped: {e}")
+        # Without a live watch the cache could go stale; fall back to direct reads
+        self.invalidate(*key)
+        logger.info(f"Watch on secret {key[0]}/{key[1]} ended, cache dropped")
+
+    def _watch_once(self, key: Tuple[str, str], resource_version: str) -> Optional[str]:
+        """
+        Run one watch request and apply its events to the cache
+
+        Returns:
+            The resourceVersion to resume from, or None if the watch must be re-established
+        """
+        namespace, name = key
+        params = {
+            "watch": "1",
+            "fieldSelector": f"metadata.name={name}",
+            "resourceVersion": resource_version,
+            "allowWatchBookmarks": "true",
+            "timeoutSeconds": str(self.watch_timeout),
+        }
+        with self._session.get(
+            f"{self.api_server}/api/v1/namespaces/{namespace}/secrets",
+            params=params, headers=self._headers(), verify=self.verify,
+            timeout=(self.timeout, self.watch_timeout + self.timeout), stream=True
+        ) as response:
+            if response.status_code != 200:
+                return None
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                event_type = event.get("type")
+                obj = event.get("object") or {}
+                if event_type == "ERROR":
+                    # Typically 410 Gone: our resourceVersion is too old
+                    return None
+                resource_version = obj.get("metadata", {}).get("resourceVersion", resource_version)
+                if event_type in ("ADDED", "MODIFIED"):
+                    with self._lock:
+                        self._cache[key] = decode_secret(obj)
+                    logger.info(f"Secret {namespace}/{name} updated")
+                elif event_type == "DELETED":
+                    return None
+        return resource_version
+
+
+_secret_reader = None
+_secret_reader_lock = threading.Lock()
+
+
+def get_secret_reader() -> KubernetesSecretReader:
+    """Process-wide secret reader configured from the environment"""
+    global _secret_reader
+    with _secret_reader_lock:
+        if _secret_reader is None:
+            _secret_reader = KubernetesSecretReader(
+                watch=os.getenv("K8S_SECRET_WATCH", "false").lower() == "true",
+                timeout=float(os.getenv("K8S_API_TIMEOUT", "10"))
+            )
+        return _secret_reader
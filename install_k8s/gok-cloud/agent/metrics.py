@@ -0,0 +1,98 @@
+"""
+Prometheus metrics for the GOK agent
+The agent has no web framework, so /metrics is served by the small HTTP
+server of prometheus_client on its own port. Without prometheus_client
+installed every metric is a no-op
+"""
+
+import logging
+from contextlib import contextmanager
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+except ImportError:
+    Counter = Gauge = Histogram = start_http_server = None
+
+logger = logging.getLogger(__name__)
+
+# Command timings range from a fork to long installs; line and publish latencies are sub-millisecond
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+SLOW_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_function(self, f):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    @contextmanager
+    def time(self):
+        yield
+
+
+def _metric(cls, *args, **kwargs):
+    return cls(*args, **kwargs) if cls is not None else _NoopMetric()
+
+
+JWT_VERIFY_SECONDS = _metric(
+    Histogram, "gok_agent_jwt_verify_seconds", "Time to verify a batch id token, cache hits included",
+    buckets=FAST_BUCKETS)
+CREDENTIAL_RESOLVE_SECONDS = _metric(
+    Histogram, "gok_agent_credential_resolve_seconds", "Time to resolve RabbitMQ credentials from Vault or fallbacks",
+    buckets=SLOW_BUCKETS)
+PUBLISH_SECONDS = _metric(
+    Histogram, "gok_agent_publish_seconds", "Time to publish a result message", ["kind"],
+    buckets=FAST_BUCKETS)
+COMMAND_SPAWN_SECONDS = _metric(
+    Histogram, "gok_agent_command_spawn_seconds", "Time from command start until its process or shell session is ready",
+    buckets=SLOW_BUCKETS)
+STREAM_LINE_SECONDS = _metric(
+    Histogram, "gok_agent_stream_line_seconds", "Time to hand one output line to the coalescer or broker",
+    buckets=FAST_BUCKETS)
+
+MESSAGES_CONSUMED = _metric(Counter, "gok_agent_messages_consumed_total", "Batches received from the commands queue")
+MESSAGES_PUBLISHED = _metric(Counter, "gok_agent_messages_published_total", "Result messages published", ["kind"])
+MESSAGES_ACKED = _metric(Counter, "gok_agent_messages_acked_total", "Batches acknowledged")
+COMMANDS = _metric(Counter, "gok_agent_commands_total", "Finished commands", ["status"])
+RECONNECTS = _metric(Counter, "gok_agent_reconnects_total", "RabbitMQ consumer reconnects")
+DUPLICATE_COMMANDS = _metric(Counter, "gok_agent_duplicate_commands_total",
+                             "Redelivered commands that replayed their record instead of running again")
+
+COMMANDS_IN_FLIGHT = _metric(Gauge, "gok_agent_commands_in_flight", "Commands currently running")
+
+
+def message_kind(message) -> str:
+    """Label value for a published message: output, command_status or batch_status"""
+    name = type(message).__name__
+    return {"CommandStatus": "command_status", "BatchStatus": "batch_status"}.get(name, "output")
+
+
+def start_metrics_server(port: int, addr: str = "0.0.0.0") -> bool:
+    """
+    Serve /metrics on a side HTTP server
+
+    Returns:
+        True if the server was started
+    """
+    if not port:
+        return False
+    if start_http_server is None:
+        logger.warning("prometheus_client is not installed, metrics are disabled")
+        return False
+    start_http_server(port, addr=addr)
+    logger.info(f"Serving metrics on {addr}:{port}/metrics")
+    return True
@@ -0,0 +1,140 @@
+"""
+Output coalescing for GOK agent results
+Buffers command output per (batch_id, command_id) and publishes it in chunks
+with per-stream sequence numbers instead of one message per line
+"""
+
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Stream:
+    """Buffered output of one command"""
+
+    __slots__ = ('target', 'lines', 'size', 'first_at', 'seq')
+
+    def __init__(self, target):
+        self.target = target
+        self.lines = []
+        self.size = 0
+        self.first_at = None
+        self.seq = 0
+
+
+class ResultCoalescer:
+    """Coalesces output lines into fewer, larger result messages"""
+
+    def __init__(self,
+                 publish: Callable[[Any, Dict], None],
+                 max_lines: int = 200,
+                 max_bytes: int = 64 * 1024,
+                 max_delay: float = 0.2,
+                 background: bool = False):
+        """
+        Initialize the coalescer
+
+        Args:
+            publish: Called with (target, message) for every chunk
+            max_lines: Flush a stream once it buffered this many lines
+            max_bytes: Flush a stream once it buffered this many characters
+            max_delay: Upper bound in seconds a line may wait before it is published
+            background: Run a flusher thread that enforces max_delay for idle
+                streams; only enable this when publish is thread-safe
+        """
+        self.publish = publish
+        self.max_lines = max(1, max_lines)
+        self.max_bytes = max(1, max_bytes)
+        self.max_delay = max(0.0, max_delay)
+
+        self._streams: Dict[Tuple[str, Any], _Stream] = {}
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._flusher = None
+        if background and self.max_delay > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="gok-result-flusher", daemon=True)
+            self._flusher.start()
+
+    def add(self, target, batch_id: str, command_id, output: str):
+        """Buffer one piece of output and flush the stream if a threshold is reached"""
+        key = (batch_id, command_id)
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None:
+                stream = _Stream(target)
+                self._streams[key] = stream
+            stream.target = target
+            if not stream.lines:
+                stream.first_at = time.monotonic()
+            stream.lines.append(output)
+            stream.size += len(output)
+            if (len(stream.lines) >= self.max_lines
+                    or stream.size >= self.max_bytes
+                    or time.monotonic() - stream.first_at >= self.max_delay):
+                self._flush_stream(key, stream)
+
+    def _flush_stream(self, key, stream: _Stream):
+        if not stream.lines:
+            return
+        batch_id, command_id = key
+        message = {
+            'batch_id': batch_id,
+            'command_id': command_id,
+            'output': ''.join(stream.lines),
+            'seq': stream.seq,
+            'lines': len(stream.lines)
+        }
+        stream.seq += 1
+        stream.lines = []
+        stream.size = 0
+        stream.first_at = None
+        try:
+            self.publish(stream.target, message)
+        except Exception as e:
+            logger.error(f"Failed to publish coalesced output (batch_id={batch_id}, command_id={command_id}): {e}")
+
+    def flush(self, batch_id: str, command_id, final: bool = False):
+        """
+        Publish whatever is buffered for a stream
+
+        Args:
+            batch_id: Batch of the stream
+            command_id: Command of the stream
+            final: Forget the stream afterwards (command finished)
+        """
+        key = (batch_id, command_id)
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None:
+                return
+            self._flush_stream(key, stream)
+            if final:
+                del self._streams[key]
+
+    def flush_expired(self):
+        """Publish every stream whose oldest line waited longer than max_delay"""
+        now = time.monotonic()
+        with self._lock:
+            for key, stream in list(self._streams.items()):
+                if stream.lines and now - stream.first_at >= self.max_delay:
+                    self._flush_stream(key, stream)
+
+    def flush_all(self):
+        with self._lock:
+            for key, stream in list(self._streams.items()):
+                self._flush_stream(key, stream)
+
+    def _flush_loop(self):
+        interval = max(self.max_delay / 2, 0.01)
+        while not self._stop.wait(interval):
+            self.flush_expired()
+
+    def close(self):
+        """Stop the flusher thread and publish remaining output"""
+        self._stop.set()
+        if self._flusher:
+            self._flusher.join(timeout=1)
+        self.flush_all()
@@ -0,0 +1,234 @@
+"""
+Persistent host shell sessions for the GOK agent
+Keeps a pool of long-lived bash processes that have already sourced the gok
+environment, and runs commands in them using framed output delimiters
+"""
+
+import os
+import time
+import signal
+import uuid
+import queue
+import shlex
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ShellSessionError(Exception):
+    """Raised when a shell session dies or cannot be started"""
+
+
+class ShellSession:
+    """A single long-lived bash process with the gok environment pre-sourced"""
+
+    def __init__(self,
+                 argv: List[str],
+                 setup: List[str] = None,
+                 max_commands: int = 500,
+                 max_age: float = 3600):
+        """
+        Initialize a shell session (the process is started lazily)
+
+        Args:
+            argv: Command line that starts an interactive-free bash
+            setup: Shell lines run once when the session starts
+            max_commands: Recycle the session after this many commands
+            max_age: Recycle the session after this many seconds
+        """
+        self.argv = argv
+        self.setup = setup or []
+        self.max_commands = max_commands
+        self.max_age = max_age
+
+        self.proc = None
+        self.started_at = None
+        self.commands_run = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    @property
+    def expired(self) -> bool:
+        """True when the session should be recycled instead of reused"""
+        if not self.alive:
+            return True
+        if self.max_commands and self.commands_run >= self.max_commands:
+            return True
+        return bool(self.max_age) and time.monotonic() - self.started_at >= self.max_age
+
+    def start(self):
+        """Start bash, run the setup lines and wait until the shell is ready"""
+        self.proc = subprocess.Popen(
+            self.argv,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            start_new_session=True
+        )
+        self.started_at = time.monotonic()
+        self.commands_run = 0
+
+        marker = f"__GOK_READY_{uuid.uuid4().hex}__"
+        script = "".join(f"{line}\n" for line in self.setup)
+        self._write(f"{script}printf '%s\\n' '{marker}'\n")
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                self.close()
+                raise ShellSessionError("Shell exited while sourcing the environment")
+            if marker in line:
+                break
+            logger.debug(f"Shell setup output: {line.rstrip()}")
+        logger.info(f"Shell session started (pid={self.proc.pid})")
+
+    def _write(self, data: str):
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            self.close()
+            raise ShellSessionError(f"Shell session is not writable: {e}")
+
+    def run(self, command: str, on_line: Callable[[str], None]) -> int:
+        """
+        Run a command and stream its output line by line
+
+        The command runs in a subshell so `exit`, `cd` or `set -e` cannot
+        leak into the session, and with stdin detached from the control pipe.
+
+        Args:
+            command: Shell command to run
+            on_line: Called with every output line
+
+        Returns:
+            Exit code of the command
+        """
+        if not self.alive:
+            raise ShellSessionError("Shell session is not running")
+
+        marker = f"__GOK_END_{uuid.uuid4().hex}__"
+        self.commands_run += 1
+        self._write(
+            f"( eval {shlex.quote(command)} ) </dev/null 2>&1\n"
+            f"printf '%s %d\\n' '{marker}' $?\n"
+        )
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                self.close()
+                raise ShellSessionError("Shell session exited while running a command")
+            index = line.find(marker)
+            if index == -1:
+                on_line(line)
+                continue
+            # Output without a trailing newline shares the line with the marker
+            if index > 0:
+                on_line(line[:index])
+            try:
+                return int(line[index + len(marker):].strip())
+            except ValueError:
+                return -1
+
+    def kill(self):
+        """Kill the shell and every process it started; a running command sees the session exit"""
+        proc = self.proc
+        if proc is None:
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def close(self):
+        """Terminate the shell process"""
+        if self.proc is None:
+            return
+        try:
+            if self.proc.poll() is None:
+                self.proc.stdin.close()
+                try:
+                    self.proc.wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    self.proc.kill()
+                    self.proc.wait()
+        except Exception as e:
+            logger.warning(f"Error closing shell session: {e}")
+        finally:
+            self.proc = None
+
+
+class ShellSessionPool:
+    """Bounded pool of pre-sourced shell sessions"""
+
+    def __init__(self,
+                 argv: List[str],
+                 setup: List[str] = None,
+                 size: int = None,
+                 max_commands: int = 500,
+                 max_age: float = 3600):
+        self.argv = argv
+        self.setup = setup or []
+        self.size = max(1, size or os.cpu_count() or 1)
+        self.max_commands = max_commands
+        self.max_age = max_age
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _new_session(self) -> ShellSession:
+        session = ShellSession(self.argv, self.setup, self.max_commands, self.max_age)
+        session.start()
+        return session
+
+    def _checkout(self) -> ShellSession:
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                return self._new_session()
+            if session.expired:
+                logger.info("Recycling shell session")
+                session.close()
+                continue
+            return session
+
+    @contextmanager
+    def session(self):
+        """Borrow a ready shell session; broken sessions are discarded on return"""
+        self._slots.acquire()
+        session = None
+        try:
+            session = self._checkout()
+            yield session
+        finally:
+            if session is not None:
+                if session.alive and not session.expired:
+                    self._idle.put(session)
+                else:
+                    session.close()
+            self._slots.release()
+
+    def warm_up(self, count: Optional[int] = None):
+        """Start sessions ahead of the first command"""
+        for _ in range(min(count or self.size, self.size)):
+            try:
+                self._idle.put(self._new_session())
+            except ShellSessionError as e:
+                logger.warning(f"Could not pre-start shell session: {e}")
+                break
+
+    def close(self):
+        """Terminate every idle session"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
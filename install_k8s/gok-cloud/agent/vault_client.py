@@ -0,0 +1,142 @@
+"""
+HTTP client for the Vault API
+One keep-alive session with timeouts and retries covering the endpoints the
+GOK services use: sys/health, KV v2 read/write, token lookup/renew and
+Kubernetes auth login
+"""
+
+import os
+import logging
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class VaultError(Exception):
+    """Raised when a Vault request fails"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def kv2_data_path(path: str) -> str:
+    """
+    Map a KV path as used with the CLI (secret/rabbitmq) to its KV v2 API path
+    (secret/data/rabbitmq); paths that already contain data/ are kept
+    """
+    path = path.strip("/")
+    mount, _, rest = path.partition("/")
+    if not rest or rest == "data" or rest.startswith("data/"):
+        return path
+    return f"{mount}/data/{rest}"
+
+
+class VaultClient:
+    """Thread-safe Vault API client sharing one pooled session"""
+
+    def __init__(self,
+                 vault_addr: str,
+                 timeout: float = 10,
+                 retries: int = 3,
+                 backoff_factor: float = 0.3,
+                 pool_size: int = 4,
+                 verify=None):
+        """
+        Initialize the Vault client
+
+        Args:
+            vault_addr: Vault server address
+            timeout: Per-request timeout in seconds
+            retries: Retries for connection errors and 500/502/504 responses
+            backoff_factor: Exponential backoff factor between retries
+            pool_size: Keep-alive connections kept per host
+            verify: TLS verification flag or CA bundle (defaults to VAULT_CACERT)
+        """
+        self.vault_addr = vault_addr.rstrip("/")
+        self.timeout = timeout
+        self.verify = verify if verify is not None else (os.getenv("VAULT_CACERT") or True)
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 504),
+            allowed_methods=frozenset({"GET", "POST", "PUT"}),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def request(self, method: str, path: str, token: str = None, **kwargs) -> Dict:
+        """
+        Send a request to /v1/<path>
+
+        Args:
+            method: HTTP method
+            path: API path below /v1/
+            token: Vault token sent as X-Vault-Token
+            **kwargs: Passed through to requests (json, params, ...)
+
+        Returns:
+            Decoded JSON body ({} for empty responses)
+
+        Raises:
+            VaultError on transport errors, non-2xx responses or invalid JSON
+        """
+        headers = {"X-Vault-Token": token} if token else {}
+        url = f"{self.vault_addr}/v1/{path.lstrip('/')}"
+        try:
+            response = self._session.request(
+                method, url, headers=headers, timeout=self.timeout, verify=self.verify, **kwargs
+            )
+        except requests.exceptions.RequestException as e:
+            raise VaultError(f"Vault request {method} {path} failed: {e}")
+
+        if response.status_code >= 400:
+            try:
+                errors = "; ".join(response.json().get("errors", [])) or response.reason
+            except ValueError:
+                errors = response.text
+            raise VaultError(f"Vault returned {response.status_code} for {path}: {errors}", response.status_code)
+        if response.status_code == 204 or not response.content:
+            return {}
+        try:
+            return response.json()
+        except ValueError:
+            raise VaultError(f"Vault returned invalid JSON for {path}", response.status_code)
+
+    def health(self) -> Dict:
+        """Return sys/health status; sealed or standby servers are reported, not raised"""
+        return self.request("GET", "sys/health", params={
+            "standbyok": "true",
+            "sealedcode": "200",
+            "uninitcode": "200",
+        })
+
+    def kv_read(self, path: str, token: str) -> Dict:
+        """Read a KV v2 secret, returning the full response (data, metadata, lease)"""
+        return self.request("GET", kv2_data_path(path), token=token)
+
+    def kv_write(self, path: str, data: Dict, token: str) -> Dict:
+        """Write a new version of a KV v2 secret"""
+        return self.request("POST", kv2_data_path(path), token=token, json={"data": data})
+
+    def token_lookup_self(self, token: str) -> Dict:
+        return self.request("GET", "auth/token/lookup-self", token=token)
+
+    def token_renew_self(self, token: str, increment: int = None) -> Dict:
+        body = {"increment": f"{increment}s"} if increment else {}
+        return self.request("POST", "auth/token/renew-self", token=token, json=body)
+
+    def kubernetes_login(self, role: str, jwt: str, auth_path: str = "auth/kubernetes") -> Dict:
+        """Log in with a service account JWT, returning the auth block of the response"""
+        response = self.request("POST", f"{auth_path.strip('/')}/login", json={"role": role, "jwt": jwt})
+        if not response.get("auth"):
+            raise VaultError("Vault login response carries no auth block")
+        return response["auth"]
@@ -1,5 +1,6 @@
 import os
 import uuid
+import time
 import json
 import pika
 import logging
@@ -7,15 +8,25 @@ import requests
 import base64
 import subprocess
 from functools import wraps
+from urllib.parse import quote
 from flask import Flask, request, jsonify, send_from_directory
-from flask_socketio import SocketIO, emit, join_room
+from flask_socketio import SocketIO, emit, join_room, leave_room
+import socketio as socketio_lib
 from werkzeug.security import check_password_hash, generate_password_hash
 from threading import Thread
 from jose import jwt as jose_jwt
 import sys
 # Import our Vault credential managers
-from vault_credentials import get_rabbitmq_credentials, VaultCredentialManager
+from vault_credentials import get_rabbitmq_credentials, VaultCredentialManager, RabbitMQCredentials, CredentialProvider
 from vault import get_vault_secrets_from_files, get_config_secrets, get_rabbitmq_secrets_from_files
+from jwks_cache import JWKSCache
+from rabbitmq_publisher import RabbitMQPublisher
+from result_consumer import ResultConsumer
+from completion_index import CompletionIndex
+import metrics
+from metrics import CREDENTIAL_RESOLVE_SECONDS, JWT_VERIFY_SECONDS, MESSAGES_PUBLISHED, PUBLISH_SECONDS, RESULT_EMIT_SECONDS
+from batch_message import BatchMessage, Command, content_type_for, decode_result, encode
+from token_cache import TokenCache
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -29,16 +40,44 @@ OAUTH_ISSUER = os.environ.get("OAUTH_ISSUER")
 OAUTH_CLIENT_ID = os.environ.get("OAUTH_CLIENT_ID")
 REQUIRED_GROUP = os.environ.get("REQUIRED_GROUP", "user")
 RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "rabbitmq.rabbitmq")
+RABBITMQ_PUBLISHER_POOL_SIZE = int(os.environ.get("RABBITMQ_PUBLISHER_POOL_SIZE", "2"))
+RESULT_PREFETCH = int(os.environ.get("RESULT_PREFETCH", "1000"))
+RESULT_ACK_BATCH = int(os.environ.get("RESULT_ACK_BATCH", "100"))
+RESULT_ACK_INTERVAL_MS = int(os.environ.get("RESULT_ACK_INTERVAL_MS", "50"))
+# Result routing: "queue" consumes the shared results queue, "topic" binds a private
+# queue on RESULTS_EXCHANGE to results.<user>.<batch_id> for each published batch
+RESULT_ROUTING = os.environ.get("RESULT_ROUTING", "queue")  # Options: "queue", "topic"
+RESULTS_EXCHANGE = os.environ.get("RESULTS_EXCHANGE", "gok.results")
+RESULT_MESSAGE_TTL_MS = int(os.environ.get("RESULT_MESSAGE_TTL_MS", "300000"))
+RESULT_BINDING_TTL = float(os.environ.get("RESULT_BINDING_TTL", "3600"))
+# Wire formats ("json" or "msgpack"); keep "json" until every agent/controller understands msgpack
+COMMAND_WIRE_FORMAT = os.environ.get("COMMAND_WIRE_FORMAT", "json")
+RESULT_WIRE_FORMAT = os.environ.get("RESULT_WIRE_FORMAT", "json")
+# Commands queue priorities (x-max-priority, 0 disables); agents must use the same value.
+# Batches without a "priority" field are published with COMMAND_DEFAULT_PRIORITY
+COMMANDS_QUEUE_MAX_PRIORITY = int(os.environ.get("COMMANDS_QUEUE_MAX_PRIORITY", "10"))
+COMMAND_DEFAULT_PRIORITY = int(os.environ.get("COMMAND_DEFAULT_PRIORITY", "5"))
+# Cancel requests are published to every agent on CONTROL_EXCHANGE as control.<batch_id>
+CONTROL_EXCHANGE = os.environ.get("CONTROL_EXCHANGE", "gok.control")
+# Completion records (exit codes, timings) kept per batch for /command-batches/<batch_id>
+COMPLETION_INDEX_SIZE = int(os.environ.get("COMPLETION_INDEX_SIZE", "10000"))
+COMPLETION_INDEX_TTL = float(os.environ.get("COMPLETION_INDEX_TTL", "86400"))
+# Shared SocketIO message queue for running several replicas: "" (single replica),
+# "rabbitmq" (the broker the controller already uses) or an explicit URL
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE", "")
+SOCKETIO_CHANNEL = os.environ.get("SOCKETIO_CHANNEL", "gok-controller")
 
 # Vault integration mode configuration
 VAULT_INTEGRATION_MODE = os.environ.get("VAULT_INTEGRATION_MODE", "hybrid")  # Options: "agent", "api", "hybrid"
+CREDENTIAL_CACHE_TTL = int(os.environ.get("CREDENTIAL_CACHE_TTL", "300"))
+CREDENTIAL_FALLBACK_TTL = int(os.environ.get("CREDENTIAL_FALLBACK_TTL", "30"))
 
-# Get RabbitMQ credentials using hybrid Vault approach
-def get_rabbitmq_connection_params():
+# Resolve RabbitMQ credentials using hybrid Vault approach
+def resolve_rabbitmq_credentials():
     """
-    Get RabbitMQ connection parameters with hybrid Vault integration
+    Resolve RabbitMQ credentials with hybrid Vault integration
     Supports both Agent Injector (static) and Direct API (dynamic) approaches
-    Returns connection parameters for pika
+    Returns RabbitMQCredentials; called by the credential provider only when needed
     """
     try:
         logger.info(f"Using Vault integration mode: {VAULT_INTEGRATION_MODE}")
@@ -52,15 +91,14 @@ def get_rabbitmq_connection_params():
             agent_secrets = get_rabbitmq_secrets_from_files()
             if agent_secrets and agent_secrets.get('username') and agent_secrets.get('password'):
                 logger.info("Successfully retrieved RabbitMQ credentials from Vault Agent Injector")
-                return {
-                    'host': agent_secrets.get('host', RABBITMQ_HOST),
-                    'port': int(agent_secrets.get('port', 5672)),
-                    'virtual_host': agent_secrets.get('virtual_host', '/'),
-                    'credentials': pika.PlainCredentials(
-                        agent_secrets.get('username'),
-                        agent_secrets.get('password')
-                    )
-                }
+                return RabbitMQCredentials(
+                    username=agent_secrets.get('username'),
+                    password=agent_secrets.get('password'),
+                    host=agent_secrets.get('host', RABBITMQ_HOST),
+                    port=int(agent_secrets.get('port', 5672)),
+                    virtual_host=agent_secrets.get('virtual_host', '/'),
+                    source="agent-injector"
+                )
             else:
                 logger.warning("Agent Injector credentials not available or incomplete")
         
@@ -71,39 +109,63 @@ def get_rabbitmq_connection_params():
             
             if credentials_obj:
                 logger.info(f"Successfully retrieved RabbitMQ credentials from Vault API for user: {credentials_obj.username}")
-                return {
-                    'host': credentials_obj.host,
-                    'port': credentials_obj.port,
-                    'virtual_host': credentials_obj.virtual_host,
-                    'credentials': pika.PlainCredentials(
-                        credentials_obj.username, 
-                        credentials_obj.password
-                    )
-                }
+                return credentials_obj
             else:
                 logger.warning("Direct API credentials not available")
         
-        # Final fallback to environment variables
+        # Final fallback to environment variables, re-checked soon in case Vault comes back
         logger.warning("Could not retrieve credentials from any Vault method, using environment variables")
-        return {
-            'host': RABBITMQ_HOST,
-            'port': 5672,
-            'virtual_host': '/',
-            'credentials': pika.PlainCredentials(
-                os.environ.get("RABBITMQ_USER", "guest"),
-                os.environ.get("RABBITMQ_PASSWORD", "guest")
-            )
-        }
+        return RabbitMQCredentials(
+            username=os.environ.get("RABBITMQ_USER", "guest"),
+            password=os.environ.get("RABBITMQ_PASSWORD", "guest"),
+            host=RABBITMQ_HOST,
+            source="environment",
+            expires_at=time.time() + CREDENTIAL_FALLBACK_TTL
+        )
         
     except Exception as e:
         logger.error(f"Error getting RabbitMQ credentials: {e}")
         # Ultimate fallback
-        return {
-            'host': RABBITMQ_HOST,
-            'port': 5672,
-            'virtual_host': '/',
-            'credentials': pika.PlainCredentials("guest", "guest")
-        }
+        return RabbitMQCredentials(
+            username="guest",
+            password="guest",
+            host=RABBITMQ_HOST,
+            source="default",
+            expires_at=time.time() + CREDENTIAL_FALLBACK_TTL
+        )
+
+# Files written by the CSI driver, Agent Injector and secret volumes; a change triggers re-resolution
+CREDENTIAL_WATCH_PATHS = [
+    "/mnt/secrets-store",
+    os.path.join(os.environ.get("VAULT_SECRETS_PATH", "/vault/secrets/"), "rabbitmq"),
+    "/var/run/secrets/kubernetes.io/secret/rabbitmq",
+]
+
+def timed_resolve_rabbitmq_credentials():
+    with CREDENTIAL_RESOLVE_SECONDS.time():
+        return resolve_rabbitmq_credentials()
+
+credential_provider = CredentialProvider(
+    timed_resolve_rabbitmq_credentials,
+    ttl=CREDENTIAL_CACHE_TTL,
+    watch_paths=CREDENTIAL_WATCH_PATHS
+)
+
+def get_rabbitmq_connection_params(force_refresh=False):
+    """
+    Get RabbitMQ connection parameters from the process-wide credential cache
+    Returns connection parameters for pika
+    """
+    credentials_obj = credential_provider.get(force=force_refresh)
+    return {
+        'host': credentials_obj.host,
+        'port': credentials_obj.port,
+        'virtual_host': credentials_obj.virtual_host,
+        'credentials': pika.PlainCredentials(
+            credentials_obj.username,
+            credentials_obj.password
+        )
+    }
 
 # Get configuration secrets using hybrid Vault approach
 def get_application_config():
@@ -141,30 +203,36 @@ def get_application_config():
 
 
 # --- OIDC/JWT helpers ---
-def get_jwks():
-    try:
-        oidc_conf = requests.get(f"{OAUTH_ISSUER}/.well-known/openid-configuration", verify=True).json()
-        jwks_uri = oidc_conf["jwks_uri"]
-        return requests.get(jwks_uri, verify=True).json()
-    except Exception as e:
-        logging.error(f"Failed to fetch JWKS: {e}")
-        return {"keys": []}
+# Signing keys are indexed by kid and refreshed on TTL or unknown kid
+JWKS_CACHE_TTL = int(os.environ.get("JWKS_CACHE_TTL", "3600"))
+jwks_cache = JWKSCache(OAUTH_ISSUER, ttl=JWKS_CACHE_TTL)
 
-JWKS = get_jwks()
+# Claims of verified tokens are reused until exp; cleared when the signing keys rotate
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "1024"))
+TOKEN_CACHE_TTL = int(os.environ.get("TOKEN_CACHE_TTL", "300"))
+token_cache = TokenCache(max_size=TOKEN_CACHE_SIZE, max_ttl=TOKEN_CACHE_TTL, version_source=lambda: jwks_cache.version)
 
 def verify_id_token(token):
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
     try:
         unverified_header = jose_jwt.get_unverified_header(token)
-        key = next(k for k in JWKS["keys"] if k["kid"] == unverified_header["kid"])
+        key = jwks_cache.get_key(unverified_header.get("kid"))
+        if key is None:
+            raise ValueError(f"No signing key for kid {unverified_header.get('kid')}")
         try:
             payload = jose_jwt.decode(
                 token, key, algorithms=["RS256"], audience=OAUTH_CLIENT_ID, issuer=OAUTH_ISSUER,
             )
+            token_cache.put(token, payload)
             return payload
         except jose_jwt.JWTError as e:
             if "at_hash" in str(e):
                 # Ignore at_hash error if you don't have access_token
                 payload = jose_jwt.get_unverified_claims(token)
+                # at_hash is checked after the signature, so these claims are still signed
+                token_cache.put(token, payload)
                 return payload
             else:
                 raise
@@ -180,7 +248,8 @@ def require_oauth(required_group=None):
             if not auth.startswith("Bearer "):
                 return jsonify({"msg": "Missing token"}), 401
             token = auth.split(" ", 1)[1]
-            payload = verify_id_token(token)
+            with JWT_VERIFY_SECONDS.time():
+                payload = verify_id_token(token)
             if not payload:
                 return jsonify({"msg": "Invalid token"}), 401
             request.user = payload
@@ -197,13 +266,61 @@ def require_oauth(required_group=None):
         return wrapper
     return decorator
 
+def get_socketio_message_queue():
+    """
+    URL of the message queue shared by all controller replicas
+    Emits go through it, so a result consumed by one replica reaches
+    browsers connected to any other replica
+    """
+    if not SOCKETIO_MESSAGE_QUEUE:
+        return None
+    if SOCKETIO_MESSAGE_QUEUE != "rabbitmq":
+        return SOCKETIO_MESSAGE_QUEUE
+    creds = credential_provider.get()
+    return "amqp://{}:{}@{}:{}/{}".format(
+        quote(creds.username, safe=""),
+        quote(creds.password, safe=""),
+        creds.host,
+        creds.port,
+        quote(creds.virtual_host, safe="")
+    )
+
+def create_socketio_manager():
+    """
+    Client manager for SOCKETIO_MESSAGE_QUEUE=rabbitmq whose connections are
+    built from the current credentials, so emits keep working after rotation
+    """
+    if SOCKETIO_MESSAGE_QUEUE != "rabbitmq":
+        # No queue, or a static URL that Flask-SocketIO connects to itself
+        return None
+
+    class CredentialKombuManager(socketio_lib.KombuManager):
+        def _connection(self):
+            # Reconnects of the listener pick up rotated credentials
+            self.url = get_socketio_message_queue()
+            return super()._connection()
+
+        def reconnect_publisher(self):
+            old, self.publisher_connection = self.publisher_connection, self._connection()
+            old.release()
+
+    manager = CredentialKombuManager(get_socketio_message_queue(), channel=SOCKETIO_CHANNEL)
+    credential_provider.subscribe(lambda old, new: manager.reconnect_publisher())
+    return manager
+
 # --- Flask app ---
 app = Flask(
     __name__,
     static_folder="static",  # This is where your React build is copied
     static_url_path=""       # Serve static files at root
 )
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio_manager = create_socketio_manager()
+if socketio_manager is not None:
+    socketio = SocketIO(app, cors_allowed_origins="*", client_manager=socketio_manager)
+else:
+    socketio = SocketIO(app, cors_allowed_origins="*", message_queue=get_socketio_message_queue(), channel=SOCKETIO_CHANNEL)
+if SOCKETIO_MESSAGE_QUEUE:
+    logger.info(f"SocketIO emits are shared across replicas on channel '{SOCKETIO_CHANNEL}'")
 
 # Initial load - removed API_TOKEN logic as it's not used
 
@@ -239,31 +356,126 @@ def send_command_batch():
     if not isinstance(commands, list) or not all(isinstance(c, str) for c in commands):
         log_access("send-command-batch", username, ip, details="Invalid commands format", status="failed")
         return jsonify({"error": "Invalid commands format"}), 400
+    priority = data.get("priority", COMMAND_DEFAULT_PRIORITY)
+    # AMQP priorities are one octet; the broker treats values above x-max-priority as the maximum
+    if isinstance(priority, bool) or not isinstance(priority, int) or not 0 <= priority <= 255:
+        log_access("send-command-batch", username, ip, details="Invalid priority", status="failed")
+        return jsonify({"error": "Invalid priority"}), 400
     user_info = {
         "sub": request.user.get("sub"),
         "name": request.user.get("name"),
         "groups": request.user.get("groups", []),
         "id_token": request.headers.get("Authorization").split(" ", 1)[1]
     }
-    batch_id = publish_batch(commands, user_info)
+    try:
+        batch_id = publish_batch(commands, user_info, priority)
+    except pika.exceptions.AMQPError as e:
+        logging.error(f"Failed to publish command batch: {e}")
+        log_access("send-command-batch", username, ip, details="Message broker unavailable", status="failed")
+        return jsonify({"error": "Message broker unavailable"}), 503
     log_access("send-command-batch", username, ip, details={"batch_id": batch_id, "groups": groups})
     return jsonify({"msg": "Command batch accepted", "batch_id": batch_id, "issued_by": user_info["sub"], "groups": groups}), 200
 
-def publish_batch(commands, user_info):
-    conn_params = get_rabbitmq_connection_params()
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(**conn_params)
+@app.route("/cancel-command-batch", methods=["POST"])
+@require_oauth(REQUIRED_GROUP)
+def cancel_command_batch():
+    username = request.user.get("name") or request.user.get("sub")
+    ip = request.remote_addr
+    data = request.json or {}
+    batch_id = data.get("batch_id")
+    command_id = data.get("command_id")
+    if not isinstance(batch_id, str) or not batch_id:
+        log_access("cancel-command-batch", username, ip, details="Missing batch_id", status="failed")
+        return jsonify({"error": "Missing batch_id"}), 400
+    groups = request.user.get("groups", [])
+    if isinstance(groups, str):
+        groups = [groups]
+    try:
+        # Agents only stop commands of the requesting user unless they are an administrator
+        publish_cancel(batch_id, command_id, request.user.get("sub"), "administrators" in groups)
+    except pika.exceptions.AMQPError as e:
+        logging.error(f"Failed to publish cancel request: {e}")
+        log_access("cancel-command-batch", username, ip, details="Message broker unavailable", status="failed")
+        return jsonify({"error": "Message broker unavailable"}), 503
+    log_access("cancel-command-batch", username, ip, details={"batch_id": batch_id, "command_id": command_id})
+    return jsonify({"msg": "Cancel requested", "batch_id": batch_id, "command_id": command_id}), 202
+
+# Completion records reported by agents, per batch
+completion_index = CompletionIndex(max_batches=COMPLETION_INDEX_SIZE, ttl=COMPLETION_INDEX_TTL)
+
+@app.route("/command-batches/<batch_id>")
+@require_oauth(REQUIRED_GROUP)
+def get_command_batch(batch_id):
+    entry = completion_index.get(batch_id)
+    groups = request.user.get("groups", [])
+    if isinstance(groups, str):
+        groups = [groups]
+    # Records of batches published by another replica carry no owner; only administrators see them
+    if entry is None or (entry["owner"] != request.user.get("sub") and "administrators" not in groups):
+        return jsonify({"error": "Unknown batch"}), 404
+    return jsonify(entry), 200
+
+# Long-lived publisher connections; credentials are only resolved on (re)connect
+rabbitmq_publisher = RabbitMQPublisher(
+    parameters_factory=lambda: pika.ConnectionParameters(**get_rabbitmq_connection_params()),
+    pool_size=RABBITMQ_PUBLISHER_POOL_SIZE
+)
+credential_provider.subscribe(lambda old, new: rabbitmq_publisher.invalidate())
+
+def result_routing_key(user, batch_id):
+    """Topic routing key for a batch's results; dots would split values into extra words"""
+    return "results.{}.{}".format(str(user or "unknown").replace(".", "_"), str(batch_id).replace(".", "_"))
+
+def control_routing_key(batch_id):
+    """Topic routing key for control messages of a batch; dots would split it into extra words"""
+    return "control.{}".format(str(batch_id).replace(".", "_"))
+
+def publish_cancel(batch_id, command_id, sub, admin):
+    body = json.dumps({"action": "cancel", "batch_id": batch_id, "command_id": command_id, "sub": sub, "admin": admin})
+    with PUBLISH_SECONDS.labels("cancel").time():
+        rabbitmq_publisher.publish(
+            control_routing_key(batch_id), body,
+            exchange=CONTROL_EXCHANGE,
+            exchange_type="topic",
+            properties=pika.BasicProperties(content_type="application/json")
+        )
+    MESSAGES_PUBLISHED.labels("cancel").inc()
+
+def commands_queue_arguments():
+    return {"x-max-priority": COMMANDS_QUEUE_MAX_PRIORITY} if COMMANDS_QUEUE_MAX_PRIORITY > 0 else None
+
+def publish_batch(commands, user_info, priority=COMMAND_DEFAULT_PRIORITY):
+    # Random ids: unique across replicas and resubmissions, unlike a hash of the commands
+    batch_id = str(uuid.uuid4())
+    batch = BatchMessage(
+        commands=[Command(c, i) for i, c in enumerate(commands)],
+        token=user_info["id_token"],
+        batch_id=batch_id,
+        user_info={k: v for k, v in user_info.items() if k != "id_token"},
+        result_format=content_type_for(RESULT_WIRE_FORMAT),
+        priority=priority
     )
-    channel = connection.channel()
-    batch_id = user_info["sub"] + "-" + str(abs(hash(json.dumps(commands))))
-    msg = {
-        "commands": [{"command": c, "command_id": i} for i, c in enumerate(commands)],
-        "user_info": user_info,
-        "batch_id": batch_id
-    }
-    channel.queue_declare(queue="commands", durable=True)
-    channel.basic_publish(exchange='', routing_key="commands", body=json.dumps(msg))
-    connection.close()
+    body, content_type, content_encoding = encode(batch, content_type_for(COMMAND_WIRE_FORMAT))
+    published_at = time.time()
+    completion_index.register(batch_id, user_info["sub"], published_at, len(commands))
+    if RESULT_ROUTING == "topic":
+        # Bind before publishing so the first output lines are not dropped
+        result_consumer.start()
+        if not result_consumer.bind(result_routing_key(user_info["sub"], batch_id)):
+            logger.warning(f"Result binding for batch {batch_id} not confirmed yet")
+    with PUBLISH_SECONDS.labels("batch").time():
+        rabbitmq_publisher.publish(
+            "commands", body,
+            properties=pika.BasicProperties(
+                content_type=content_type,
+                content_encoding=content_encoding,
+                priority=priority,
+                # Lets agents report how long the batch waited in the queue
+                headers={"published_at": published_at}
+            ),
+            queue_arguments=commands_queue_arguments()
+        )
+    MESSAGES_PUBLISHED.labels("batch").inc()
     return batch_id
 
 @socketio.on("join")
@@ -273,25 +485,53 @@ def on_join(data):
         join_room(batch_id)
         emit("joined", {"batch_id": batch_id})
 
-def rabbitmq_result_worker():
-    conn_params = get_rabbitmq_connection_params()
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(**conn_params)
-    )
-    channel = connection.channel()
-    channel.queue_declare(queue="results", durable=True)
-    for method_frame, properties, body in channel.consume("results", inactivity_timeout=1):
-        if body is not None:
-            msg = json.loads(body)
-            batch_id = msg.get("batch_id")
-            socketio.emit("result", msg, room=batch_id)
-            channel.basic_ack(method_frame.delivery_tag)
-        socketio.sleep(0.01)
+@socketio.on("leave")
+def on_leave(data):
+    # Sent by the console's shared socket bridge once nobody watches a batch any more
+    batch_id = data.get("batch_id")
+    if batch_id:
+        leave_room(batch_id)
+
+def decode_result_message(body, properties):
+    return decode_result(body, properties.content_type, properties.content_encoding).to_dict()
+
+def emit_result(msg):
+    # Completion records (exit code, timings) have no output
+    if completion_index.record(msg):
+        event = "batch_status" if msg.get("type") == "batch_status" else "command_status"
+    else:
+        event = "result"
+    with RESULT_EMIT_SECONDS.time():
+        socketio.emit(event, msg, room=msg.get("batch_id"))
+
+# Broker-pushed results, emitted in order and acknowledged in batches
+result_consumer = ResultConsumer(
+    parameters_factory=lambda: pika.ConnectionParameters(**get_rabbitmq_connection_params()),
+    dispatch=emit_result,
+    decode=decode_result_message,
+    queue_name="results",
+    exchange=RESULTS_EXCHANGE if RESULT_ROUTING == "topic" else None,
+    message_ttl=RESULT_MESSAGE_TTL_MS,
+    binding_ttl=RESULT_BINDING_TTL,
+    prefetch=RESULT_PREFETCH,
+    ack_batch=RESULT_ACK_BATCH,
+    ack_interval=RESULT_ACK_INTERVAL_MS / 1000
+)
+credential_provider.subscribe(lambda old, new: result_consumer.invalidate())
+metrics.register_pipeline(rabbitmq_publisher, result_consumer)
+
+@app.route("/metrics")
+def prometheus_metrics():
+    rendered = metrics.render()
+    if rendered is None:
+        return jsonify({"error": "Metrics unavailable, prometheus_client is not installed"}), 503
+    body, content_type = rendered
+    return body, 200, {"Content-Type": content_type}
 
 @socketio.on("connect")
 def start_worker():
-    if not hasattr(socketio, "result_thread"):
-        socketio.result_thread = socketio.start_background_task(rabbitmq_result_worker)
+    # Safety net for servers that do not run __main__; start() is idempotent
+    result_consumer.start()
 
 # Catch-all route to serve React for client-side routing
 @app.errorhandler(404)
@@ -304,4 +544,6 @@ def index():
     return send_from_directory(app.static_folder, "index.html")
 
 if __name__ == "__main__":
+    # Every replica competes for results, even with no browser connected to it
+    result_consumer.start()
     socketio.run(app, host="0.0.0.0", port=8080, allow_unsafe_werkzeug=True)
\ No newline at end of file
@@ -0,0 +1,98 @@
+"""
+In-memory index of command and batch completion records
+Agents publish a status record after every command and batch; the
+controller keeps them per batch, together with the publish time it knows,
+so a batch can be queried for exit codes, timings and end-to-end latency
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class CompletionIndex:
+    """Thread-safe, bounded index of completion records keyed by batch id"""
+
+    def __init__(self, max_batches: int = 10000, ttl: float = 86400):
+        """
+        Initialize the index
+
+        Args:
+            max_batches: Batches kept at most; the least recently updated are dropped first
+            ttl: Seconds a batch is kept after its last update
+        """
+        self.max_batches = max(1, max_batches)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._batches: "OrderedDict[str, Dict]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def register(self, batch_id: str, owner: Optional[str], published_at: float, commands: int):
+        """Record a batch when it is published"""
+        with self._lock:
+            entry = self._entry_locked(batch_id)
+            entry.update(owner=owner, published_at=published_at, commands_total=commands)
+
+    def record(self, msg: Dict) -> bool:
+        """
+        Add a status message (as decoded from the results queue)
+
+        Returns:
+            True if the message was a completion record, False for plain output
+        """
+        if "status" not in msg or not msg.get("batch_id"):
+            return False
+        with self._lock:
+            entry = self._entry_locked(msg["batch_id"])
+            if msg.get("type") == "batch_status":
+                entry["batch"] = {k: v for k, v in msg.items() if k != "type"}
+                if entry.get("published_at") and msg.get("ended_at"):
+                    entry["end_to_end"] = round(msg["ended_at"] - entry["published_at"], 3)
+            else:
+                entry["commands"][str(msg.get("command_id"))] = dict(msg)
+        return True
+
+    def get(self, batch_id: str) -> Optional[Dict]:
+        """Snapshot of a batch's records, or None if unknown or expired"""
+        with self._lock:
+            self._expire_locked(time.monotonic())
+            entry = self._batches.get(batch_id)
+            if entry is None:
+                return None
+            snapshot = {k: v for k, v in entry.items() if k != "updated"}
+            snapshot["commands"] = [entry["commands"][key] for key in sorted(entry["commands"], key=_command_order)]
+            return snapshot
+
+    def _entry_locked(self, batch_id: str) -> Dict:
+        now = time.monotonic()
+        entry = self._batches.get(batch_id)
+        if entry is None:
+            entry = {
+                "batch_id": batch_id,
+                "owner": None,
+                "published_at": None,
+                "commands_total": None,
+                "commands": {},
+                "batch": None,
+                "end_to_end": None,
+            }
+            self._batches[batch_id] = entry
+        entry["updated"] = now
+        self._batches.move_to_end(batch_id)
+        self._expire_locked(now)
+        return entry
+
+    def _expire_locked(self, now: float):
+        while self._batches:
+            batch_id, entry = next(iter(self._batches.items()))
+            if len(self._batches) <= self.max_batches and now - entry["updated"] < self.ttl:
+                break
+            self._batches.popitem(last=False)
+
+
+def _command_order(key: str):
+    # Command ids are list indexes for batches from /send-command-batch
+    return (0, int(key), "") if key.isdigit() else (1, 0, key)
@@ -0,0 +1,89 @@
+"""
+Prometheus metrics for the GOK controller
+Latencies are recorded directly on the hot paths; message counts and
+connection state are read from the publisher and result consumer at
+scrape time. Without prometheus_client installed every metric is a no-op
+and /metrics reports that metrics are unavailable
+"""
+
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    Counter = Histogram = None
+
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+SLOW_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    @contextmanager
+    def time(self):
+        yield
+
+
+def _metric(cls, *args, **kwargs):
+    return cls(*args, **kwargs) if cls is not None else _NoopMetric()
+
+
+JWT_VERIFY_SECONDS = _metric(
+    Histogram, "gok_controller_jwt_verify_seconds", "Time to verify a request's id token, cache hits included",
+    buckets=FAST_BUCKETS)
+CREDENTIAL_RESOLVE_SECONDS = _metric(
+    Histogram, "gok_controller_credential_resolve_seconds", "Time to resolve RabbitMQ credentials from Vault or fallbacks",
+    buckets=SLOW_BUCKETS)
+PUBLISH_SECONDS = _metric(
+    Histogram, "gok_controller_publish_seconds", "Time to publish a message and receive the broker confirm", ["kind"],
+    buckets=FAST_BUCKETS)
+RESULT_EMIT_SECONDS = _metric(
+    Histogram, "gok_controller_result_emit_seconds", "Time to emit one result message to SocketIO clients",
+    buckets=FAST_BUCKETS)
+MESSAGES_PUBLISHED = _metric(Counter, "gok_controller_messages_published_total", "Messages published", ["kind"])
+
+
+class PipelineCollector:
+    """Exposes the counters kept by RabbitMQPublisher and ResultConsumer"""
+
+    def __init__(self, publisher, consumer):
+        self.publisher = publisher
+        self.consumer = consumer
+
+    def collect(self):
+        yield CounterMetricFamily("gok_controller_results_consumed", "Result messages delivered by the broker",
+                                  value=self.consumer.delivered)
+        yield CounterMetricFamily("gok_controller_results_dispatched", "Result messages emitted to SocketIO",
+                                  value=self.consumer.dispatched)
+        yield CounterMetricFamily("gok_controller_results_acked", "Result messages acknowledged",
+                                  value=self.consumer.acked)
+        yield GaugeMetricFamily("gok_controller_results_pending", "Result messages received but not yet emitted",
+                                value=self.consumer.pending)
+        connects = CounterMetricFamily("gok_controller_rabbitmq_connects",
+                                         "RabbitMQ connections opened, reconnects included", labels=["connection"])
+        connects.add_metric(["publisher"], self.publisher.reconnects)
+        connects.add_metric(["result_consumer"], self.consumer.reconnects)
+        yield connects
+
+
+def register_pipeline(publisher, consumer):
+    """Register the publisher and result consumer counters with the default registry"""
+    if Counter is not None:
+        REGISTRY.register(PipelineCollector(publisher, consumer))
+
+
+def render() -> Optional[Tuple[bytes, str]]:
+    """Body and content type of a /metrics response, or None if prometheus_client is missing"""
+    if Counter is None:
+        return None
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
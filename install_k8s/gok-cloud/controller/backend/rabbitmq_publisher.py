@@ -0,0 +1,192 @@
+"""
+Pooled RabbitMQ publisher for the GOK controller
+Keeps long-lived connections with confirm-mode channels so request handlers
+publish without a connect, credential lookup and queue declare per call
+"""
+
+import time
+import queue
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+import pika
+
+logger = logging.getLogger(__name__)
+
+
+class _PooledChannel:
+    """One connection/channel pair owned by the pool"""
+
+    def __init__(self):
+        self.connection = None
+        self.channel = None
+        self.declared = set()
+        self.generation = 0
+
+    @property
+    def is_open(self) -> bool:
+        return (self.connection is not None and self.connection.is_open
+                and self.channel is not None and self.channel.is_open)
+
+    def close(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception as e:
+            logger.debug(f"Error closing publisher connection: {e}")
+        self.connection = None
+        self.channel = None
+        self.declared = set()
+
+
+class RabbitMQPublisher:
+    """Thread-safe pool of persistent publisher connections with publisher confirms"""
+
+    def __init__(self,
+                 parameters_factory: Callable[[], pika.ConnectionParameters],
+                 pool_size: int = 2,
+                 max_retries: int = 3,
+                 base_delay: float = 0.5,
+                 max_delay: float = 10,
+                 checkout_timeout: float = 30):
+        """
+        Initialize the publisher pool (connections are opened lazily)
+
+        Args:
+            parameters_factory: Returns pika connection parameters; only called on (re)connect
+            pool_size: Number of connections kept open
+            max_retries: Publish attempts before giving up
+            base_delay: Initial reconnect backoff in seconds
+            max_delay: Maximum reconnect backoff in seconds
+            checkout_timeout: Seconds to wait for a free connection
+        """
+        self.parameters_factory = parameters_factory
+        self.pool_size = max(1, pool_size)
+        self.max_retries = max(1, max_retries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.checkout_timeout = checkout_timeout
+
+        self._pool = queue.LifoQueue()
+        for _ in range(self.pool_size):
+            self._pool.put(_PooledChannel())
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.reconnects = 0
+
+    def _connect(self, slot: _PooledChannel):
+        slot.close()
+        slot.connection = pika.BlockingConnection(self.parameters_factory())
+        slot.channel = slot.connection.channel()
+        slot.channel.confirm_delivery()
+        with self._lock:
+            self.reconnects += 1
+            slot.generation = self._generation
+        logger.info("Publisher connection to RabbitMQ established")
+
+    def invalidate(self):
+        """Reconnect every pooled connection on its next use (e.g. after credential rotation)"""
+        with self._lock:
+            self._generation += 1
+
+    def _ensure_open(self, slot: _PooledChannel):
+        if slot.is_open and slot.generation == self._generation:
+            try:
+                # Service heartbeats that arrived while the connection sat idle
+                slot.connection.process_data_events(time_limit=0)
+                return
+            except Exception as e:
+                logger.warning(f"Idle publisher connection is gone, reconnecting: {e}")
+        self._connect(slot)
+
+    def _declare(self, slot: _PooledChannel, queue_name: str, arguments: Optional[Dict]):
+        if queue_name in slot.declared:
+            return
+        try:
+            slot.channel.queue_declare(queue=queue_name, durable=True, arguments=arguments)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code != 406 or not arguments:
+                raise
+            # Declared earlier with other arguments (e.g. before priorities were enabled); use it as it is
+            logger.warning(f"Queue '{queue_name}' exists with other arguments, publishing without them: {e}")
+            slot.channel = slot.connection.channel()
+            slot.channel.confirm_delivery()
+            slot.channel.queue_declare(queue=queue_name, passive=True)
+        slot.declared.add(queue_name)
+
+    def _declare_exchange(self, slot: _PooledChannel, exchange: str, exchange_type: str):
+        key = f"exchange:{exchange}"
+        if key in slot.declared:
+            return
+        slot.channel.exchange_declare(exchange=exchange, exchange_type=exchange_type, durable=True)
+        slot.declared.add(key)
+
+    def publish(self,
+                routing_key: str,
+                body,
+                exchange: str = '',
+                properties: pika.BasicProperties = None,
+                queue_arguments: Optional[Dict] = None,
+                declare: bool = True,
+                exchange_type: Optional[str] = None):
+        """
+        Publish a message and wait for the broker confirm
+
+        Args:
+            routing_key: Queue name (default exchange) or routing key
+            body: Message body
+            exchange: Exchange to publish to
+            properties: Optional message properties
+            queue_arguments: Arguments used when declaring the queue
+            declare: Declare routing_key as a durable queue on first use
+            exchange_type: Declare the exchange as a durable exchange of this type on first use
+
+        Raises:
+            pika.exceptions.AMQPError if the message could not be confirmed
+        """
+        try:
+            slot = self._pool.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            raise pika.exceptions.AMQPConnectionError("No publisher connection available")
+
+        delay = self.base_delay
+        try:
+            for attempt in range(self.max_retries):
+                try:
+                    self._ensure_open(slot)
+                    if declare and not exchange:
+                        self._declare(slot, routing_key, queue_arguments)
+                    if exchange and exchange_type:
+                        self._declare_exchange(slot, exchange, exchange_type)
+                    slot.channel.basic_publish(
+                        exchange=exchange,
+                        routing_key=routing_key,
+                        body=body,
+                        properties=properties
+                    )
+                    return
+                except (pika.exceptions.UnroutableError, pika.exceptions.NackError):
+                    raise
+                except (pika.exceptions.AMQPError, OSError) as e:
+                    slot.close()
+                    if attempt == self.max_retries - 1:
+                        logger.error(f"Publish to '{routing_key}' failed after {self.max_retries} attempts: {e}")
+                        raise
+                    logger.warning(f"Publish attempt {attempt + 1}/{self.max_retries} failed: {e}. Retrying in {delay}s...")
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_delay)
+        finally:
+            self._pool.put(slot)
+
+    def close(self):
+        """Close every pooled connection"""
+        slots = []
+        while True:
+            try:
+                slots.append(self._pool.get_nowait())
+            except queue.Empty:
+                break
+        for slot in slots:
+            slot.close()
+            self._pool.put(slot)
@@ -0,0 +1,246 @@
+"""
+Push-based consumer for agent results
+Deliveries are pushed by the broker, handed to a single dispatcher thread
+that emits them in order, and acknowledged in batches with multiple=True.
+The prefetch window bounds the dispatch queue, so a slow emitter stops the
+broker instead of growing memory.
+
+With an exchange configured, the consumer reads a private auto-delete queue
+that is bound only to the routing keys passed to bind(), so each controller
+receives the batches it serves instead of all cluster traffic
+"""
+
+import json
+import time
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict
+
+import pika
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ResultConsumer:
+    """Consumes a results queue and dispatches each decoded message"""
+
+    def __init__(self,
+                 parameters_factory: Callable[[], pika.ConnectionParameters],
+                 dispatch: Callable[[Dict], None],
+                 decode: Callable[[bytes, Any], Dict] = None,
+                 queue_name: str = "results",
+                 exchange: str = None,
+                 message_ttl: int = None,
+                 binding_ttl: float = 3600,
+                 prefetch: int = 1000,
+                 ack_batch: int = 100,
+                 ack_interval: float = 0.05,
+                 base_delay: float = 1,
+                 max_delay: float = 30):
+        """
+        Initialize the consumer (call start() to begin consuming)
+
+        Args:
+            parameters_factory: Returns pika connection parameters; called on every (re)connect
+            dispatch: Called with each decoded message on the dispatcher thread
+            decode: Turns (body, properties) into a message dict; JSON by default
+            queue_name: Queue to consume when no exchange is given
+            exchange: Topic exchange to bind a private queue to (per-batch routing)
+            message_ttl: x-message-ttl in milliseconds for the private queue
+            binding_ttl: Seconds without traffic after which a binding is removed
+            prefetch: Unacknowledged deliveries the broker may push, which also bounds the dispatch queue
+            ack_batch: Dispatched messages acknowledged with a single multi-ack
+            ack_interval: Maximum seconds a dispatched message waits for its ack
+            base_delay: Initial reconnect backoff in seconds
+            max_delay: Maximum reconnect backoff in seconds
+        """
+        self.parameters_factory = parameters_factory
+        self.dispatch = dispatch
+        self.decode = decode or (lambda body, properties: json.loads(body))
+        self.queue_name = queue_name
+        self.exchange = exchange
+        self.message_ttl = message_ttl
+        self.binding_ttl = binding_ttl
+        self.prefetch = max(1, prefetch)
+        self.ack_batch = max(1, ack_batch)
+        self.ack_interval = ack_interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+        self._bound = threading.Condition(self._lock)
+        self._bindings: Dict[str, float] = {}
+        self._applied = set()
+        self._generation = 0
+        self._dispatched_tag = 0
+        self._acked_tag = 0
+        self._reconnect = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+        self.delivered = 0
+        self.dispatched = 0
+        self.acked = 0
+        self.reconnects = 0
+
+    @property
+    def pending(self) -> int:
+        """Messages received but not yet dispatched"""
+        return self._pending.qsize()
+
+    def start(self):
+        """Start the consumer and dispatcher threads (idempotent)"""
+        with self._lock:
+            if self._threads:
+                return
+            self._threads = [
+                threading.Thread(target=self._dispatch_loop, name="result-dispatch", daemon=True),
+                threading.Thread(target=self._consume_loop, name="result-consumer", daemon=True),
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def invalidate(self):
+        """Reconnect with fresh parameters (e.g. after credential rotation)"""
+        self._reconnect.set()
+
+    def bind(self, routing_key: str, timeout: float = 5) -> bool:
+        """
+        Route messages with this key to the consumer (exchange mode only)
+
+        Args:
+            routing_key: Routing key (or topic pattern) to bind
+            timeout: Seconds to wait until the binding is active on the broker
+
+        Returns:
+            True once the binding is active, False on timeout
+        """
+        if not self.exchange:
+            return True
+        with self._bound:
+            self._bindings[routing_key] = time.monotonic()
+            return self._bound.wait_for(lambda: routing_key in self._applied, timeout)
+
+    def stop(self, timeout: float = 5):
+        self._stopping.set()
+        self._pending.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _consume_loop(self):
+        delay = self.base_delay
+        while not self._stopping.is_set():
+            connection = None
+            try:
+                self._reconnect.clear()
+                connection = pika.BlockingConnection(self.parameters_factory())
+                channel = connection.channel()
+                if self.exchange:
+                    channel.exchange_declare(exchange=self.exchange, exchange_type="topic", durable=True)
+                    arguments = {"x-message-ttl": self.message_ttl} if self.message_ttl else None
+                    result = channel.queue_declare(queue="", exclusive=True, auto_delete=True, arguments=arguments)
+                    queue_name = result.method.queue
+                else:
+                    channel.queue_declare(queue=self.queue_name, durable=True)
+                    queue_name = self.queue_name
+                channel.basic_qos(prefetch_count=self.prefetch)
+
+                with self._lock:
+                    # Delivery tags restart on every channel
+                    self.reconnects += 1
+                    self._generation += 1
+                    self._dispatched_tag = 0
+                    self._acked_tag = 0
+                    self._applied = set()
+                    generation = self._generation
+
+                def on_message(ch, method, properties, body):
+                    self.delivered += 1
+                    if self.exchange and method.routing_key in self._bindings:
+                        self._bindings[method.routing_key] = time.monotonic()
+                    self._pending.put((generation, method.delivery_tag, body, properties))
+
+                channel.basic_consume(queue=queue_name, on_message_callback=on_message)
+                logger.info(f"Consuming '{queue_name}' with prefetch {self.prefetch}")
+                delay = self.base_delay
+
+                last_ack = time.monotonic()
+                while not self._stopping.is_set() and not self._reconnect.is_set():
+                    if self.exchange:
+                        self._apply_bindings(channel, queue_name)
+                    connection.process_data_events(time_limit=self.ack_interval)
+                    last_ack = self._ack(channel, generation, last_ack)
+            except pika.exceptions.AMQPError as e:
+                logger.error(f"Result consumer connection lost: {e}. Reconnecting in {delay}s...")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+            except Exception as e:
+                logger.error(f"Result consumer failed: {e}. Reconnecting in {delay}s...")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+            finally:
+                if connection is not None and connection.is_open:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+    def _apply_bindings(self, channel, queue_name: str):
+        now = time.monotonic()
+        with self._lock:
+            wanted = set(self._bindings)
+            expired = {key for key in self._applied
+                       if now - self._bindings.get(key, 0) > self.binding_ttl}
+            for key in expired:
+                self._bindings.pop(key, None)
+            missing = wanted - self._applied - expired
+        for key in expired:
+            channel.queue_unbind(queue=queue_name, exchange=self.exchange, routing_key=key)
+        for key in missing:
+            channel.queue_bind(queue=queue_name, exchange=self.exchange, routing_key=key)
+        if expired or missing:
+            with self._bound:
+                self._applied = (self._applied - expired) | missing
+                self._bound.notify_all()
+
+    def _ack(self, channel, generation: int, last_ack: float) -> float:
+        with self._lock:
+            if generation != self._generation:
+                return last_ack
+            tag = self._dispatched_tag
+            outstanding = tag - self._acked_tag
+        now = time.monotonic()
+        if outstanding <= 0:
+            return now
+        if outstanding < self.ack_batch and now - last_ack < self.ack_interval:
+            return last_ack
+        channel.basic_ack(delivery_tag=tag, multiple=True)
+        with self._lock:
+            self.acked += tag - self._acked_tag
+            self._acked_tag = tag
+        return now
+
+    def _dispatch_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is _STOP:
+                return
+            generation, tag, body, properties = item
+            if generation != self._generation:
+                # Unacked deliveries of a closed channel are redelivered on the new one
+                continue
+            try:
+                msg = self.decode(body, properties)
+                self.dispatch(msg)
+            except ValueError as e:
+                logger.warning(f"Dropping undecodable result message: {e}")
+            except Exception as e:
+                logger.error(f"Error dispatching result message: {e}")
+            with self._lock:
+                if generation == self._generation:
+                    self._dispatched_tag = tag
+            self.dispatched += 1
@@ -5,13 +5,15 @@ This module provides functions to securely retrieve RabbitMQ credentials from Va
 
 import os
 import json
-import subprocess
 import logging
-import requests
 import time
-from typing import Dict, Optional, Tuple
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
 from dataclasses import dataclass
 
+from k8s_secrets import KubernetesSecretError, get_secret_reader
+from vault_client import VaultClient, VaultError
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,6 +26,8 @@ class RabbitMQCredentials:
     host: str = "rabbitmq.rabbitmq"
     port: int = 5672
     virtual_host: str = "/"
+    source: str = "unknown"
+    expires_at: Optional[float] = None
     
 class VaultCredentialManager:
     """Manager class for Vault credential operations with Kubernetes Service Account support"""
@@ -34,7 +38,9 @@ class VaultCredentialManager:
                  vault_path: str = "secret/rabbitmq",
                  vault_role: str = None,
                  k8s_auth_path: str = "auth/kubernetes",
-                 service_account_token_path: str = "/var/run/secrets/kubernetes.io/serviceaccount/token"):
+                 service_account_token_path: str = "/var/run/secrets/kubernetes.io/serviceaccount/token",
+                 renew_ahead: float = None,
+                 auto_renew: bool = True):
         """
         Initialize Vault credential manager
         
@@ -45,6 +51,8 @@ class VaultCredentialManager:
             vault_role: Kubernetes auth role for service account
             k8s_auth_path: Vault Kubernetes auth path
             service_account_token_path: Path to Kubernetes service account token
+            renew_ahead: Seconds before token expiry to renew it (capped at a third of its TTL)
+            auto_renew: Renew the token in a background thread so reads never wait on it
         """
         self.vault_addr = vault_addr or os.getenv('VAULT_ADDR', 'http://vault.vault:8200')
         self.vault_token = vault_token or os.getenv('VAULT_TOKEN')
@@ -53,9 +61,21 @@ class VaultCredentialManager:
         self.k8s_auth_path = k8s_auth_path
         self.service_account_token_path = service_account_token_path
         
-        # Token management
+        # Shared keep-alive session for every Vault call of this manager
+        self.client = VaultClient(
+            self.vault_addr,
+            timeout=float(os.getenv('VAULT_TIMEOUT', '10')),
+            retries=int(os.getenv('VAULT_RETRIES', '3'))
+        )
+        
+        # Token management; token_expires is tracked locally so reads need no lookup-self
         self.token_expires = None
+        self.token_ttl = 0
         self.token_renewable = False
+        self.renew_ahead = renew_ahead if renew_ahead is not None else float(os.getenv('VAULT_TOKEN_RENEW_AHEAD', '300'))
+        self.auto_renew = auto_renew
+        self._token_lock = threading.Lock()
+        self._renewal_thread = None
         
         # Try to authenticate with Kubernetes service account if no token provided
         if not self.vault_token:
@@ -83,26 +103,15 @@ class VaultCredentialManager:
         Returns:
             Token info dict if successful, None otherwise
         """
-        if not self.is_token_valid():
-            logger.info("Token expired or invalid, re-authenticating...")
-            if not self._authenticate_with_k8s_service_account():
-                return None
+        if not self._refresh_token_if_needed():
+            return None
         
         try:
-            token_url = f"{self.vault_addr}/v1/auth/token/lookup-self"
-            headers = {
-                'X-Vault-Token': self.vault_token,
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.get(token_url, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            token_info = response.json()
+            token_info = self.client.token_lookup_self(self.vault_token)
             logger.debug("Token info retrieved successfully")
             return token_info
             
-        except requests.exceptions.RequestException as e:
+        except VaultError as e:
             logger.error(f"Failed to get token info: {e}")
             return None
     
@@ -111,13 +120,13 @@ class VaultCredentialManager:
         Authenticate with Vault using Kubernetes service account token
         
         Returns:
-            Vault token if successful, None otherwise
+            True if a new token was obtained, False otherwise
         """
         try:
             # Check if service account token exists
             if not os.path.exists(self.service_account_token_path):
                 logger.warning(f"Service account token not found at {self.service_account_token_path}")
-                return None
+                return False
             
             # Read the service account token
             with open(self.service_account_token_path, 'r') as f:
@@ -125,38 +134,23 @@ class VaultCredentialManager:
             
             if not jwt_token:
                 logger.warning("Service account token is empty")
-                return None
+                return False
             
             logger.info(f"Authenticating with Vault using Kubernetes service account (role: {self.vault_role})")
             
             # Authenticate with Vault using the service account token
-            auth_url = f"{self.vault_addr}/v1/{self.k8s_auth_path}/login"
-            
-            auth_data = {
-                "role": self.vault_role,
-                "jwt": jwt_token
-            }
-            
-            headers = {
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(auth_url, json=auth_data, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            auth_response = response.json()
-            self.vault_token = auth_response['auth']['client_token']
+            auth = self.client.kubernetes_login(self.vault_role, jwt_token, self.k8s_auth_path)
+            self.vault_token = auth['client_token']
             
             # Calculate token expiration
-            lease_duration = auth_response['auth'].get('lease_duration', 3600)
-            self.token_expires = time.time() + lease_duration
-            self.token_renewable = auth_response['auth'].get('renewable', False)
+            lease_duration = auth.get('lease_duration', 3600)
+            self._set_token_lease(lease_duration, auth.get('renewable', False))
             
             logger.info(f"Authentication successful, token expires in {lease_duration} seconds")
             return True
                 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Network error during Vault authentication: {e}")
+        except VaultError as e:
+            logger.error(f"Vault authentication failed: {e}")
             return False
         except FileNotFoundError:
             logger.warning("Service account token file not found - not running in Kubernetes?")
@@ -165,111 +159,117 @@ class VaultCredentialManager:
             logger.error(f"Unexpected error during Vault authentication: {e}")
             return False
     
-    def _run_vault_command(self, command: list) -> Tuple[bool, str]:
+    def check_vault_status(self) -> bool:
         """
-        Execute vault CLI command
+        Check if Vault is accessible
         
-        Args:
-            command: List of command arguments
-            
         Returns:
-            Tuple of (success, output)
+            True if Vault is accessible, False otherwise
         """
         try:
-            # Set environment variables for vault command
-            env = os.environ.copy()
-            env['VAULT_ADDR'] = self.vault_addr
-            if self.vault_token:
-                env['VAULT_TOKEN'] = self.vault_token
-            
-            result = subprocess.run(
-                ['vault'] + command,
-                env=env,
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
-            
-            if result.returncode == 0:
-                return True, result.stdout.strip()
-            else:
-                logger.error(f"Vault command failed: {result.stderr}")
-                return False, result.stderr.strip()
-                
-        except subprocess.TimeoutExpired:
-            logger.error("Vault command timed out")
-            return False, "Command timeout"
-        except Exception as e:
-            logger.error(f"Error running vault command: {e}")
-            return False, str(e)
+            health = self.client.health()
+        except VaultError as e:
+            logger.error(f"Vault is not accessible: {e}")
+            return False
+        
+        if health.get('initialized', True) and not health.get('sealed', False):
+            logger.info("Vault is accessible and unsealed")
+            return True
+        logger.error(f"Vault is not ready: initialized={health.get('initialized')}, sealed={health.get('sealed')}")
+        return False
     
-    def check_vault_status(self) -> bool:
+    def _set_token_lease(self, ttl: int, renewable: bool):
+        """Record the lifetime of the current token (a TTL of 0 never expires)"""
+        self.token_ttl = ttl
+        self.token_expires = time.time() + ttl if ttl > 0 else float('inf')
+        self.token_renewable = bool(renewable)
+    
+    def _renew_at(self) -> float:
+        return self.token_expires - min(self.renew_ahead, self.token_ttl / 3)
+    
+    def _renew_token(self) -> bool:
         """
-        Check if Vault is accessible
+        Extend the current token with renew-self
         
         Returns:
-            True if Vault is accessible, False otherwise
+            True if the token was renewed for a useful period, False if a new login is needed
         """
-        success, output = self._run_vault_command(['status'])
-        if success or 'Sealed: false' in output:
-            logger.info("Vault is accessible and unsealed")
-            return True
-        else:
-            logger.error(f"Vault is not accessible: {output}")
+        try:
+            auth = self.client.token_renew_self(self.vault_token, increment=self.token_ttl or None).get('auth', {})
+        except VaultError as e:
+            logger.warning(f"Token renewal failed: {e}")
             return False
+        
+        lease_duration = auth.get('lease_duration', 0)
+        # Renewal is capped by the token's max TTL; near the cap only a new login helps
+        if lease_duration < min(60, self.token_ttl):
+            logger.info("Token reached its maximum TTL")
+            return False
+        self._set_token_lease(lease_duration, auth.get('renewable', self.token_renewable))
+        logger.info(f"Token renewed, expires in {lease_duration} seconds")
+        return True
+    
+    def _invalidate_token(self):
+        """Force a new login on the next read (e.g. after the token was revoked)"""
+        with self._token_lock:
+            self.token_expires = 0
+            self.token_renewable = False
     
     def _refresh_token_if_needed(self) -> bool:
         """
         Refresh Vault token if it's expired or about to expire
+        Expiry is tracked locally, so a current token costs no Vault request
         
         Returns:
             True if token is valid or successfully refreshed, False otherwise
         """
-        if not self.vault_token:
-            # Try to get a new token using service account
-            self.vault_token = self._authenticate_with_k8s_service_account()
-            return self.vault_token is not None
-        
-        # Check if current token is valid
-        try:
-            headers = {"X-Vault-Token": self.vault_token}
-            response = requests.get(f"{self.vault_addr}/v1/auth/token/lookup-self", 
-                                  headers=headers, timeout=10)
-            
-            if response.status_code == 200:
-                token_info = response.json()
-                ttl = token_info.get('data', {}).get('ttl', 0)
-                
-                # If token expires in less than 5 minutes, refresh it
-                if ttl < 300:
-                    logger.info("Token expires soon, refreshing...")
-                    new_token = self._authenticate_with_k8s_service_account()
-                    if new_token:
-                        self.vault_token = new_token
-                        return True
-                    else:
-                        logger.warning("Failed to refresh token")
-                        return False
-                
-                return True  # Token is still valid
+        with self._token_lock:
+            if not self.vault_token:
+                # Try to get a new token using service account
+                valid = self._authenticate_with_k8s_service_account()
             else:
-                # Token is invalid, try to get a new one
-                logger.warning("Current token is invalid, attempting to refresh")
-                new_token = self._authenticate_with_k8s_service_account()
-                if new_token:
-                    self.vault_token = new_token
-                    return True
-                else:
-                    return False
-                    
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error checking token validity: {e}")
-            # Try to refresh anyway
-            new_token = self._authenticate_with_k8s_service_account()
-            if new_token:
-                self.vault_token = new_token
-                return True
-            return False
+                valid = self._refresh_token_locked()
+        if valid:
+            self._ensure_renewal_thread()
+        return valid
+    
+    def _refresh_token_locked(self) -> bool:
+        if self.token_expires is None:
+            # Token came from VAULT_TOKEN; learn its lifetime once
+            try:
+                data = self.client.token_lookup_self(self.vault_token).get('data', {})
+                self._set_token_lease(data.get('ttl', 0), data.get('renewable', False))
+            except VaultError as e:
+                logger.warning(f"Current token is invalid, attempting to refresh: {e}")
+                return self._authenticate_with_k8s_service_account()
+        
+        if time.time() < self._renew_at():
+            return True  # Token is still valid
+        
+        if self.token_renewable and self._renew_token():
+            return True
+        
+        logger.info("Token expires soon, re-authenticating...")
+        if self._authenticate_with_k8s_service_account():
+            return True
+        # Keep using the old token while it lasts
+        return self.is_token_valid()
+    
+    def _ensure_renewal_thread(self):
+        if not self.auto_renew or (self._renewal_thread and self._renewal_thread.is_alive()):
+            return
+        with self._token_lock:
+            if self._renewal_thread and self._renewal_thread.is_alive():
+                return
+            self._renewal_thread = threading.Thread(target=self._renewal_loop, name="vault-token-renewal", daemon=True)
+            self._renewal_thread.start()
+    
+    def _renewal_loop(self):
+        while True:
+            # Wake up at the renewal point; retry failures every 10 seconds
+            delay = self._renew_at() - time.time() if self.token_expires else 0
+            time.sleep(min(max(delay, 10), 3600))
+            self._refresh_token_if_needed()
     
     def get_rabbitmq_credentials(self) -> Optional[RabbitMQCredentials]:
         """
@@ -286,37 +286,42 @@ class VaultCredentialManager:
         logger.info(f"Retrieving RabbitMQ credentials from Vault path: {self.vault_path}")
         
         try:
-            # Use REST API to get credentials from Vault
-            headers = {"X-Vault-Token": self.vault_token}
-            url = f"{self.vault_addr}/v1/{self.vault_path}"
+            try:
+                secret_data = self.client.kv_read(self.vault_path, self.vault_token)
+            except VaultError as e:
+                if e.status_code != 403:
+                    raise
+                # Token was revoked behind our back; log in again and retry once
+                logger.warning("Vault rejected the token, re-authenticating...")
+                self._invalidate_token()
+                if not self._refresh_token_if_needed():
+                    raise
+                secret_data = self.client.kv_read(self.vault_path, self.vault_token)
+            data = secret_data.get('data', {}).get('data', {})
             
-            response = requests.get(url, headers=headers, timeout=30)
+            username = data.get('username')
+            password = data.get('password')
             
-            if response.status_code == 200:
-                secret_data = response.json()
-                data = secret_data.get('data', {}).get('data', {})
-                
-                username = data.get('username')
-                password = data.get('password')
-                
-                if not username or not password:
-                    logger.error("Username or password not found in Vault secret")
-                    return None
-                
-                logger.info("Successfully retrieved RabbitMQ credentials from Vault")
-                return RabbitMQCredentials(
-                    username=username,
-                    password=password,
-                    host=os.getenv('RABBITMQ_HOST', 'rabbitmq.rabbitmq'),
-                    port=int(os.getenv('RABBITMQ_PORT', '5672')),
-                    virtual_host=os.getenv('RABBITMQ_VHOST', '/')
-                )
-            else:
-                logger.error(f"Failed to retrieve credentials from Vault: {response.status_code} - {response.text}")
+            if not username or not password:
+                logger.error("Username or password not found in Vault secret")
                 return None
+            
+            # Dynamic secrets carry a lease; static KV secrets report 0
+            lease_duration = secret_data.get('lease_duration') or 0
+            
+            logger.info("Successfully retrieved RabbitMQ credentials from Vault")
+            return RabbitMQCredentials(
+                username=username,
+                password=password,
+                host=os.getenv('RABBITMQ_HOST', 'rabbitmq.rabbitmq'),
+                port=int(os.getenv('RABBITMQ_PORT', '5672')),
+                virtual_host=os.getenv('RABBITMQ_VHOST', '/'),
+                source="vault",
+                expires_at=time.time() + lease_duration if lease_duration > 0 else None
+            )
                 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Network error retrieving credentials: {e}")
+        except VaultError as e:
+            logger.error(f"Failed to retrieve credentials from Vault: {e}")
             return None
         except Exception as e:
             logger.error(f"Error processing Vault credentials: {e}")
@@ -347,20 +352,31 @@ class VaultCredentialManager:
         if metadata:
             data.update(metadata)
         
-        # Build vault command
-        command = ['kv', 'put', self.vault_path]
-        for key, value in data.items():
-            command.extend([f'{key}={value}'])
-        
-        success, output = self._run_vault_command(command)
-        
-        if success:
+        try:
+            self.client.kv_write(self.vault_path, data, self.vault_token)
             logger.info("Successfully stored RabbitMQ credentials in Vault")
             return True
-        else:
-            logger.error(f"Failed to store credentials: {output}")
+        except VaultError as e:
+            logger.error(f"Failed to store credentials: {e}")
             return False
 
+_vault_manager = None
+_vault_manager_lock = threading.Lock()
+
+def get_vault_manager() -> VaultCredentialManager:
+    """
+    Get the process-wide VaultCredentialManager
+    Reusing one manager keeps its Vault token instead of logging in on every lookup
+    
+    Returns:
+        Shared VaultCredentialManager instance
+    """
+    global _vault_manager
+    with _vault_manager_lock:
+        if _vault_manager is None:
+            _vault_manager = VaultCredentialManager()
+        return _vault_manager
+
 # Fallback functions for backward compatibility
 def get_rabbitmq_credentials_from_vault() -> Optional[RabbitMQCredentials]:
     """
@@ -370,8 +386,7 @@ def get_rabbitmq_credentials_from_vault() -> Optional[RabbitMQCredentials]:
     Returns:
         RabbitMQCredentials object or None if failed
     """
-    manager = VaultCredentialManager()
-    return manager.get_rabbitmq_credentials()
+    return get_vault_manager().get_rabbitmq_credentials()
 
 def get_rabbitmq_credentials_from_k8s() -> Optional[RabbitMQCredentials]:
     """
@@ -381,37 +396,13 @@ def get_rabbitmq_credentials_from_k8s() -> Optional[RabbitMQCredentials]:
         RabbitMQCredentials object or None if failed
     """
     try:
-        # Extract credentials using kubectl
         namespace = os.getenv('RABBITMQ_NAMESPACE', 'rabbitmq')
         secret_name = os.getenv('RABBITMQ_SECRET_NAME', 'rabbitmq-default-user')
         
-        # Get username
-        result = subprocess.run([
-            'kubectl', 'get', 'secret', secret_name, 
-            '-n', namespace, '-o', 'jsonpath={.data.username}'
-        ], capture_output=True, text=True, timeout=10)
-        
-        if result.returncode != 0:
-            logger.error("Failed to get username from Kubernetes secret")
-            return None
-        
-        username = subprocess.run([
-            'base64', '-d'
-        ], input=result.stdout, capture_output=True, text=True).stdout.strip()
-        
-        # Get password
-        result = subprocess.run([
-            'kubectl', 'get', 'secret', secret_name,
-            '-n', namespace, '-o', 'jsonpath={.data.password}'
-        ], capture_output=True, text=True, timeout=10)
-        
-        if result.returncode != 0:
-            logger.error("Failed to get password from Kubernetes secret")
-            return None
-        
-        password = subprocess.run([
-            'base64', '-d'
-        ], input=result.stdout, capture_output=True, text=True).stdout.strip()
+        # One API call returns every key of the secret
+        data = get_secret_reader().get_secret(namespace, secret_name)
+        username = data.get('username', '').strip()
+        password = data.get('password', '').strip()
         
         if not username or not password:
             logger.error("Empty username or password from Kubernetes secret")
@@ -423,16 +414,18 @@ def get_rabbitmq_credentials_from_k8s() -> Optional[RabbitMQCredentials]:
             password=password,
             host=os.getenv('RABBITMQ_HOST', 'rabbitmq.rabbitmq'),
             port=int(os.getenv('RABBITMQ_PORT', '5672')),
-            virtual_host=os.getenv('RABBITMQ_VHOST', '/')
+            virtual_host=os.getenv('RABBITMQ_VHOST', '/'),
+            source="kubernetes"
         )
         
-    except subprocess.TimeoutExpired:
-        logger.error("Kubernetes credential retrieval timed out")
+    except KubernetesSecretError as e:
+        logger.error(f"Failed to get RabbitMQ credentials from Kubernetes secret: {e}")
         return None
     except Exception as e:
         logger.error(f"Error retrieving credentials from Kubernetes: {e}")
         return None
 
+
 def get_rabbitmq_credentials(prefer_vault: bool = True) -> Optional[RabbitMQCredentials]:
     """
     Get RabbitMQ credentials with fallback mechanism
@@ -460,6 +453,150 @@ def get_rabbitmq_credentials(prefer_vault: bool = True) -> Optional[RabbitMQCred
         logger.warning("Kubernetes credential retrieval failed, trying Vault fallback")
         return get_rabbitmq_credentials_from_vault()
 
+class CredentialProvider:
+    """
+    Process-wide cache of resolved RabbitMQ credentials
+    
+    Renews ahead of lease expiry, re-resolves when the Vault injector or CSI
+    files change, rate limits forced refreshes during reconnect storms and
+    notifies subscribers when the credentials rotate.
+    """
+    
+    def __init__(self,
+                 resolver: Callable[[], Optional[RabbitMQCredentials]],
+                 ttl: float = 300,
+                 renew_ahead: float = 60,
+                 min_refresh_interval: float = 10,
+                 watch_paths: List[str] = None,
+                 background: bool = True):
+        """
+        Initialize the credential provider (credentials are resolved lazily)
+        
+        Args:
+            resolver: Resolves credentials from the configured sources
+            ttl: Seconds to trust credentials that carry no lease
+            renew_ahead: Seconds before expiry at which credentials are renewed
+            min_refresh_interval: Minimum seconds between two resolutions
+            watch_paths: Secret files or directories whose changes trigger a refresh
+            background: Renew in a daemon thread so callers never wait on Vault
+        """
+        self.resolver = resolver
+        self.ttl = ttl
+        self.renew_ahead = renew_ahead
+        self.min_refresh_interval = min_refresh_interval
+        self.watch_paths = watch_paths or []
+        self.background = background
+        
+        self._credentials = None
+        self._renew_at = 0.0
+        self._last_resolve = 0.0
+        self._files_signature = None
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._thread = None
+    
+    def _watch_signature(self) -> Tuple:
+        """mtimes of the watched secret files; cheap enough to check on every get"""
+        signature = []
+        for path in self.watch_paths:
+            try:
+                if os.path.isdir(path):
+                    for name in sorted(os.listdir(path)):
+                        if not name.startswith('.'):
+                            signature.append((name, os.stat(os.path.join(path, name)).st_mtime_ns))
+                elif os.path.exists(path):
+                    signature.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                continue
+        return tuple(signature)
+    
+    def _needs_refresh(self) -> bool:
+        if self._credentials is None or time.time() >= self._renew_at:
+            return True
+        return self._watch_signature() != self._files_signature
+    
+    def get(self, force: bool = False) -> Optional[RabbitMQCredentials]:
+        """
+        Get current credentials, resolving them only when needed
+        
+        Args:
+            force: Re-resolve even if the cache is fresh (e.g. after an auth failure);
+                still limited to one resolution per min_refresh_interval
+            
+        Returns:
+            RabbitMQCredentials object or None if no source is available
+        """
+        self._ensure_background()
+        if not force and not self._needs_refresh():
+            return self._credentials
+        with self._lock:
+            # Another caller refreshed while we waited for the lock
+            if time.time() - self._last_resolve < self.min_refresh_interval and self._credentials:
+                return self._credentials
+            if not force and not self._needs_refresh():
+                return self._credentials
+            self._resolve()
+            return self._credentials
+    
+    def _resolve(self):
+        self._last_resolve = time.time()
+        signature = self._watch_signature()
+        try:
+            credentials = self.resolver()
+        except Exception as e:
+            logger.error(f"Credential resolution failed: {e}")
+            credentials = None
+        
+        now = time.time()
+        if credentials is None:
+            # Keep serving the previous credentials and retry soon
+            self._renew_at = now + self.min_refresh_interval
+            return
+        
+        expires_at = credentials.expires_at or now + self.ttl
+        self._renew_at = max(expires_at - self.renew_ahead, now + self.min_refresh_interval)
+        self._files_signature = signature
+        
+        previous = self._credentials
+        self._credentials = credentials
+        if previous and (previous.username, previous.password) != (credentials.username, credentials.password):
+            logger.info(f"RabbitMQ credentials rotated (source: {credentials.source})")
+            for callback in list(self._subscribers):
+                try:
+                    callback(previous, credentials)
+                except Exception as e:
+                    logger.error(f"Credential rotation subscriber failed: {e}")
+    
+    def subscribe(self, callback: Callable[[RabbitMQCredentials, RabbitMQCredentials], None]) -> Callable[[], None]:
+        """
+        Register a callback invoked with (old, new) when credentials rotate
+        
+        Returns:
+            Function that removes the subscription
+        """
+        self._subscribers.append(callback)
+        
+        def unsubscribe():
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+        return unsubscribe
+    
+    def _ensure_background(self):
+        if not self.background or (self._thread and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._renew_loop, name="credential-renewal", daemon=True)
+            self._thread.start()
+    
+    def _renew_loop(self):
+        while True:
+            time.sleep(max(min(self._renew_at - time.time(), 30), 1))
+            if self._needs_refresh():
+                with self._lock:
+                    self._resolve()
+
 # Example usage and testing functions
 def test_vault_connectivity():
     """Test Vault connectivity and configuration"""
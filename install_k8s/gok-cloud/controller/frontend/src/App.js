@@ -37,6 +37,20 @@ function App() {
     }
   };
 
+  const cancelBatch = async () => {
+    const res = await fetch(`${API_URL}/cancel-command-batch`, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json"
+      },
+      body: JSON.stringify({ batch_id: batchId }),
+    });
+    if (!res.ok) {
+      const data = await res.json();
+      alert(data.error || "Failed to cancel commands");
+    }
+  };
+
   const connectSocket = (batch_id) => {
     if (socketRef.current) socketRef.current.disconnect();
     const socket = io(API_URL, {
@@ -48,6 +62,14 @@ function App() {
       socket.emit("join", { batch_id });
     });
     socket.on("result", (msg) => setResults((prev) => [...prev, msg]));
+    socket.on("command_status", (msg) => setResults((prev) => [...prev, {
+      command_id: msg.command_id,
+      output: `[${msg.status}${msg.exit_code != null ? `, exit code ${msg.exit_code}` : ""}${msg.duration != null ? `, ${msg.duration}s` : ""}]`
+    }]));
+    socket.on("batch_status", (msg) => setResults((prev) => [...prev, {
+      command_id: "all",
+      output: `[batch ${msg.status}: ${msg.succeeded}/${msg.commands} succeeded]`
+    }]));
     socket.on("disconnect", () => setConnected(false));
   };
 
@@ -67,7 +89,8 @@ function App() {
           placeholder="Enter one command per line"
         />
         <br />
-        <button onClick={sendCommands} disabled={!commands.trim()}>Send</button>
+        <button onClick={sendCommands} disabled={!commands.trim()}>Send</button>{" "}
+        <button onClick={cancelBatch} disabled={!batchId}>Cancel</button>
         <div>
           <strong>Batch ID:</strong> {batchId}<br />
           <strong>Socket Connected:</strong> {connected ? "Yes" : "No"}
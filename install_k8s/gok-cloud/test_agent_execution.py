@@ -0,0 +1,710 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the GOK agent execution pipeline
+Covers the pure-Python building blocks that do not need RabbitMQ or Vault
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+# Add the agent directory to Python path to import agent modules
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, 'agent'))
+
+from batch_executor import BatchExecutor, ThreadSafeChannel, parse_group_limits
+from shell_sessions import ShellSession, ShellSessionPool, ShellSessionError
+from result_coalescer import ResultCoalescer
+import batch_message
+from batch_message import (BatchMessage, BatchStatus, Command, CommandStatus, ResultMessage, CONTENT_TYPE_COMPACT, CONTENT_TYPE_JSON,
+                           decode_batch, decode_result, encode)
+from async_agent import AsyncAgent
+from command_control import CommandRegistry, batch_record, parse_control_message
+from dedupe_index import DedupeIndex
+from fair_scheduler import AsyncFairSlots, FairScheduler
+
+
+class TestGroupLimits(unittest.TestCase):
+    """Test cases for per-group concurrency spec parsing"""
+
+    def test_parse_group_limits(self):
+        limits = parse_group_limits("developers=2, administrators=8")
+        self.assertEqual(limits, {"developers": 2, "administrators": 8})
+
+    def test_parse_group_limits_ignores_malformed(self):
+        limits = parse_group_limits("developers,admins=x,ops=0,,qa=3")
+        self.assertEqual(limits, {"qa": 3})
+
+    def test_parse_group_limits_empty(self):
+        self.assertEqual(parse_group_limits(None), {})
+        self.assertEqual(parse_group_limits(""), {})
+
+
+class TestBatchExecutor(unittest.TestCase):
+    """Test cases for the concurrent batch executor"""
+
+    def setUp(self):
+        self.executor = BatchExecutor(max_batches=4, max_commands=4, group_limits={"developers": 1})
+
+    def tearDown(self):
+        self.executor.shutdown(wait=True)
+
+    def test_commands_in_batch_run_in_order(self):
+        seen = []
+        done = threading.Event()
+        commands = [{"command": f"echo {i}", "command_id": i} for i in range(5)]
+
+        self.executor.submit("batch-1", "administrators", commands,
+                             run_command=lambda cmd: seen.append(cmd["command_id"]),
+                             on_done=done.set)
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(seen, [0, 1, 2, 3, 4])
+
+    def test_batches_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        done = [threading.Event(), threading.Event()]
+
+        for i in range(2):
+            self.executor.submit(f"batch-{i}", "administrators", [{"command": "wait", "command_id": 0}],
+                                 run_command=lambda cmd: barrier.wait(),
+                                 on_done=done[i].set)
+
+        self.assertTrue(all(event.wait(5) for event in done))
+
+    def test_group_limit_is_enforced(self):
+        active = []
+        peak = []
+        lock = threading.Lock()
+        done = [threading.Event() for _ in range(3)]
+
+        def run(cmd):
+            with lock:
+                active.append(cmd)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(cmd)
+
+        for i in range(3):
+            self.executor.submit(f"batch-{i}", "developers", [{"command": "ls", "command_id": i}],
+                                 run_command=run, on_done=done[i].set)
+
+        self.assertTrue(all(event.wait(5) for event in done))
+        self.assertEqual(max(peak), 1)
+
+    def test_waiting_batches_start_by_priority_then_fair_share(self):
+        executor = BatchExecutor(max_batches=1, max_commands=1)
+        started, release = threading.Event(), threading.Event()
+        order = []
+        done = threading.Event()
+
+        def block(cmd):
+            started.set()
+            release.wait(5)
+
+        executor.submit("busy", "administrators", [{"command_id": 0}], run_command=block,
+                        on_done=lambda: None, owner="u1")
+        self.assertTrue(started.wait(5))
+        for batch_id, owner, priority in (("u1-a", "u1", 0), ("u1-b", "u1", 0), ("u2-a", "u2", 0), ("u3-a", "u3", 9)):
+            executor.submit(batch_id, "administrators", [{"command_id": 0}],
+                            run_command=lambda cmd, b=batch_id: order.append(b),
+                            on_done=done.set if batch_id == "u1-b" else (lambda: None),
+                            owner=owner, priority=priority)
+        self.assertEqual(executor.waiting, 4)
+        release.set()
+        self.assertTrue(done.wait(5))
+        executor.shutdown(wait=True)
+        # u1 was served last (the busy batch), so u2 goes before u1
+        self.assertEqual(order, ["u3-a", "u2-a", "u1-a", "u1-b"])
+
+    def test_on_done_called_when_command_fails(self):
+        done = threading.Event()
+
+        def fail(cmd):
+            raise RuntimeError("boom")
+
+        self.executor.submit("batch-err", "administrators", [{"command": "x", "command_id": 0}],
+                             run_command=fail, on_done=done.set)
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self.executor.in_flight, 0)
+
+
+class TestThreadSafeChannel(unittest.TestCase):
+    """Test cases for the connection-thread channel proxy"""
+
+    def test_operations_are_scheduled_on_connection(self):
+        connection = MagicMock()
+        channel = MagicMock()
+        proxy = ThreadSafeChannel(connection, channel)
+
+        proxy.basic_publish(exchange='', routing_key='results', body='{}')
+        proxy.basic_ack(delivery_tag=7)
+
+        self.assertEqual(connection.add_callback_threadsafe.call_count, 2)
+        channel.basic_publish.assert_not_called()
+        for call in connection.add_callback_threadsafe.call_args_list:
+            call[0][0]()
+        channel.basic_publish.assert_called_once_with(exchange='', routing_key='results', body='{}')
+        channel.basic_ack.assert_called_once_with(delivery_tag=7, multiple=False)
+
+    def test_closed_connection_is_reported(self):
+        connection = MagicMock()
+        connection.add_callback_threadsafe.side_effect = RuntimeError("closed")
+        proxy = ThreadSafeChannel(connection, MagicMock())
+
+        self.assertFalse(proxy.basic_ack(delivery_tag=1))
+
+    def test_run_defers_operation_and_bookkeeping_to_connection(self):
+        connection = MagicMock()
+        channel = MagicMock()
+        done = []
+
+        def ack(ch):
+            ch.basic_ack(delivery_tag=3)
+            done.append("counted")
+
+        self.assertTrue(ThreadSafeChannel.run(ThreadSafeChannel(connection, channel), "basic_ack", ack))
+        self.assertEqual(done, [])
+        connection.add_callback_threadsafe.call_args[0][0]()
+        channel.basic_ack.assert_called_once_with(delivery_tag=3)
+        self.assertEqual(done, ["counted"])
+
+        # A plain channel runs the operation right away
+        ThreadSafeChannel.run(channel, "basic_ack", ack)
+        self.assertEqual(done, ["counted", "counted"])
+
+
+@unittest.skipUnless(os.path.exists('/bin/bash'), "bash not available")
+class TestShellSessions(unittest.TestCase):
+    """Test cases for persistent pre-sourced shell sessions"""
+
+    def setUp(self):
+        self.pool = ShellSessionPool(
+            argv=['/bin/bash', '--noprofile', '--norc'],
+            setup=['export GOK_SESSION_TEST=sourced', 'greet() { echo "hello $1"; }'],
+            size=2,
+            max_commands=3
+        )
+
+    def tearDown(self):
+        self.pool.close()
+
+    def run_in_pool(self, command):
+        lines = []
+        with self.pool.session() as shell:
+            returncode = shell.run(command, lines.append)
+        return returncode, lines
+
+    def test_setup_is_sourced_once(self):
+        returncode, lines = self.run_in_pool('greet world; echo $GOK_SESSION_TEST')
+        self.assertEqual(returncode, 0)
+        self.assertEqual(lines, ['hello world\n', 'sourced\n'])
+
+    def test_exit_code_and_stderr(self):
+        returncode, lines = self.run_in_pool('echo oops >&2; exit 3')
+        self.assertEqual(returncode, 3)
+        self.assertEqual(lines, ['oops\n'])
+
+    def test_output_without_trailing_newline(self):
+        returncode, lines = self.run_in_pool("printf 'partial'")
+        self.assertEqual(returncode, 0)
+        self.assertEqual(lines, ['partial'])
+
+    def test_state_does_not_leak_between_commands(self):
+        self.run_in_pool('cd /tmp; export LEAK=1')
+        returncode, lines = self.run_in_pool('echo "${LEAK:-clean}"')
+        self.assertEqual(lines, ['clean\n'])
+
+    def test_session_is_reused_and_recycled(self):
+        pids = []
+        for _ in range(4):
+            with self.pool.session() as shell:
+                pids.append(shell.proc.pid)
+                shell.run('true', lambda line: None)
+        self.assertEqual(len(set(pids[:3])), 1)
+        self.assertNotEqual(pids[3], pids[0])
+
+    def test_crashed_session_is_replaced(self):
+        with self.assertRaises(ShellSessionError):
+            with self.pool.session() as shell:
+                shell.run('kill -9 $$', lambda line: None)
+        returncode, lines = self.run_in_pool('echo alive')
+        self.assertEqual(lines, ['alive\n'])
+
+    def test_kill_stops_running_command(self):
+        start = time.monotonic()
+        with self.assertRaises(ShellSessionError):
+            with self.pool.session() as shell:
+                threading.Timer(0.2, shell.kill).start()
+                shell.run('sleep 30', lambda line: None)
+        self.assertLess(time.monotonic() - start, 5)
+        returncode, lines = self.run_in_pool('echo alive')
+        self.assertEqual(lines, ['alive\n'])
+
+    def test_failed_setup_raises(self):
+        session = ShellSession(['/bin/bash', '--noprofile', '--norc'], setup=['exit 1'])
+        with self.assertRaises(ShellSessionError):
+            session.start()
+
+
+class TestResultCoalescer(unittest.TestCase):
+    """Test cases for batched result publishing"""
+
+    def setUp(self):
+        self.published = []
+        self.coalescer = ResultCoalescer(
+            publish=lambda target, msg: self.published.append((target, msg)),
+            max_lines=3,
+            max_bytes=1024,
+            max_delay=60
+        )
+
+    def test_flush_on_line_count(self):
+        for i in range(7):
+            self.coalescer.add('ch', 'b1', 0, f"line {i}\n")
+
+        self.assertEqual(len(self.published), 2)
+        self.assertEqual(self.published[0][1]['output'], "line 0\nline 1\nline 2\n")
+        self.assertEqual([msg['seq'] for _, msg in self.published], [0, 1])
+
+        self.coalescer.flush('b1', 0, final=True)
+        self.assertEqual(self.published[2][1]['output'], "line 6\n")
+        self.assertEqual(self.published[2][1]['seq'], 2)
+        self.assertEqual(self.published[2][1]['lines'], 1)
+
+    def test_flush_on_size(self):
+        self.coalescer.add('ch', 'b1', 0, "x" * 2048)
+        self.assertEqual(len(self.published), 1)
+
+    def test_streams_are_independent(self):
+        self.coalescer.add('ch', 'b1', 0, "a\n")
+        self.coalescer.add('ch', 'b1', 1, "b\n")
+        self.coalescer.flush('b1', 1, final=True)
+
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(self.published[0][1]['command_id'], 1)
+
+    def test_final_flush_resets_sequence(self):
+        self.coalescer.add('ch', 'b1', 0, "a\n")
+        self.coalescer.flush('b1', 0, final=True)
+        self.coalescer.add('ch', 'b1', 0, "b\n")
+        self.coalescer.flush('b1', 0, final=True)
+
+        self.assertEqual([msg['seq'] for _, msg in self.published], [0, 0])
+
+    def test_background_flush_bounds_latency(self):
+        published = threading.Event()
+        coalescer = ResultCoalescer(publish=lambda target, msg: published.set(),
+                                    max_lines=100, max_delay=0.05, background=True)
+        try:
+            coalescer.add('ch', 'b1', 0, "first line\n")
+            self.assertTrue(published.wait(2))
+        finally:
+            coalescer.close()
+
+
+class TestBatchMessage(unittest.TestCase):
+    """Test cases for the JSON and compact message wire formats"""
+
+    def make_batch(self):
+        return BatchMessage([Command("ls", 0), Command("uptime", 1)], "id-token", "b1",
+                            {"sub": "u1", "groups": ["developers"]}, CONTENT_TYPE_COMPACT)
+
+    def test_json_keeps_legacy_shape(self):
+        body, content_type, encoding = encode(self.make_batch())
+        self.assertEqual((content_type, encoding), (CONTENT_TYPE_JSON, None))
+
+        msg = json.loads(body)
+        self.assertEqual(msg["user_info"]["id_token"], "id-token")
+        self.assertEqual(msg["commands"][1], {"command": "uptime", "command_id": 1})
+
+        # Old producers send JSON without a content type
+        batch = decode_batch(body)
+        self.assertEqual(batch.token, "id-token")
+        self.assertEqual(batch.user_info, {"sub": "u1", "groups": ["developers"]})
+
+    @unittest.skipUnless(batch_message.msgpack, "msgpack not available")
+    def test_compact_round_trip(self):
+        batch = self.make_batch()
+        body, content_type, encoding = encode(batch, CONTENT_TYPE_COMPACT)
+        self.assertEqual(content_type, CONTENT_TYPE_COMPACT)
+        self.assertLess(len(body), len(encode(batch)[0]))
+        self.assertEqual(decode_batch(body, content_type, encoding), batch)
+
+    @unittest.skipUnless(batch_message.msgpack, "msgpack not available")
+    def test_large_output_is_compressed(self):
+        result = ResultMessage("b1", 0, "line of output\n" * 2000, seq=3, lines=2000)
+        body, content_type, encoding = encode(result, CONTENT_TYPE_COMPACT)
+
+        self.assertEqual(encoding, "deflate")
+        self.assertLess(len(body), 2000)
+        self.assertEqual(decode_result(body, content_type, encoding), result)
+
+    def test_missing_msgpack_falls_back_to_json(self):
+        original = batch_message.msgpack
+        batch_message.msgpack = None
+        try:
+            body, content_type, _ = encode(ResultMessage("b1", 0, "x"), CONTENT_TYPE_COMPACT)
+        finally:
+            batch_message.msgpack = original
+        self.assertEqual(content_type, CONTENT_TYPE_JSON)
+        self.assertEqual(decode_result(body, content_type).to_dict(),
+                         {"batch_id": "b1", "command_id": 0, "output": "x"})
+
+    def test_status_round_trip(self):
+        statuses = [
+            CommandStatus("b1", 2, "timeout", -9, 12.5, 1700000000.0, 1700000012.5, 0.2, 0.004, 1024, 10, 5120),
+            BatchStatus("b1", "failed", 3, 2, 1, 1700000000.0, 1700000012.5, 0.1),
+        ]
+        for status in statuses:
+            for content_type in (CONTENT_TYPE_JSON, CONTENT_TYPE_COMPACT):
+                body, content_type, encoding = encode(status, content_type)
+                self.assertEqual(decode_result(body, content_type, encoding), status)
+
+
+class RecordingAsyncAgent(AsyncAgent):
+    """AsyncAgent that runs commands with /bin/sh and records results instead of publishing"""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("max_delay", 0.05)
+        super().__init__(
+            credentials_factory=None,
+            parse_batch=lambda body, properties: decode_batch(body),
+            authorize=lambda token: "developers" if token == "good" else None,
+            command_allowed=lambda group, command: not command.startswith("rm"),
+            argv_for=lambda command: ["/bin/sh", "-c", command],
+            result_route=lambda batch: "results",
+            **kwargs
+        )
+        self.results = []
+        self.statuses = []
+
+    async def _publish(self, batch, result):
+        if isinstance(result, (CommandStatus, BatchStatus)):
+            self.statuses.append(result)
+        else:
+            self.results.append(result)
+
+
+class TestAsyncAgent(unittest.TestCase):
+    """Test cases for the asyncio execution mode"""
+
+    def batch(self, *commands, token="good", batch_id="b1"):
+        return BatchMessage([Command(c, i) for i, c in enumerate(commands)], token, batch_id)
+
+    def test_output_coalesced_with_exit_code(self):
+        agent = RecordingAsyncAgent()
+        record = asyncio.run(agent.run_command(self.batch(), "echo a; echo b; echo c; exit 3", 0, "developers"))
+        self.assertEqual(record.exit_code, 3)
+        self.assertEqual((record.output_lines, record.output_bytes), (3, 6))
+        self.assertIsNotNone(record.spawn_latency)
+        self.assertEqual(len(agent.results), 1)
+        self.assertEqual(agent.results[0].output, "a\nb\nc\n")
+        self.assertEqual((agent.results[0].seq, agent.results[0].lines), (0, 3))
+        self.assertEqual((agent.statuses[0].status, agent.statuses[0].exit_code), ("failed", 3))
+
+    def test_quiet_command_flushes_after_delay(self):
+        agent = RecordingAsyncAgent(max_delay=0.05)
+        asyncio.run(agent.run_command(self.batch(), "echo a; sleep 0.3; echo b", 0, "developers"))
+        self.assertEqual([r.output for r in agent.results], ["a\n", "b\n"])
+        self.assertEqual([r.seq for r in agent.results], [0, 1])
+
+    def test_line_longer_than_stream_limit_is_kept(self):
+        agent = RecordingAsyncAgent()
+
+        async def pump():
+            reader = asyncio.StreamReader(limit=16)
+            reader.feed_data(b"A" * 40 + b"\nok\n")
+            reader.feed_eof()
+            await agent._pump(self.batch(), 0, reader)
+
+        asyncio.run(pump())
+        self.assertEqual("".join(r.output for r in agent.results), "A" * 40 + "\nok\n")
+
+    def test_denied_command_is_reported(self):
+        agent = RecordingAsyncAgent()
+        record = asyncio.run(agent.run_command(self.batch(), "rm -rf /tmp/x", 0, "developers"))
+        self.assertIsNone(record.exit_code)
+        self.assertIn("not allowed", agent.results[0].output)
+        self.assertEqual(agent.statuses[0].status, "denied")
+
+    def test_batch_runs_in_order_and_acks_once(self):
+        agent = RecordingAsyncAgent()
+        message = MagicMock(ack=AsyncMock())
+        asyncio.run(agent.run_batch(message, self.batch("echo one", "echo two")))
+        self.assertEqual([(r.command_id, r.output) for r in agent.results], [(0, "one\n"), (1, "two\n")])
+        message.ack.assert_awaited_once()
+        batch_status = agent.statuses[-1]
+        self.assertEqual((batch_status.status, batch_status.commands, batch_status.succeeded), ("succeeded", 2, 2))
+
+    def test_redelivered_batch_does_not_rerun_commands(self):
+        agent = RecordingAsyncAgent()
+        for _ in range(2):
+            asyncio.run(agent.run_batch(MagicMock(ack=AsyncMock()), self.batch("echo once")))
+        self.assertEqual([r.output for r in agent.results], ["once\n"])
+        replayed = [s for s in agent.statuses if isinstance(s, CommandStatus)]
+        self.assertEqual(len(replayed), 2)
+        self.assertIs(replayed[0], replayed[1])
+
+    def test_unauthorized_batch_is_acked_without_running(self):
+        agent = RecordingAsyncAgent()
+        message = MagicMock(ack=AsyncMock())
+        asyncio.run(agent.run_batch(message, self.batch("echo one", token="bad")))
+        self.assertEqual(agent.results, [])
+        self.assertEqual(agent.statuses[0].status, "unauthorized")
+        message.ack.assert_awaited_once()
+
+    def test_batches_run_concurrently(self):
+        agent = RecordingAsyncAgent()
+
+        async def run_two():
+            messages = [MagicMock(ack=AsyncMock()), MagicMock(ack=AsyncMock())]
+            await asyncio.gather(*(agent.run_batch(m, self.batch("sleep 0.5", batch_id=str(i)))
+                                   for i, m in enumerate(messages)))
+
+        start = time.monotonic()
+        asyncio.run(run_two())
+        self.assertLess(time.monotonic() - start, 0.9)
+
+    def test_cancelled_batch_kills_command_and_is_not_acked(self):
+        agent = RecordingAsyncAgent()
+        message = MagicMock(ack=AsyncMock())
+
+        async def cancel_midway():
+            task = asyncio.create_task(agent.run_batch(message, self.batch("sleep 30")))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        start = time.monotonic()
+        asyncio.run(cancel_midway())
+        self.assertLess(time.monotonic() - start, 5)
+        message.ack.assert_not_awaited()
+
+    def test_timeout_kills_command(self):
+        agent = RecordingAsyncAgent(registry=CommandRegistry(timeout=0.3, interval=0.05))
+        start = time.monotonic()
+        record = asyncio.run(agent.run_command(self.batch(), "echo started; sleep 30", 0, "developers"))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertNotEqual(record.exit_code, 0)
+        self.assertEqual(agent.statuses[0].status, "timeout")
+        self.assertEqual(agent.results[0].output, "started\n")
+
+    def test_output_limit_stops_command(self):
+        agent = RecordingAsyncAgent(registry=CommandRegistry(max_output=100))
+        asyncio.run(agent.run_command(self.batch(), "while true; do echo 0123456789; done", 0, "developers"))
+        self.assertEqual(agent.statuses[0].status, "output_limit")
+        self.assertLessEqual(sum(len(r.output) for r in agent.results), 100)
+
+    def test_control_cancel_stops_running_command(self):
+        registry = CommandRegistry()
+        agent = RecordingAsyncAgent(registry=registry)
+        batch = BatchMessage([Command("sleep 30", 0)], "good", "b1", {"sub": "u1"})
+
+        async def cancel_midway():
+            task = asyncio.create_task(agent.run_command(batch, "sleep 30", 0, "developers"))
+            await asyncio.sleep(0.2)
+            # Other users cannot cancel the batch
+            self.assertEqual(registry.cancel("b1", sub="u2"), 0)
+            await agent._on_control(MagicMock(body=json.dumps({"action": "cancel", "batch_id": "b1", "sub": "u1"})))
+            return await task
+
+        asyncio.run(cancel_midway())
+        self.assertEqual(agent.statuses[0].status, "cancelled")
+
+
+class TestFairScheduler(unittest.TestCase):
+    """Test cases for priority and fair-share slot scheduling"""
+
+    def test_owner_with_fewest_running_goes_first(self):
+        scheduler = FairScheduler()
+        scheduler.started("u1")
+        for item in ("u1-a", "u1-b"):
+            scheduler.push("u1", 0, item)
+        scheduler.push("u2", 0, "u2-a")
+        self.assertEqual(scheduler.pop(), ("u2", "u2-a"))
+        self.assertEqual(scheduler.pop(), ("u1", "u1-a"))
+        self.assertEqual(scheduler.running("u1"), 2)
+        scheduler.finished("u1")
+        self.assertEqual(scheduler.running("u1"), 1)
+        self.assertEqual(scheduler.pop(), ("u1", "u1-b"))
+        self.assertIsNone(scheduler.pop())
+
+    def test_priority_wins_within_and_across_owners(self):
+        scheduler = FairScheduler()
+        scheduler.push("u1", 1, "low")
+        scheduler.push("u1", 5, "high")
+        scheduler.push("u2", 3, "mid")
+        self.assertEqual([scheduler.pop()[1] for _ in range(3)], ["high", "mid", "low"])
+
+    def test_async_slots_are_shared_fairly(self):
+        order = []
+
+        async def scenario():
+            slots = AsyncFairSlots(1)
+
+            async def worker(owner, name, hold=0.0):
+                await slots.acquire(owner)
+                order.append(name)
+                await asyncio.sleep(hold)
+                slots.release(owner)
+
+            first = asyncio.create_task(worker("u1", "u1-a", 0.05))
+            await asyncio.sleep(0)
+            waiting = [asyncio.create_task(worker("u1", "u1-b")), asyncio.create_task(worker("u1", "u1-c"))]
+            cancelled = asyncio.create_task(worker("u3", "u3-a"))
+            waiting.append(asyncio.create_task(worker("u2", "u2-a")))
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+            await asyncio.gather(first, *waiting)
+            self.assertEqual(slots.waiting, 0)
+
+        asyncio.run(scenario())
+        self.assertEqual(order, ["u1-a", "u2-a", "u1-b", "u1-c"])
+
+
+class TestDedupeIndex(unittest.TestCase):
+    """Test cases for redelivery duplicate suppression"""
+
+    def test_completed_command_is_replayed(self):
+        index = DedupeIndex()
+        run = MagicMock(return_value=CommandStatus("b1", 0, "succeeded", 0))
+        first = index.run_once("b1", 0, run)
+        second = index.run_once("b1", 0, run)
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual((first[1], second[1]), (False, True))
+        self.assertIs(first[0], second[0])
+        self.assertEqual(index.run_once("b1", 1, run)[1], False)
+
+    def test_failed_run_releases_claim(self):
+        index = DedupeIndex()
+        with self.assertRaises(RuntimeError):
+            index.run_once("b1", 0, MagicMock(side_effect=RuntimeError("boom")))
+        record, duplicate = index.run_once("b1", 0, lambda: CommandStatus("b1", 0, "succeeded", 0))
+        self.assertFalse(duplicate)
+
+    def test_duplicate_waits_for_running_command(self):
+        index = DedupeIndex()
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return CommandStatus("b1", 0, "succeeded", 0)
+
+        worker = threading.Thread(target=index.run_once, args=("b1", 0, slow))
+        worker.start()
+        started.wait(5)
+        with self.assertRaises(TimeoutError):
+            index.run_once("b1", 0, slow, timeout=0.05)
+        release.set()
+        record, duplicate = index.run_once("b1", 0, slow, timeout=5)
+        worker.join()
+        self.assertTrue(duplicate)
+        self.assertEqual(record.status, "succeeded")
+
+    def test_redelivered_batch_is_parked_until_release(self):
+        index = DedupeIndex()
+        resumed = []
+        self.assertTrue(index.claim_batch("b1", lambda: resumed.append("first")))
+        self.assertFalse(index.claim_batch("b1", lambda: resumed.append("redelivery")))
+        self.assertTrue(index.claim_batch("b2", lambda: None))
+        self.assertEqual(resumed, [])
+        index.release_batch("b1")
+        self.assertEqual(resumed, ["redelivery"])
+        # The resumed delivery owns the batch now
+        self.assertTrue(index.claim_batch("b1", lambda: None))
+
+    def test_entries_are_bounded_and_expire(self):
+        index = DedupeIndex(max_entries=2, ttl=0.05)
+        for command_id in range(3):
+            index.run_once("b1", command_id, lambda: CommandStatus("b1", command_id, "succeeded", 0))
+        index.claim("b2", 0)
+        # The oldest completed entry is dropped; running claims are kept
+        self.assertEqual(len(index), 3)
+        time.sleep(0.1)
+        self.assertIsNone(index.claim("b1", 2))
+        self.assertIsNotNone(index.claim("b2", 0))
+
+
+class TestCommandRegistry(unittest.TestCase):
+    """Test cases for command cancellation and limits"""
+
+    def test_cancel_before_start_skips_command(self):
+        registry = CommandRegistry()
+        registry.cancel("b1", sub="u1")
+        self.assertEqual(registry.start("b1", 0, "u1").stop_reason, "cancelled")
+        self.assertIsNone(registry.start("b1", 0, "u2").stop_reason)
+        self.assertIsNone(registry.start("b2", 0, "u1").stop_reason)
+
+    def test_cancel_single_command(self):
+        registry = CommandRegistry()
+        first, second = registry.start("b1", 0, "u1"), registry.start("b1", 1, "u1")
+        kill = MagicMock()
+        second.attach(kill)
+        self.assertEqual(registry.cancel("b1", 1, sub="u1"), 1)
+        kill.assert_called_once()
+        self.assertIsNone(first.stop_reason)
+        self.assertEqual(second.status(-9), "cancelled")
+
+    def test_admin_cancels_any_batch(self):
+        registry = CommandRegistry()
+        handle = registry.start("b1", 0, "u1")
+        self.assertEqual(registry.cancel("b1", sub="admin", admin=True), 1)
+        self.assertEqual(handle.stop_reason, "cancelled")
+
+    def test_attach_after_stop_kills_immediately(self):
+        handle = CommandRegistry().start("b1", 0)
+        handle.stop("cancelled")
+        kill = MagicMock()
+        handle.attach(kill)
+        kill.assert_called_once()
+
+    def test_watchdog_times_out(self):
+        registry = CommandRegistry(timeout=0.1, interval=0.02)
+        handle = registry.start("b1", 0)
+        time.sleep(0.3)
+        self.assertEqual(handle.stop_reason, "timeout")
+        registry.close()
+
+    def test_cancels_are_bounded(self):
+        registry = CommandRegistry(max_cancels=2)
+        for batch_id in ("b1", "b2", "b3"):
+            registry.cancel(batch_id, sub="u1")
+        self.assertFalse(registry.is_cancelled("b1", owner="u1"))
+        self.assertTrue(registry.is_cancelled("b3", owner="u1"))
+
+    def test_record_and_batch_record(self):
+        registry = CommandRegistry()
+        published_at = time.time() - 2
+        ok, failed = registry.start("b1", 0), registry.start("b1", 1)
+        ok.attach(lambda: None)
+        ok.count_output(5)
+        records = [ok.record("succeeded", 0, published_at), failed.record("failed", 1)]
+        self.assertEqual((records[0].output_bytes, records[0].output_lines), (5, 1))
+        self.assertGreaterEqual(records[0].queue_wait, 2)
+        self.assertIsNone(records[1].queue_wait)
+
+        batch = batch_record("b1", records, time.time() - 1, published_at)
+        self.assertEqual((batch.status, batch.commands, batch.succeeded, batch.failed), ("failed", 2, 1, 1))
+        self.assertGreaterEqual(batch.ended_at, batch.started_at)
+
+    def test_parse_control_message(self):
+        msg = parse_control_message(b'{"action": "cancel", "batch_id": "b1", "command_id": 2}')
+        self.assertEqual((msg["batch_id"], msg["command_id"]), ("b1", 2))
+        with self.assertRaises(ValueError):
+            parse_control_message(b'{"action": "pause", "batch_id": "b1"}')
+        with self.assertRaises(ValueError):
+            parse_control_message(b'not json')
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the shared OIDC verification caches
+Uses locally generated RSA keys and a mocked JWKS endpoint
+"""
+
+import os
+import sys
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+# Add the agent directory to Python path to import agent modules
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, 'agent'))
+
+try:
+    import rsa
+    from jose import jwk, jwt
+    from jwks_cache import JWKSCache
+    JOSE_AVAILABLE = True
+except ImportError as e:
+    print(f"Warning: Some imports failed: {e}")
+    JOSE_AVAILABLE = False
+
+from token_cache import TokenCache
+
+ISSUER = "https://issuer.example.com/realms/test"
+JWKS_URI = f"{ISSUER}/protocol/openid-connect/certs"
+
+
+def make_key(kid):
+    """Generate an RSA key pair, returning (private PEM, public JWK dict)"""
+    _, private_key = rsa.newkeys(1024)
+    pem = private_key.save_pkcs1().decode()
+    public = jwk.construct(pem, 'RS256').public_key().to_dict()
+    public['kid'] = kid
+    return pem, public
+
+
+def make_response(body=None, status=200, headers=None):
+    response = MagicMock()
+    response.status_code = status
+    response.json.return_value = body
+    response.headers = headers or {}
+    return response
+
+
+@unittest.skipUnless(JOSE_AVAILABLE, "python-jose or rsa not available")
+class TestJWKSCache(unittest.TestCase):
+    """Test cases for the kid-indexed JWKS cache"""
+
+    def setUp(self):
+        self.pem1, self.jwk1 = make_key("k1")
+        self.pem2, self.jwk2 = make_key("k2")
+        self.jwks = {"keys": [self.jwk1]}
+        self.fetches = 0
+
+        def fake_get(url, headers=None, **kwargs):
+            if url.endswith("/.well-known/openid-configuration"):
+                return make_response({"jwks_uri": JWKS_URI})
+            self.fetches += 1
+            return make_response(self.jwks, headers={"Cache-Control": "max-age=600", "ETag": f'"{self.fetches}"'})
+
+        patcher = patch("requests.Session.get", side_effect=fake_get)
+        self.mock_get = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_cache(self, **kwargs):
+        kwargs.setdefault("background", False)
+        return JWKSCache(ISSUER, **kwargs)
+
+    def test_key_lookup_by_kid(self):
+        cache = self.make_cache()
+        token = jwt.encode({"sub": "u1", "aud": "client", "iss": ISSUER}, self.pem1,
+                           algorithm="RS256", headers={"kid": "k1"})
+
+        key = cache.get_key("k1")
+        payload = jwt.decode(token, key, algorithms=["RS256"], audience="client", issuer=ISSUER)
+
+        self.assertEqual(payload["sub"], "u1")
+        self.assertEqual(self.fetches, 1)
+
+    def test_cache_headers_set_expiry(self):
+        cache = self.make_cache()
+        self.assertAlmostEqual(cache._expires_at - time.time(), 600, delta=5)
+
+    def test_unknown_kid_triggers_refresh(self):
+        cache = self.make_cache(min_refresh_interval=0)
+        self.jwks = {"keys": [self.jwk1, self.jwk2]}
+
+        self.assertIsNotNone(cache.get_key("k2"))
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(cache.version, 2)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        cache = self.make_cache(min_refresh_interval=60)
+
+        for _ in range(5):
+            self.assertIsNone(cache.get_key("missing"))
+        self.assertEqual(self.fetches, 1)
+
+    def test_fetch_failure_keeps_previous_keys(self):
+        cache = self.make_cache(min_refresh_interval=0)
+        self.mock_get.side_effect = Exception("issuer down")
+
+        self.assertFalse(cache.refresh(force=True))
+        self.assertIsNotNone(cache.get_key("k1"))
+
+
+class TestTokenCache(unittest.TestCase):
+    """Test cases for the verified-token LRU cache"""
+
+    def test_hit_and_miss_counters(self):
+        cache = TokenCache(max_size=10)
+        claims = {"sub": "u1", "exp": time.time() + 60}
+
+        self.assertIsNone(cache.get("token-a"))
+        cache.put("token-a", claims)
+        self.assertIs(cache.get("token-a"), claims)
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 1, 1))
+
+    def test_entry_expires_at_exp(self):
+        cache = TokenCache(max_size=10, max_ttl=300)
+        cache.put("token-a", {"sub": "u1", "exp": time.time() + 0.05})
+        time.sleep(0.1)
+
+        self.assertIsNone(cache.get("token-a"))
+
+    def test_expired_token_is_not_cached(self):
+        cache = TokenCache(max_size=10)
+        cache.put("token-a", {"sub": "u1", "exp": time.time() - 1})
+
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_lru_eviction(self):
+        cache = TokenCache(max_size=2)
+        for name in ("a", "b"):
+            cache.put(name, {"sub": name})
+        cache.get("a")
+        cache.put("c", {"sub": "c"})
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_key_rotation_clears_cache(self):
+        version = [1]
+        cache = TokenCache(max_size=10, version_source=lambda: version[0])
+        cache.put("token-a", {"sub": "u1"})
+
+        version[0] = 2
+        self.assertIsNone(cache.get("token-a"))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the GOK controller messaging pipeline
+RabbitMQ connections are mocked; no broker is required
+"""
+
+import os
+import sys
+import json
+import importlib.util
+import time
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+# Add the controller backend directory to Python path to import controller modules
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CURRENT_DIR, 'controller', 'backend'))
+
+try:
+    import pika
+    import rabbitmq_publisher
+    from rabbitmq_publisher import RabbitMQPublisher
+    import result_consumer
+    from result_consumer import ResultConsumer
+    PIKA_AVAILABLE = True
+except ImportError as e:
+    print(f"Warning: Some imports failed: {e}")
+    PIKA_AVAILABLE = False
+
+from completion_index import CompletionIndex
+
+# The agent has a metrics module of its own; load the controller's by path so test order does not matter
+_spec = importlib.util.spec_from_file_location(
+    "controller_metrics", os.path.join(CURRENT_DIR, 'controller', 'backend', 'metrics.py'))
+metrics = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(metrics)
+
+
+def make_connection():
+    connection = MagicMock()
+    connection.is_open = True
+    connection.channel.return_value.is_open = True
+    return connection
+
+
+@unittest.skipUnless(PIKA_AVAILABLE, "pika not available")
+class TestRabbitMQPublisher(unittest.TestCase):
+    """Test cases for the pooled publisher"""
+
+    def setUp(self):
+        self.parameters_factory = MagicMock(return_value="params")
+        self.publisher = RabbitMQPublisher(self.parameters_factory, pool_size=1, base_delay=0)
+
+    def test_connection_and_declare_are_reused(self):
+        connection = make_connection()
+        with patch.object(rabbitmq_publisher.pika, 'BlockingConnection', return_value=connection) as mock_conn:
+            self.publisher.publish("commands", "one")
+            self.publisher.publish("commands", "two")
+
+        channel = connection.channel.return_value
+        self.assertEqual(mock_conn.call_count, 1)
+        self.assertEqual(self.parameters_factory.call_count, 1)
+        channel.confirm_delivery.assert_called_once()
+        channel.queue_declare.assert_called_once_with(queue="commands", durable=True, arguments=None)
+        self.assertEqual(channel.basic_publish.call_count, 2)
+
+    def test_exchange_declared_once(self):
+        connection = make_connection()
+        with patch.object(rabbitmq_publisher.pika, 'BlockingConnection', return_value=connection):
+            self.publisher.publish("control.b1", "one", exchange="gok.control", exchange_type="topic")
+            self.publisher.publish("control.b2", "two", exchange="gok.control", exchange_type="topic")
+
+        channel = connection.channel.return_value
+        channel.exchange_declare.assert_called_once_with(exchange="gok.control", exchange_type="topic", durable=True)
+        channel.queue_declare.assert_not_called()
+        self.assertEqual(channel.basic_publish.call_count, 2)
+
+    def test_existing_queue_with_other_arguments_is_used(self):
+        connection = make_connection()
+        first = connection.channel.return_value
+        first.queue_declare.side_effect = [pika.exceptions.ChannelClosedByBroker(406, "PRECONDITION_FAILED"), None]
+        with patch.object(rabbitmq_publisher.pika, 'BlockingConnection', return_value=connection):
+            self.publisher.publish("commands", "body", queue_arguments={"x-max-priority": 10})
+
+        self.assertEqual(connection.channel.call_count, 2)
+        first.queue_declare.assert_called_with(queue="commands", passive=True)
+        first.basic_publish.assert_called_once()
+
+    def test_reconnects_after_connection_error(self):
+        broken = make_connection()
+        broken.channel.return_value.basic_publish.side_effect = pika.exceptions.StreamLostError("lost")
+        healthy = make_connection()
+        with patch.object(rabbitmq_publisher.pika, 'BlockingConnection', side_effect=[broken, healthy]):
+            self.publisher.publish("commands", "body")
+
+        healthy.channel.return_value.basic_publish.assert_called_once()
+        self.assertEqual(self.publisher.reconnects, 2)
+
+    def test_gives_up_after_max_retries(self):
+        broken = make_connection()
+        broken.channel.return_value.basic_publish.side_effect = pika.exceptions.StreamLostError("lost")
+        with patch.object(rabbitmq_publisher.pika, 'BlockingConnection', return_value=broken):
+            with self.assertRaises(pika.exceptions.AMQPError):
+                self.publisher.publish("commands", "body")
+
+        # The connection slot is returned to the pool even after a failure
+        self.assertEqual(self.publisher._pool.qsize(), 1)
+
+
+@unittest.skipUnless(PIKA_AVAILABLE, "pika not available")
+class TestResultConsumer(unittest.TestCase):
+    """Test cases for the push-based result consumer"""
+
+    def setUp(self):
+        self.dispatched = []
+        self.consumer = ResultConsumer(lambda: "params", self.dispatched.append, ack_batch=2, ack_interval=10)
+
+    def enqueue(self, generation, count):
+        for tag in range(1, count + 1):
+            body = json.dumps({"batch_id": "b1", "output": f"line {tag}"})
+            self.consumer._pending.put((generation, tag, body, None))
+
+    def run_dispatcher(self):
+        self.consumer._pending.put(result_consumer._STOP)
+        self.consumer._dispatch_loop()
+
+    def test_dispatch_in_order_and_multi_ack(self):
+        self.consumer._generation = 1
+        self.enqueue(1, 3)
+        self.run_dispatcher()
+
+        self.assertEqual([m["output"] for m in self.dispatched], ["line 1", "line 2", "line 3"])
+        channel = MagicMock()
+        self.consumer._ack(channel, 1, time.monotonic())
+        channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+        self.assertEqual(self.consumer.acked, 3)
+
+    def test_ack_waits_for_batch_or_interval(self):
+        self.consumer._generation = 1
+        self.enqueue(1, 1)
+        self.run_dispatcher()
+
+        channel = MagicMock()
+        self.consumer._ack(channel, 1, time.monotonic())
+        channel.basic_ack.assert_not_called()
+
+        self.consumer._ack(channel, 1, time.monotonic() - 60)
+        channel.basic_ack.assert_called_once_with(delivery_tag=1, multiple=True)
+
+    def test_stale_deliveries_are_skipped(self):
+        self.consumer._generation = 2
+        self.enqueue(1, 2)
+        self.run_dispatcher()
+
+        self.assertEqual(self.dispatched, [])
+        self.assertEqual(self.consumer._dispatched_tag, 0)
+
+    def test_consume_sets_prefetch_and_queues_deliveries(self):
+        connection = make_connection()
+        channel = connection.channel.return_value
+
+        def deliver(time_limit):
+            callback = channel.basic_consume.call_args[1]["on_message_callback"]
+            for tag in (1, 2):
+                callback(channel, MagicMock(delivery_tag=tag), None, b'{"batch_id": "b1"}')
+            self.consumer._stopping.set()
+
+        connection.process_data_events.side_effect = deliver
+        with patch.object(result_consumer.pika, 'BlockingConnection', return_value=connection):
+            self.consumer._consume_loop()
+
+        channel.basic_qos.assert_called_once_with(prefetch_count=1000)
+        self.assertEqual(self.consumer.pending, 2)
+        self.assertEqual(self.consumer.delivered, 2)
+        connection.close.assert_called_once()
+
+    def test_exchange_mode_binds_private_queue(self):
+        consumer = ResultConsumer(lambda: "params", self.dispatched.append, exchange="gok.results",
+                                  message_ttl=60000, binding_ttl=10)
+        connection = make_connection()
+        channel = connection.channel.return_value
+        channel.queue_declare.return_value.method.queue = "amq.gen-1"
+        waiter = {}
+
+        def run_once(time_limit):
+            if "thread" not in waiter:
+                waiter["thread"] = threading.Thread(
+                    target=lambda: waiter.setdefault("bound", consumer.bind("results.u1.b1", timeout=2)))
+                waiter["thread"].start()
+                time.sleep(0.1)
+                return
+            waiter["thread"].join(2)
+            consumer._stopping.set()
+
+        connection.process_data_events.side_effect = run_once
+        with patch.object(result_consumer.pika, 'BlockingConnection', return_value=connection):
+            consumer._consume_loop()
+
+        channel.exchange_declare.assert_called_once_with(exchange="gok.results", exchange_type="topic", durable=True)
+        channel.queue_declare.assert_called_once_with(queue="", exclusive=True, auto_delete=True,
+                                                      arguments={"x-message-ttl": 60000})
+        channel.queue_bind.assert_called_once_with(queue="amq.gen-1", exchange="gok.results", routing_key="results.u1.b1")
+        self.assertTrue(waiter["bound"])
+
+    def test_idle_bindings_expire(self):
+        consumer = ResultConsumer(lambda: "params", self.dispatched.append, exchange="gok.results", binding_ttl=10)
+        channel = MagicMock()
+        consumer._bindings["results.u1.b1"] = time.monotonic() - 60
+        consumer._applied = {"results.u1.b1"}
+
+        consumer._apply_bindings(channel, "amq.gen-1")
+
+        channel.queue_unbind.assert_called_once_with(queue="amq.gen-1", exchange="gok.results", routing_key="results.u1.b1")
+        self.assertEqual(consumer._bindings, {})
+        self.assertEqual(consumer._applied, set())
+
+
+class TestPipelineCollector(unittest.TestCase):
+    """Test cases for the scrape-time pipeline metrics"""
+
+    def test_collects_publisher_and_consumer_counters(self):
+        if metrics.Counter is None:
+            self.skipTest("prometheus_client not available")
+        publisher = MagicMock(reconnects=2)
+        consumer = MagicMock(delivered=5, dispatched=4, acked=3, pending=1, reconnects=1)
+        samples = {
+            (s.name, s.labels.get("connection")): s.value
+            for family in metrics.PipelineCollector(publisher, consumer).collect()
+            for s in family.samples
+        }
+        self.assertEqual(samples[("gok_controller_results_consumed_total", None)], 5)
+        self.assertEqual(samples[("gok_controller_results_acked_total", None)], 3)
+        self.assertEqual(samples[("gok_controller_results_pending", None)], 1)
+        self.assertEqual(samples[("gok_controller_rabbitmq_connects_total", "publisher")], 2)
+        self.assertEqual(samples[("gok_controller_rabbitmq_connects_total", "result_consumer")], 1)
+
+
+class TestCompletionIndex(unittest.TestCase):
+    """Test cases for the per-batch completion record index"""
+
+    def test_records_are_grouped_by_batch(self):
+        index = CompletionIndex()
+        index.register("b1", "u1", 1000.0, 2)
+        self.assertFalse(index.record({"batch_id": "b1", "command_id": 0, "output": "hi\n"}))
+        self.assertTrue(index.record({"batch_id": "b1", "command_id": 10, "status": "failed", "exit_code": 1}))
+        self.assertTrue(index.record({"batch_id": "b1", "command_id": 2, "status": "succeeded", "exit_code": 0}))
+        self.assertTrue(index.record({"batch_id": "b1", "type": "batch_status", "status": "failed",
+                                      "commands": 2, "ended_at": 1012.5}))
+
+        entry = index.get("b1")
+        self.assertEqual(entry["owner"], "u1")
+        self.assertEqual([c["command_id"] for c in entry["commands"]], [2, 10])
+        self.assertEqual(entry["batch"]["status"], "failed")
+        self.assertNotIn("type", entry["batch"])
+        self.assertEqual(entry["end_to_end"], 12.5)
+        self.assertIsNone(index.get("b2"))
+
+    def test_index_is_bounded(self):
+        index = CompletionIndex(max_batches=2)
+        for batch_id in ("b1", "b2", "b3"):
+            index.register(batch_id, "u1", time.time(), 1)
+        self.assertEqual(len(index), 2)
+        self.assertIsNone(index.get("b1"))
+
+    def test_entries_expire(self):
+        index = CompletionIndex(ttl=0.05)
+        index.register("b1", "u1", time.time(), 1)
+        time.sleep(0.1)
+        self.assertIsNone(index.get("b1"))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
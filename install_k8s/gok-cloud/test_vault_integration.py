@@ -23,10 +23,13 @@ try:
     from vault_credentials import (
         VaultCredentialManager, 
         RabbitMQCredentials,
+        CredentialProvider,
         get_rabbitmq_credentials,
         test_vault_connectivity,
         test_credential_retrieval
     )
+    from k8s_secrets import KubernetesSecretError, KubernetesSecretReader
+    from vault_client import VaultClient, VaultError, kv2_data_path
     PIKA_AVAILABLE = True
 except ImportError as e:
     print(f"Warning: Some imports failed: {e}")
@@ -66,65 +69,42 @@ class TestVaultCredentials(unittest.TestCase):
             self.assertEqual(manager.vault_token, 'env-token')
             self.assertEqual(manager.vault_path, 'secret/env/rabbitmq')
     
-    @patch('subprocess.run')
-    def test_vault_command_success(self, mock_run):
-        """Test successful vault command execution"""
-        mock_run.return_value.returncode = 0
-        mock_run.return_value.stdout = "success output"
-        mock_run.return_value.stderr = ""
-        
-        success, output = self.manager._run_vault_command(['status'])
-        
-        self.assertTrue(success)
-        self.assertEqual(output, "success output")
-        mock_run.assert_called_once()
-    
-    @patch('subprocess.run')
-    def test_vault_command_failure(self, mock_run):
-        """Test failed vault command execution"""
-        mock_run.return_value.returncode = 1
-        mock_run.return_value.stdout = ""
-        mock_run.return_value.stderr = "error output"
-        
-        success, output = self.manager._run_vault_command(['status'])
-        
-        self.assertFalse(success)
-        self.assertEqual(output, "error output")
-    
-    @patch('subprocess.run')
-    def test_vault_command_timeout(self, mock_run):
-        """Test vault command timeout"""
-        mock_run.side_effect = subprocess.TimeoutExpired(['vault'], 30)
-        
-        success, output = self.manager._run_vault_command(['status'])
-        
-        self.assertFalse(success)
-        self.assertEqual(output, "Command timeout")
-    
-    @patch.object(VaultCredentialManager, '_run_vault_command')
-    def test_check_vault_status_success(self, mock_cmd):
+    def test_check_vault_status_success(self):
         """Test successful vault status check"""
-        mock_cmd.return_value = (True, "Sealed: false")
+        self.manager.client = MagicMock()
+        self.manager.client.health.return_value = {"initialized": True, "sealed": False}
         
         result = self.manager.check_vault_status()
         
         self.assertTrue(result)
-        mock_cmd.assert_called_once_with(['status'])
+        self.manager.client.health.assert_called_once()
     
-    @patch.object(VaultCredentialManager, '_run_vault_command')
-    def test_check_vault_status_failure(self, mock_cmd):
+    def test_check_vault_status_failure(self):
         """Test failed vault status check"""
-        mock_cmd.return_value = (False, "connection refused")
+        self.manager.client = MagicMock()
+        self.manager.client.health.side_effect = VaultError("connection refused")
         
         result = self.manager.check_vault_status()
         
         self.assertFalse(result)
     
-    @patch.object(VaultCredentialManager, '_run_vault_command')
-    def test_get_credentials_success(self, mock_cmd):
+    def test_check_vault_status_sealed(self):
+        """Test vault status check against a sealed Vault"""
+        self.manager.client = MagicMock()
+        self.manager.client.health.return_value = {"initialized": True, "sealed": True}
+        
+        self.assertFalse(self.manager.check_vault_status())
+    
+    def _mock_client(self):
+        client = MagicMock()
+        client.token_lookup_self.return_value = {"data": {"ttl": 3600}}
+        self.manager.client = client
+        return client
+    
+    def test_get_credentials_success(self):
         """Test successful credential retrieval from Vault"""
-        # Mock successful vault response
-        mock_response = {
+        client = self._mock_client()
+        client.kv_read.return_value = {
             "data": {
                 "data": {
                     "username": "test_user",
@@ -132,7 +112,6 @@ class TestVaultCredentials(unittest.TestCase):
                 }
             }
         }
-        mock_cmd.return_value = (True, json.dumps(mock_response))
         
         credentials = self.manager.get_rabbitmq_credentials()
         
@@ -141,43 +120,43 @@ class TestVaultCredentials(unittest.TestCase):
         self.assertEqual(credentials.password, "test_password")
         self.assertEqual(credentials.host, "rabbitmq.rabbitmq")
         self.assertEqual(credentials.port, 5672)
+        client.kv_read.assert_called_once_with(self.test_vault_path, self.test_vault_token)
     
-    @patch.object(VaultCredentialManager, '_run_vault_command')
-    def test_get_credentials_failure(self, mock_cmd):
+    def test_get_credentials_failure(self):
         """Test failed credential retrieval from Vault"""
-        mock_cmd.return_value = (False, "secret not found")
+        client = self._mock_client()
+        client.kv_read.side_effect = VaultError("secret not found", 404)
         
         credentials = self.manager.get_rabbitmq_credentials()
         
         self.assertIsNone(credentials)
     
-    @patch.object(VaultCredentialManager, '_run_vault_command')
-    def test_get_credentials_malformed_response(self, mock_cmd):
-        """Test credential retrieval with malformed JSON response"""
-        mock_cmd.return_value = (True, "invalid json")
+    def test_get_credentials_malformed_response(self):
+        """Test credential retrieval with malformed response"""
+        client = self._mock_client()
+        client.kv_read.return_value = {"data": {}}
         
         credentials = self.manager.get_rabbitmq_credentials()
         
         self.assertIsNone(credentials)
     
-    @patch.object(VaultCredentialManager, '_run_vault_command')
-    def test_store_credentials_success(self, mock_cmd):
+    def test_store_credentials_success(self):
         """Test successful credential storage in Vault"""
-        mock_cmd.return_value = (True, "secret stored")
+        client = self._mock_client()
         
         result = self.manager.store_credentials("test_user", "test_pass", {"env": "test"})
         
         self.assertTrue(result)
-        # Verify the command was called with correct parameters
-        args = mock_cmd.call_args[0][0]
-        self.assertEqual(args[0], 'kv')
-        self.assertEqual(args[1], 'put')
-        self.assertEqual(args[2], self.test_vault_path)
-    
-    @patch.object(VaultCredentialManager, '_run_vault_command')
-    def test_store_credentials_failure(self, mock_cmd):
+        client.kv_write.assert_called_once_with(
+            self.test_vault_path,
+            {"username": "test_user", "password": "test_pass", "env": "test"},
+            self.test_vault_token
+        )
+    
+    def test_store_credentials_failure(self):
         """Test failed credential storage in Vault"""
-        mock_cmd.return_value = (False, "storage failed")
+        client = self._mock_client()
+        client.kv_write.side_effect = VaultError("storage failed", 500)
         
         result = self.manager.store_credentials("test_user", "test_pass")
         
@@ -192,6 +171,133 @@ class TestVaultCredentials(unittest.TestCase):
         self.assertFalse(result)
 
 
+class TestVaultClient(unittest.TestCase):
+    """Test cases for the pooled Vault HTTP client"""
+    
+    def setUp(self):
+        self.client = VaultClient("http://localhost:8200/", retries=0)
+    
+    def make_response(self, status=200, body=None):
+        response = MagicMock(status_code=status, content=b"{}" if body is not None else b"")
+        response.json.return_value = body
+        return response
+    
+    def test_kv2_data_path(self):
+        """Test mapping of CLI-style KV paths to KV v2 API paths"""
+        self.assertEqual(kv2_data_path("secret/rabbitmq"), "secret/data/rabbitmq")
+        self.assertEqual(kv2_data_path("secret/data/rabbitmq"), "secret/data/rabbitmq")
+        self.assertEqual(kv2_data_path("/secret/test/rabbitmq"), "secret/data/test/rabbitmq")
+    
+    def test_requests_share_one_session(self):
+        """Test that every call goes through the pooled session with the token header"""
+        with patch('requests.Session.request', return_value=self.make_response(body={"data": {}})) as mock_request:
+            self.client.kv_read("secret/rabbitmq", "tok")
+            self.client.token_lookup_self("tok")
+        
+        method, url = mock_request.call_args_list[0][0]
+        self.assertEqual((method, url), ("GET", "http://localhost:8200/v1/secret/data/rabbitmq"))
+        self.assertEqual(mock_request.call_args_list[0][1]["headers"], {"X-Vault-Token": "tok"})
+        self.assertEqual(mock_request.call_count, 2)
+    
+    def test_error_status_raises(self):
+        """Test that Vault errors surface as VaultError with the status code"""
+        with patch('requests.Session.request', return_value=self.make_response(403, {"errors": ["permission denied"]})):
+            with self.assertRaises(VaultError) as ctx:
+                self.client.kv_read("secret/rabbitmq", "tok")
+        
+        self.assertEqual(ctx.exception.status_code, 403)
+        self.assertIn("permission denied", str(ctx.exception))
+    
+    def test_connection_error_raises(self):
+        """Test that transport errors surface as VaultError without a status code"""
+        import requests
+        with patch('requests.Session.request', side_effect=requests.exceptions.ConnectionError("refused")):
+            with self.assertRaises(VaultError) as ctx:
+                self.client.health()
+        
+        self.assertIsNone(ctx.exception.status_code)
+    
+    def test_kubernetes_login_returns_auth(self):
+        """Test Kubernetes auth login"""
+        auth = {"client_token": "s.new", "lease_duration": 600, "renewable": True}
+        with patch('requests.Session.request', return_value=self.make_response(body={"auth": auth})) as mock_request:
+            result = self.client.kubernetes_login("gok-agent-role", "jwt")
+        
+        self.assertEqual(result, auth)
+        self.assertEqual(mock_request.call_args[1]["json"], {"role": "gok-agent-role", "jwt": "jwt"})
+
+
+class TestVaultTokenLifecycle(unittest.TestCase):
+    """Test cases for local token expiry tracking and renewal"""
+    
+    SECRET = {"data": {"data": {"username": "u", "password": "p"}}}
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.sa_token_path = os.path.join(self.temp_dir, "token")
+        with open(self.sa_token_path, "w") as f:
+            f.write("sa-jwt")
+        self.manager = VaultCredentialManager(
+            vault_addr="http://localhost:8200",
+            vault_token="s.initial",
+            service_account_token_path=self.sa_token_path,
+            auto_renew=False
+        )
+        self.client = MagicMock()
+        self.client.token_lookup_self.return_value = {"data": {"ttl": 3600, "renewable": True}}
+        self.client.kv_read.return_value = self.SECRET
+        self.manager.client = self.client
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_reads_skip_lookup_self(self):
+        """Test that token lifetime is looked up once, not per read"""
+        for _ in range(3):
+            self.assertIsNotNone(self.manager.get_rabbitmq_credentials())
+        
+        self.client.token_lookup_self.assert_called_once()
+        self.assertEqual(self.client.kv_read.call_count, 3)
+    
+    def test_renewable_token_is_renewed(self):
+        """Test that a token close to expiry is extended with renew-self"""
+        self.manager._set_token_lease(3600, True)
+        self.manager.token_expires = time.time() + 30
+        self.client.token_renew_self.return_value = {"auth": {"lease_duration": 3600, "renewable": True}}
+        
+        self.assertIsNotNone(self.manager.get_rabbitmq_credentials())
+        
+        self.client.token_renew_self.assert_called_once()
+        self.client.kubernetes_login.assert_not_called()
+        self.assertEqual(self.manager.vault_token, "s.initial")
+        self.assertGreater(self.manager.token_expires, time.time() + 3000)
+    
+    def test_failed_renewal_logs_in_again(self):
+        """Test that a non-renewable token is replaced by a new login"""
+        self.manager._set_token_lease(3600, False)
+        self.manager.token_expires = time.time() + 30
+        self.client.kubernetes_login.return_value = {"client_token": "s.new", "lease_duration": 1800, "renewable": True}
+        
+        self.assertIsNotNone(self.manager.get_rabbitmq_credentials())
+        
+        self.client.token_renew_self.assert_not_called()
+        self.assertEqual(self.manager.vault_token, "s.new")
+        self.assertTrue(self.manager.token_renewable)
+    
+    def test_revoked_token_is_replaced(self):
+        """Test that a 403 on read triggers one login and retry"""
+        self.manager._set_token_lease(3600, True)
+        self.client.kv_read.side_effect = [VaultError("permission denied", 403), self.SECRET]
+        self.client.kubernetes_login.return_value = {"client_token": "s.new", "lease_duration": 1800}
+        
+        credentials = self.manager.get_rabbitmq_credentials()
+        
+        self.assertIsNotNone(credentials)
+        self.assertEqual(self.manager.vault_token, "s.new")
+        self.assertEqual(self.client.kv_read.call_args[0][1], "s.new")
+
+
 class TestRabbitMQCredentials(unittest.TestCase):
     """Test cases for RabbitMQCredentials data class"""
     
@@ -217,20 +323,13 @@ class TestRabbitMQCredentials(unittest.TestCase):
 class TestFallbackFunctions(unittest.TestCase):
     """Test cases for fallback credential functions"""
     
-    @patch('subprocess.run')
-    def test_k8s_credentials_success(self, mock_run):
+    @patch('vault_credentials.get_secret_reader')
+    def test_k8s_credentials_success(self, mock_reader):
         """Test successful Kubernetes credential retrieval"""
-        # Mock kubectl responses
-        mock_run.side_effect = [
-            # Username retrieval
-            MagicMock(returncode=0, stdout="dGVzdF91c2Vy", stderr=""),  # base64 for "test_user"
-            # Base64 decode username
-            MagicMock(returncode=0, stdout="test_user", stderr=""),
-            # Password retrieval
-            MagicMock(returncode=0, stdout="dGVzdF9wYXNz", stderr=""),  # base64 for "test_pass"
-            # Base64 decode password
-            MagicMock(returncode=0, stdout="test_pass", stderr="")
-        ]
+        mock_reader.return_value.get_secret.return_value = {
+            "username": "test_user",
+            "password": "test_pass"
+        }
         
         from vault_credentials import get_rabbitmq_credentials_from_k8s
         credentials = get_rabbitmq_credentials_from_k8s()
@@ -238,11 +337,13 @@ class TestFallbackFunctions(unittest.TestCase):
         self.assertIsNotNone(credentials)
         self.assertEqual(credentials.username, "test_user")
         self.assertEqual(credentials.password, "test_pass")
+        self.assertEqual(credentials.source, "kubernetes")
+        mock_reader.return_value.get_secret.assert_called_once_with("rabbitmq", "rabbitmq-default-user")
     
-    @patch('subprocess.run')
-    def test_k8s_credentials_failure(self, mock_run):
+    @patch('vault_credentials.get_secret_reader')
+    def test_k8s_credentials_failure(self, mock_reader):
         """Test failed Kubernetes credential retrieval"""
-        mock_run.return_value.returncode = 1
+        mock_reader.return_value.get_secret.side_effect = KubernetesSecretError("HTTP 403")
         
         from vault_credentials import get_rabbitmq_credentials_from_k8s
         credentials = get_rabbitmq_credentials_from_k8s()
@@ -280,6 +381,147 @@ class TestFallbackFunctions(unittest.TestCase):
         mock_k8s.assert_called_once()
 
 
+class TestKubernetesSecretReader(unittest.TestCase):
+    """Test cases for the in-process Kubernetes secret reader"""
+    
+    SECRET = {
+        "metadata": {"name": "rabbitmq-default-user", "resourceVersion": "7"},
+        "data": {"username": "dGVzdF91c2Vy", "password": "dGVzdF9wYXNz"}
+    }
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.token_path = os.path.join(self.temp_dir, "token")
+        with open(self.token_path, "w") as f:
+            f.write("sa-token\n")
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def make_reader(self, **kwargs):
+        return KubernetesSecretReader(
+            api_server="https://kubernetes.default.svc",
+            token_path=self.token_path,
+            ca_path=os.path.join(self.temp_dir, "ca.crt"),
+            **kwargs
+        )
+    
+    def test_single_request_decodes_all_keys(self):
+        """Test that one GET returns every decoded key"""
+        reader = self.make_reader()
+        with patch('requests.Session.get', return_value=MagicMock(status_code=200, json=lambda: self.SECRET)) as mock_get:
+            data = reader.get_secret("rabbitmq", "rabbitmq-default-user")
+        
+        self.assertEqual(data, {"username": "test_user", "password": "test_pass"})
+        mock_get.assert_called_once()
+        self.assertTrue(mock_get.call_args[0][0].endswith("/api/v1/namespaces/rabbitmq/secrets/rabbitmq-default-user"))
+        self.assertEqual(mock_get.call_args[1]["headers"]["Authorization"], "Bearer sa-token")
+    
+    def test_http_error_raises(self):
+        """Test that a non-200 response raises KubernetesSecretError"""
+        reader = self.make_reader()
+        with patch('requests.Session.get', return_value=MagicMock(status_code=403)):
+            with self.assertRaises(KubernetesSecretError):
+                reader.get_secret("rabbitmq", "rabbitmq-default-user")
+    
+    def test_unavailable_outside_cluster(self):
+        """Test that a missing service account token is reported"""
+        reader = KubernetesSecretReader(token_path=os.path.join(self.temp_dir, "missing"))
+        self.assertFalse(reader.available)
+        with self.assertRaises(KubernetesSecretError):
+            reader.get_secret("rabbitmq", "rabbitmq-default-user")
+    
+    def test_watch_events_update_cache(self):
+        """Test that watch events keep the cached secret current"""
+        reader = self.make_reader(watch=True)
+        key = ("rabbitmq", "rabbitmq-default-user")
+        with patch.object(reader, '_start_watch'), \
+                patch('requests.Session.get', return_value=MagicMock(status_code=200, json=lambda: self.SECRET)) as mock_get:
+            reader.get_secret(*key)
+            reader.get_secret(*key)
+        self.assertEqual(mock_get.call_count, 1)
+        
+        rotated = {
+            "metadata": {"resourceVersion": "8"},
+            "data": {"username": "dGVzdF91c2Vy", "password": "bmV3X3Bhc3M="}  # new_pass
+        }
+        response = MagicMock(status_code=200)
+        response.__enter__.return_value = response
+        response.iter_lines.return_value = [json.dumps({"type": "MODIFIED", "object": rotated}).encode()]
+        with patch('requests.Session.get', return_value=response):
+            self.assertEqual(reader._watch_once(key, "7"), "8")
+        
+        self.assertEqual(reader.get_secret(*key)["password"], "new_pass")
+
+
+class TestCredentialProvider(unittest.TestCase):
+    """Test cases for the process-wide credential cache"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.secret_file = os.path.join(self.temp_dir, "rabbitmq")
+        with open(self.secret_file, "w") as f:
+            f.write("username: user1")
+        self.resolved = [RabbitMQCredentials("user1", "pass1")]
+        self.resolver = MagicMock(side_effect=lambda: self.resolved[-1])
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def make_provider(self, **kwargs):
+        kwargs.setdefault("background", False)
+        kwargs.setdefault("min_refresh_interval", 0)
+        return CredentialProvider(self.resolver, watch_paths=[self.secret_file], **kwargs)
+    
+    def test_credentials_are_cached(self):
+        provider = self.make_provider()
+        for _ in range(5):
+            self.assertEqual(provider.get().username, "user1")
+        self.assertEqual(self.resolver.call_count, 1)
+    
+    def test_renews_ahead_of_lease_expiry(self):
+        provider = self.make_provider(renew_ahead=60)
+        self.resolved.append(RabbitMQCredentials("user2", "pass2", expires_at=time.time() + 30))
+        provider.get()
+        provider.get()
+        self.assertEqual(self.resolver.call_count, 2)
+    
+    def test_file_change_triggers_refresh(self):
+        provider = self.make_provider()
+        provider.get()
+        stat = os.stat(self.secret_file)
+        os.utime(self.secret_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        provider.get()
+        self.assertEqual(self.resolver.call_count, 2)
+    
+    def test_forced_refresh_is_rate_limited(self):
+        provider = self.make_provider(min_refresh_interval=60)
+        provider.get()
+        for _ in range(5):
+            provider.get(force=True)
+        self.assertEqual(self.resolver.call_count, 1)
+    
+    def test_rotation_notifies_subscribers(self):
+        provider = self.make_provider()
+        rotations = []
+        unsubscribe = provider.subscribe(lambda old, new: rotations.append((old.username, new.username)))
+        provider.get()
+        self.resolved.append(RabbitMQCredentials("user2", "pass2"))
+        provider.get(force=True)
+        unsubscribe()
+        self.resolved.append(RabbitMQCredentials("user3", "pass3"))
+        provider.get(force=True)
+        self.assertEqual(rotations, [("user1", "user2")])
+    
+    def test_failed_resolution_keeps_previous_credentials(self):
+        provider = self.make_provider()
+        provider.get()
+        self.resolver.side_effect = Exception("vault down")
+        self.assertEqual(provider.get(force=True).username, "user1")
+
+
 @unittest.skipUnless(PIKA_AVAILABLE, "pika not available")
 class TestRabbitMQConnectivity(unittest.TestCase):
     """Test cases for RabbitMQ connectivity using credentials"""
@@ -360,8 +602,12 @@ def run_comprehensive_tests():
     # Add test classes
     test_classes = [
         TestVaultCredentials,
+        TestVaultClient,
+        TestVaultTokenLifecycle,
         TestRabbitMQCredentials,
         TestFallbackFunctions,
+        TestKubernetesSecretReader,
+        TestCredentialProvider,
         TestRabbitMQConnectivity,
         TestIntegrationScenarios
     ]
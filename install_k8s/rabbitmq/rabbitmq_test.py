@@ -187,30 +187,21 @@ def get_rabbitmq_credentials():
     Try to get RabbitMQ credentials from Kubernetes
     """
     try:
-        import subprocess
-        
-        # Get username
-        result = subprocess.run([
-            'kubectl', 'get', 'secret', 'rabbitmq-default-user', 
-            '-n', 'rabbitmq', '-o', 'jsonpath={.data.username}'
-        ], capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            return None, None
-            
         import base64
-        username = base64.b64decode(result.stdout).decode()
+        from kubernetes import client, config
         
-        # Get password
-        result = subprocess.run([
-            'kubectl', 'get', 'secret', 'rabbitmq-default-user', 
-            '-n', 'rabbitmq', '-o', 'jsonpath={.data.password}'
-        ], capture_output=True, text=True)
+        # Works from a workstation (kubeconfig) as well as inside a pod
+        try:
+            config.load_kube_config()
+        except config.ConfigException:
+            config.load_incluster_config()
         
-        if result.returncode != 0:
-            return username, None
-            
-        password = base64.b64decode(result.stdout).decode()
+        # A single API call returns both keys
+        secret = client.CoreV1Api().read_namespaced_secret('rabbitmq-default-user', 'rabbitmq')
+        data = secret.data or {}
+        
+        username = base64.b64decode(data['username']).decode() if 'username' in data else None
+        password = base64.b64decode(data['password']).decode() if 'password' in data else None
         return username, password
         
     except Exception as e: